@@ -6,6 +6,7 @@ from rich import print
 from rich.console import Console
 from datetime import datetime
 from lib.input_const import *
+from lib.util import sorting_columns
 
 console = Console()
 
@@ -115,7 +116,9 @@ if __name__ == '__main__':
 
     _mark = datetime.now()
     with console.status(f'[blue]Storing data in parquet file {_output_parquet_path}', spinner="bouncingBall"):
-        pq.write_table(pdelay_full, _output_parquet_path)
+        # pd-id is generated after sorting by source, entity and due-date, hence it carries the same order
+        pq.write_table(pdelay_full, _output_parquet_path,
+                       sorting_columns=sorting_columns(pdelay_full, [PayDelayColumns.Id.name]))
     print(f'[green]Parquet file stored in {(datetime.now() - _mark).total_seconds():.1f} s')
 
     # dataset = ds.dataset(_input_csv_path, format='csv')
@@ -6,7 +6,7 @@ import sys
 import csv
 from datetime import datetime
 from lib.input_const import *
-from lib.util import CodenameGen, report_processing
+from lib.util import CodenameGen, report_processing, sorting_columns, sort_if_needed, declared_sorting
 
 
 console = Console()
@@ -43,6 +43,10 @@ if __name__ == '__main__':
         pdelay_full = pq.read_table(_input_parquet_path)
     report_processing(f'File {_input_parquet_path} loaded', _mark, pdelay_full)
 
+    # the joins done in 121 do not preserve the order, sorting by pd-id restores the order by entity and due-date
+    # (filtering keeps it, so each per-source file is sorted by pd-id as well)
+    pdelay_full = sort_if_needed(pdelay_full, PayDelayColumns.Id.name, declared_sorting(_input_parquet_path))
+
     # isolate unique sources, count records for each source
     sources_counted = pdelay_full.group_by(PayDelayColumns.DataSource.name).\
         aggregate([(PayDelayColumns.DataSource.name, 'count')]).to_pandas().set_index(PayDelayColumns.DataSource.name)
@@ -71,10 +75,13 @@ if __name__ == '__main__':
             _target = PayDelayWithDebtsFileName(input_code=_input_code, codename=_sources_codenames[_src])
             _target_file = _target.file(DIR_PROCESSING, validate=False)
 
+            _source_content = pdelay_full.filter(pc.field(PayDelayColumns.DataSource.name) == _src)
             pq.write_table(
-                pdelay_full.filter(pc.field(PayDelayColumns.DataSource.name) == _src),
-                _target_file
+                _source_content,
+                _target_file,
+                sorting_columns=sorting_columns(_source_content, [PayDelayColumns.Id.name])
             )
+            _source_content = None
         print(f'[green]Source {_target.codename()} stored to parquet in '
               f'{(datetime.now() - _mark).total_seconds():.1f} s.')
 
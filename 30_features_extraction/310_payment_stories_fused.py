@@ -0,0 +1,60 @@
+import sys
+sys.path.append('../')
+from datetime import datetime
+
+from rich import print
+from rich.console import Console
+
+from lib.input_const import PayDelayWithDebtsDirectory, PaymentsGroupedDirectory, PaymentsDerivedDirectory, \
+    PaymentStoriesDirectory, DIR_PROCESSING
+from lib.paystories import *
+
+
+console = Console()
+
+# the fused equivalent of 311 and 312: the grouped payments are passed to story building in memory
+# and written only once, with all derived columns
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('[red]Missing required parameter: input code that identifies the group of files to be processed')
+        exit(1)
+
+    _input_code = sys.argv[1]
+    # optional: the input code of a previous run, its scaling parameters are used instead of calculating new ones
+    _frozen_input_code = None if len(sys.argv) < 3 else sys.argv[2]
+
+    _frozen_scaling = {}
+    if _frozen_input_code is not None:
+        # read before the grouped payments are removed, the snapshot may be the previous run of the same input
+        for _gpf in PaymentsDerivedDirectory(DIR_PROCESSING).file_names():
+            if _gpf.input_code() == _frozen_input_code:
+                _frozen_scaling[_gpf.codename()] = read_scaling_parameters(_gpf.file(DIR_PROCESSING))
+
+    # remove files from previous execution(s)
+    print(f'[green]Removing existing files with grouped payments and payment stories from {DIR_PROCESSING.absolute()}')
+    for _psf in PaymentsGroupedDirectory(DIR_PROCESSING).file_names() + \
+            PaymentsDerivedDirectory(DIR_PROCESSING).file_names() + \
+            PaymentStoriesDirectory(DIR_PROCESSING).file_names():
+        _psf.file(DIR_PROCESSING).unlink()
+        print(f'[red]{_psf.file_name()} deleted')
+
+    for pd_source_file in PayDelayWithDebtsDirectory(DIR_PROCESSING).file_names():
+        _codename = pd_source_file.codename()
+        if _frozen_input_code is not None and _frozen_scaling.get(_codename) is None:
+            print(f'[red]No scaling parameters persisted for source {_codename} and input {_frozen_input_code}')
+            exit(1)
+
+        _mark = datetime.now()
+        with console.status(f'[blue]Grouping payments of {_codename} into stories, building up stories '
+                            f'and discovering tendencies', spinner="bouncingBall"):
+            stories_builder = group_and_build_stories(pd_source_file.file(DIR_PROCESSING), _codename, _input_code,
+                                                      scaling=_frozen_scaling.get(_codename))
+        print(f'<{stories_builder.source_codename}> '
+              f'Delay: mean: {stories_builder.delay_mean()}, stddev: {stories_builder.delay_stddev()} | '
+              f'Amount: median: {stories_builder.amount_median()}, IQR: {stories_builder.amount_quantile_range()}')
+        print(f'[green]Stories wrote to {payment_stories_file(_input_code, _codename)}, payment groups wrote to '
+              f'{payments_grouped_by_stories_file(_input_code, _codename)} '
+              f'in {(datetime.now() - _mark).total_seconds():.1f} s')
+
+    print('[green]DONE')
@@ -5,13 +5,17 @@ from datetime import datetime
 from rich import print
 from rich.console import Console
 
-from lib.input_const import PayDelayWithDebtsDirectory, PaymentsGroupedDirectory, DIR_PROCESSING
+from lib.input_const import PayDelayWithDebtsDirectory, PaymentsGroupedDirectory, PaymentsDerivedDirectory, \
+    DIR_PROCESSING
 from lib.util import report_processing
 from lib.paystories import *
 
 
 console = Console()
 
+MODE_STREAM = 'stream'
+MODE_SHARDS = 'shards'
+
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
@@ -19,16 +23,55 @@ if __name__ == '__main__':
         exit(1)
 
     _input_code = sys.argv[1]
+    # optional processing mode:
+    # 'stream <batch-size>' - the sources are processed in entity-aligned batches of given number of records
+    # 'shards <count>' - each source is split into given count of entity ranges, processed in parallel
+    _usage = f'usage: {sys.argv[0]} <input-code> ({MODE_STREAM} <batch-size> | {MODE_SHARDS} <count>)'
+    if len(sys.argv) not in (2, 4):
+        print(f'[red]Unexpected parameters: {" ".join(sys.argv[2:])}, {_usage}')
+        exit(1)
+    _mode = None if len(sys.argv) == 2 else sys.argv[2]
+    if _mode not in (None, MODE_STREAM, MODE_SHARDS):
+        print(f'[red]Unknown processing mode: {_mode}, expected either {MODE_STREAM} or {MODE_SHARDS}, {_usage}')
+        exit(1)
+    if _mode is not None and (not sys.argv[3].isdigit() or int(sys.argv[3]) < 1):
+        print(f'[red]The {"batch size" if _mode == MODE_STREAM else "count of shards"} must be a positive number: '
+              f'{sys.argv[3]}, {_usage}')
+        exit(1)
+    _batch_size = int(sys.argv[3]) if _mode == MODE_STREAM else None
+    _shards = int(sys.argv[3]) if _mode == MODE_SHARDS else None
 
     # remove files from previous execution(s)
     print(f'[green]Removing existing files with per-source grouped payments from {DIR_PROCESSING.absolute()}')
-    for _pdf in PaymentsGroupedDirectory(DIR_PROCESSING).file_names():
+    # (including the sidecars with derived columns, they would not be aligned with new groups)
+    for _pdf in PaymentsGroupedDirectory(DIR_PROCESSING).file_names() + \
+            PaymentsDerivedDirectory(DIR_PROCESSING).file_names():
         _pdf.file(DIR_PROCESSING).unlink()
-        print(f'[red]{_pdf.codename()} deleted')
+        print(f'[red]{_pdf.file_name()} deleted')
 
     for pd_source_file in PayDelayWithDebtsDirectory(DIR_PROCESSING).file_names():
         timelines_grouper = PaymentHistoryGrouper(pd_source_file.file(DIR_PROCESSING), pd_source_file.codename())
 
+        if _batch_size is not None:
+            _mark = datetime.now()
+            with console.status(f'[blue]Grouping {timelines_grouper.source_codename} in batches of {_batch_size}',
+                                spinner="bouncingBall"):
+                _written = timelines_grouper.stream_and_store(_input_code, _batch_size)
+            print(f'[green]Source {timelines_grouper.source_codename} grouped in batches and stored to parquet '
+                  f'in {(datetime.now() - _mark).total_seconds():.1f} s, {_written} records, '
+                  f'total mem.: [red]{pa.total_allocated_bytes()/(1024*1024*1024):.1f} GB')
+            continue
+
+        if _shards is not None:
+            _mark = datetime.now()
+            with console.status(f'[blue]Grouping {timelines_grouper.source_codename} in {_shards} shards',
+                                spinner="bouncingBall"):
+                _written = group_in_shards(
+                    pd_source_file.file(DIR_PROCESSING), pd_source_file.codename(), _input_code, _shards)
+            print(f'[green]Source {timelines_grouper.source_codename} grouped in shards and stored to parquet '
+                  f'in {(datetime.now() - _mark).total_seconds():.1f} s, {_written} records')
+            continue
+
         _mark = datetime.now()
         with console.status(f'[blue]Loading {timelines_grouper.source_codename}', spinner="bouncingBall"):
             _content = timelines_grouper.content()
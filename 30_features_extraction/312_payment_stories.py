@@ -8,9 +8,12 @@ from rich.console import Console
 
 from lib.util import report_processing
 from lib.paystories import *
+from lib.storyindex import PaymentsIndex
 
 console = Console()
 
+ALL_SOURCES = '*'
+
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
@@ -18,7 +21,13 @@ if __name__ == '__main__':
         exit(1)
 
     _input_code = sys.argv[1]
-    _single_source = None if len(sys.argv) < 3 else sys.argv[2]
+    _single_source = None if len(sys.argv) < 3 or sys.argv[2] == ALL_SOURCES else sys.argv[2]
+    # optional: if provided, each source is split into given count of entity ranges, processed in parallel
+    # (0 = not split)
+    _shards = None if len(sys.argv) < 4 or int(sys.argv[3]) == 0 else int(sys.argv[3])
+    # optional: the input code of a previous run, its scaling parameters are used instead of calculating new ones,
+    # so that the stories are comparable with the snapshot
+    _frozen_input_code = None if len(sys.argv) < 5 else sys.argv[4]
 
     if _single_source is None:
         # remove files from previous execution(s)
@@ -31,7 +40,32 @@ if __name__ == '__main__':
         if _single_source is not None and _single_source != grouped_payments.codename():
             continue
 
-        stories_builder = PaymentStoriesBuilder(grouped_payments.file(DIR_PROCESSING), grouped_payments.codename())
+        _scaling = None
+        if _frozen_input_code is not None:
+            try:
+                _scaling = frozen_scaling_parameters(_frozen_input_code, grouped_payments.codename())
+            except ValueError as _e:
+                print(f'[red]{_e}')
+                exit(1)
+            print(f'[yellow]Scaling parameters of {grouped_payments.codename()} frozen from input {_frozen_input_code}')
+
+        if _shards is not None:
+            _mark = datetime.now()
+            with console.status(f'[blue]Building stories of {grouped_payments.codename()} in {_shards} shards',
+                                spinner="bouncingBall"):
+                _scaling, _count = build_stories_in_shards(
+                    grouped_payments.file(DIR_PROCESSING), grouped_payments.codename(), _input_code, _shards,
+                    _scaling)
+            print(f'<{grouped_payments.codename()}> '
+                  f'Delay: mean: {_scaling.delay_mean}, stddev: {_scaling.delay_stddev} | '
+                  f'Amount: median: {_scaling.amount_median}, IQR: {_scaling.amount_quantile_range}')
+            print(f'[green]{_count} stories built in shards, stories and derived columns of payment groups written '
+                  f'in {(datetime.now() - _mark).total_seconds():.1f} s')
+            PaymentsIndex.of(_input_code, grouped_payments.codename())
+            continue
+
+        stories_builder = PaymentStoriesBuilder(grouped_payments.file(DIR_PROCESSING), grouped_payments.codename(),
+                                                scaling=_scaling)
 
         _mark = datetime.now()
         with console.status(f'[blue]Loading {stories_builder.source_codename}', spinner="bouncingBall"):
@@ -73,7 +107,14 @@ if __name__ == '__main__':
         _mark = datetime.now()
         with console.status(f'[blue]Updating payment groups', spinner="bouncingBall"):
             _file = stories_builder.update_payment_groups(_input_code)
-        print(f'[green]Payment groups updated, wrote to '
+        print(f'[green]Derived columns of payment groups wrote to '
               f'{_file} in {(datetime.now() - _mark).total_seconds():.1f} s')
 
+        _mark = datetime.now()
+        with console.status(f'[blue]Indexing payment groups', spinner="bouncingBall"):
+            _index = PaymentsIndex.of(_input_code, grouped_payments.codename())
+        print(f'[green]Offset index of {len(_index)} stories wrote to '
+              f'{payments_index_file(_input_code, grouped_payments.codename())} '
+              f'in {(datetime.now() - _mark).total_seconds():.1f} s')
+
     print('[green]DONE')
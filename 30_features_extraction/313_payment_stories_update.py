@@ -0,0 +1,83 @@
+import sys
+sys.path.append('../')
+
+from datetime import datetime
+
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from rich import print
+from rich.console import Console
+
+from lib.input_const import PayDelayWithDebtsDirectory, DIR_INPUT, DIR_PROCESSING, PREFIX_DEBTS, EXTENSION_PARQUET, \
+    PayDelayColumns, payment_stories_file, story_state_file
+from lib.paystories import PaymentHistoryGrouper, calculate_scaling_parameters
+from lib.storystate import IncrementalStories, updated_stories
+from lib.util import report_processing
+
+console = Console()
+
+# the incremental alternative to 311 and 312: the stories of the previous input are updated with the new payments
+# (and debts), only the state of the last story of every entity is read, not the payments already processed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('[red]Missing required parameter: input code that identifies the group of files with new payments')
+        exit(1)
+
+    _input_code = sys.argv[1]
+    # optional: the input code of the previous run, whose stories are updated (if not provided, built from scratch)
+    _previous_input_code = None if len(sys.argv) < 3 else sys.argv[2]
+
+    # the debts of the input (optional), only those valid from after the last processed payment of an entity
+    # are applied, the earlier ones were joined to the processed payments already (see IncrementalStories.update)
+    _debts_file = DIR_INPUT / f'{PREFIX_DEBTS}_{_input_code}{EXTENSION_PARQUET}'
+    _debts = pq.read_table(_debts_file) if _previous_input_code is not None and _debts_file.exists() else None
+
+    for pd_source_file in PayDelayWithDebtsDirectory(DIR_PROCESSING).file_names():
+        if pd_source_file.input_code() != _input_code:
+            continue
+        _codename = pd_source_file.codename()
+
+        _mark = datetime.now()
+        with console.status(f'[blue]Loading new payments of {_codename}', spinner="bouncingBall"):
+            _payments = pq.read_table(pd_source_file.file(DIR_PROCESSING),
+                                      columns=PaymentHistoryGrouper.COLUMNS + [PayDelayColumns.IsOutlier.name])
+        report_processing(f"New payments of source {_codename} loaded", _mark, _payments)
+
+        if _previous_input_code is None:
+            _stories = None
+            _incremental = IncrementalStories(_codename, calculate_scaling_parameters(
+                _payments.filter(~pc.field(PayDelayColumns.IsOutlier.name))))
+        else:
+            _state_file = story_state_file(_previous_input_code, _codename)
+            if not _state_file.exists():
+                print(f'[red]No story state of source {_codename} and input {_previous_input_code} ({_state_file})')
+                exit(1)
+            _stories = pq.read_table(payment_stories_file(_previous_input_code, _codename))
+            _incremental = IncrementalStories.read(_state_file, _codename)
+
+        _mark = datetime.now()
+        with console.status(f'[blue]Updating stories', spinner="bouncingBall"):
+            try:
+                _update = _incremental.update(_payments, _debts)
+            except ValueError as _e:
+                print(f'[red]{_e}')
+                exit(1)
+            _stories = _update.stories if _stories is None else updated_stories(_stories, _update)
+        print(f'[green]{_update.stories.num_rows} stories changed ({len(_update.retracted)} continued under new id) '
+              f'in {(datetime.now() - _mark).total_seconds():.1f} s')
+        if _update.ignored_debts > 0:
+            print(f'[yellow]{_update.ignored_debts} debts valid from before the last processed payment of their entity '
+                  f'ignored (already joined to the processed payments)')
+
+        _mark = datetime.now()
+        with console.status(f'[blue]Writing stories and story state', spinner="bouncingBall"):
+            _stories_file = payment_stories_file(_input_code, _codename)
+            pq.write_table(_stories, _stories_file)
+            _state_file = _incremental.write(story_state_file(_input_code, _codename))
+        print(f'[green]Stories wrote to {_stories_file}, story state wrote to {_state_file} '
+              f'in {(datetime.now() - _mark).total_seconds():.1f} s')
+
+    print('[green]DONE')
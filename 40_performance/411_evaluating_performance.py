@@ -7,6 +7,9 @@ from rich import print
 from rich.console import Console
 
 from lib.perfeval import *
+from lib.bootstrap import PerformanceBootstrap
+from lib.evalcache import EvaluationCache
+from lib.histogram import DEFAULT_PRECISION_BITS, histograms_table, write_histograms
 from lib.input_const import PaymentStoriesColumns
 
 console = Console()
@@ -18,6 +21,12 @@ if __name__ == '__main__':
         exit(1)
 
     _input_code = sys.argv[1]
+    # optional: the count of bootstrap replicates of the confidence intervals of ROC AUC and F1-max (0 = no intervals)
+    _replicates = 1000 if len(sys.argv) < 3 else int(sys.argv[2])
+    # optional: the count of processes computing the bootstrap replicates
+    _workers = None if len(sys.argv) < 4 else int(sys.argv[3])
+    # optional: the precision (bits of mantissa) of the histograms pooled by 412_pooled_performance
+    _precision_bits = DEFAULT_PRECISION_BITS if len(sys.argv) < 5 else int(sys.argv[4])
 
     predictor_cols = [
         PaymentStoriesColumns.ScaledDelayMean,
@@ -56,7 +65,16 @@ if __name__ == '__main__':
                 StoriesPerformanceReportColNames.PredictorPerformanceROCAUC(_predictor_col, _actual_col): [],
                 StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMax(_predictor_col, _actual_col): [],
                 StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMaxTh(_predictor_col, _actual_col): [],
+                StoriesPerformanceReportColNames.PredictorPerformancePRAUC(_predictor_col, _actual_col): [],
             })
+            if _replicates > 0:
+                statistics.update({
+                    StoriesPerformanceReportColNames.PredictorPerformanceROCAUCLow(_predictor_col, _actual_col): [],
+                    StoriesPerformanceReportColNames.PredictorPerformanceROCAUCHigh(_predictor_col, _actual_col): [],
+                    StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMaxLow(_predictor_col, _actual_col): [],
+                    StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMaxHigh(_predictor_col, _actual_col):
+                        [],
+                })
 
     # F1 for 0.0 threshold (tendencies coefficients)
     for _predictor_col in (PaymentStoriesColumns.TendencyCoefficient_ForDelay,
@@ -67,6 +85,7 @@ if __name__ == '__main__':
             })
 
     sources = []
+    histograms = []
 
     for payment_stories in PaymentStoriesDirectory(DIR_PROCESSING).file_names():
         evaluator = PaymentStoriesPerformanceEvaluator(payment_stories.file(DIR_PROCESSING), payment_stories.codename())
@@ -80,6 +99,8 @@ if __name__ == '__main__':
         #     continue
 
         sources.append(payment_stories.codename())
+        # the optimal thresholds and their confusion matrices are persisted for the output scripts (50_output)
+        cache = EvaluationCache(payment_stories.input_code(), payment_stories.codename(), evaluator)
 
         _mark = datetime.now()
         with console.status(f'[blue]Calculating basic stats for {payment_stories.codename()}', spinner="bouncingBall"):
@@ -95,35 +116,58 @@ if __name__ == '__main__':
               f'Basic stats done in {(datetime.now() - _mark).total_seconds():.1f} s. '
               f'Size: {evaluator.count_stories()} stories')
 
-        for _predictor_col in predictor_cols:
-            _mark = datetime.now()
-            with console.status(f'[blue]Calculating statistics of {_predictor_col.name}', spinner="bouncingBall"):
-                statistics[StoriesPerformanceReportColNames.PredictorMean(_predictor_col)].append(
-                    evaluator.predictor_mean(_predictor_col.name))
-                statistics[StoriesPerformanceReportColNames.PredictorMedian(_predictor_col)].append(
-                    evaluator.predictor_median(_predictor_col.name))
-                statistics[StoriesPerformanceReportColNames.PredictorStddev(_predictor_col)].append(
-                    evaluator.predictor_stddev(_predictor_col.name))
-                statistics[StoriesPerformanceReportColNames.PredictorCountValid(_predictor_col)].append(
-                    evaluator.predictor_vcount(_predictor_col.name))
-            print(f'[green]Stats for {_predictor_col.name} '
-                  f'calculated in {(datetime.now() - _mark).total_seconds():.1f} s')
+        _mark = datetime.now()
+        with console.status(f'[blue]Calculating statistics and ROC AUC of {len(predictor_cols)} predictors',
+                            spinner="bouncingBall"):
+            _batch = evaluator.predictors_report(predictor_cols, actual_cols)
+            for _name in _batch.columns:
+                statistics[_name].append(_batch[_name].iloc[0])
+        print(f'[green]Stats and ROC AUC of {len(predictor_cols)} predictors for {len(actual_cols)} actual columns '
+              f'calculated in {(datetime.now() - _mark).total_seconds():.1f} s')
 
+        for _predictor_col in predictor_cols:
             for _actual_col in actual_cols:
+                _mark = datetime.now()
                 with console.status(f'[blue]Evaluating performance of {_predictor_col.name} for {_actual_col.name}',
                                     spinner="bouncingBall"):
-                    rocauc = evaluator.roc_auc(_predictor_col.name, _actual_col.name)
-                    statistics[StoriesPerformanceReportColNames.PredictorPerformanceROCAUC(
-                        _predictor_col, _actual_col)].append(rocauc)
-                    f1 = evaluator.f1_max(_predictor_col.name, _actual_col.name)
+                    f1 = cache.f1_max(_predictor_col.name, _actual_col.name, exact=True)
+                    cache.confusion_matrix(_predictor_col.name, f1[1], _actual_col.name)
                     statistics[StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMax(
                         _predictor_col, _actual_col)].append(f1[0])
                     statistics[StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMaxTh(
                         _predictor_col, _actual_col)].append(f1[1])
+                    prauc = evaluator.precision_recall_auc(_predictor_col.name, _actual_col.name)
+                    statistics[StoriesPerformanceReportColNames.PredictorPerformancePRAUC(
+                        _predictor_col, _actual_col)].append(prauc)
+                rocauc = _batch[StoriesPerformanceReportColNames.PredictorPerformanceROCAUC(
+                    _predictor_col, _actual_col)].iloc[0]
                 print(f'[green]Performance of {_predictor_col.name} for {_actual_col.name} evaluated '
                       f'in {(datetime.now() - _mark).total_seconds():.1f} s. '
                       f'F1-max: {"N/A" if f1[0] is None else f"{f1[0]:.3f}"}, '
-                      f'ROCAUC: {"N/A" if rocauc is None else f"{rocauc:.3f}"}')
+                      f'ROCAUC: {"N/A" if rocauc is None else f"{rocauc:.3f}"}, '
+                      f'PRAUC: {"N/A" if prauc is None else f"{prauc:.3f}"}')
+
+        if _replicates > 0:
+            _mark = datetime.now()
+            with console.status(f'[blue]Bootstrapping confidence intervals ({_replicates} replicates)',
+                                spinner="bouncingBall"):
+                # fixed seed: the intervals are reproducible
+                _intervals = PerformanceBootstrap(evaluator, replicates=_replicates, seed=0, workers=_workers).report(
+                    predictor_cols, actual_cols)
+                for _name in _intervals.columns:
+                    statistics[_name].append(_intervals[_name].iloc[0])
+            print(f'[green]Confidence intervals of ROC AUC and F1-max bootstrapped '
+                  f'in {(datetime.now() - _mark).total_seconds():.1f} s')
+
+        _mark = datetime.now()
+        with console.status(f'[blue]Building histograms of {len(predictor_cols)} predictors', spinner="bouncingBall"):
+            histograms.append(histograms_table(payment_stories.codename(), {
+                (_predictor_col.name, _actual_col.name): evaluator.predictor_histogram(
+                    _predictor_col.name, _actual_col.name, _precision_bits)
+                for _predictor_col in predictor_cols for _actual_col in actual_cols
+            }))
+        print(f'[green]Histograms of {len(predictor_cols)} predictors ({histograms[-1].num_rows} bins) '
+              f'built in {(datetime.now() - _mark).total_seconds():.1f} s')
 
         for _predictor_col in (PaymentStoriesColumns.TendencyCoefficient_ForDelay,
                                PaymentStoriesColumns.TendencyCoefficient_ForSeverity):
@@ -139,4 +183,5 @@ if __name__ == '__main__':
 
     report = pd.DataFrame(statistics, index=sources)
     report.to_csv(report_predictors(_input_code))
+    write_histograms(histograms, report_predictor_histograms(_input_code), _precision_bits)
     print('[green]DONE')
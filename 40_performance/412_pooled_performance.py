@@ -0,0 +1,51 @@
+import sys
+sys.path.append('../')
+
+from datetime import datetime
+
+import pandas as pd
+from rich import print
+
+from lib.histogram import pooled_histograms
+from lib.input_const import *
+
+# the performance of predictors pooled over sources, from the histograms written by 411_evaluating_performance
+# (the story files are not read)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('[red]Missing required parameter: input code that identifies the group of files to be processed')
+        exit(1)
+
+    _input_code = sys.argv[1]
+    # optional: comma-separated code-names of the sources to be pooled, all sources of the histograms by default
+    _sources = None if len(sys.argv) < 3 else sys.argv[2].split(',')
+
+    if not report_predictor_histograms(_input_code).exists():
+        print(f'[red]No histograms {report_predictor_histograms(_input_code)}, run 411_evaluating_performance first')
+        exit(1)
+
+    _mark = datetime.now()
+    histograms = pooled_histograms(report_predictor_histograms(_input_code), _sources)
+    print(f'[green]Histograms of {len(histograms)} predictor-actual pairs pooled over '
+          f'{"all sources" if _sources is None else f"{len(_sources)} sources"} '
+          f'in {(datetime.now() - _mark).total_seconds():.1f} s')
+
+    statistics = {}
+    for (_predictor, _actual), _histogram in histograms.items():
+        _predictor_col = Column(_predictor, None)
+        _actual_col = Column(_actual, None)
+        f1 = _histogram.f1_max()
+        rocauc = _histogram.roc_auc()
+        statistics.update({
+            StoriesPerformanceReportColNames.PredictorPerformanceROCAUC(_predictor_col, _actual_col): rocauc,
+            StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMax(_predictor_col, _actual_col): f1[0],
+            StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMaxTh(_predictor_col, _actual_col): f1[1]
+        })
+        print(f'[green]Pooled performance of {_predictor} for {_actual}: '
+              f'F1-max: {"N/A" if f1[0] is None else f"{f1[0]:.3f}"}, ROCAUC: {rocauc:.3f}')
+
+    report = pd.DataFrame({_name: [_value] for _name, _value in statistics.items()},
+                          index=['pooled' if _sources is None else '+'.join(_sources)])
+    report.to_csv(report_predictors_pooled(_input_code))
+    print('[green]DONE')
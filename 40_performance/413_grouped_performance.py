@@ -0,0 +1,63 @@
+import sys
+sys.path.append('../')
+
+from datetime import datetime
+
+import pandas as pd
+from rich import print
+from rich.console import Console
+
+from lib.perfeval import *
+
+console = Console()
+
+# the performance of predictors per group of stories (e.g. credit status at the beginning of the story,
+# bucket of story length), one row per source, group, predictor and actual column
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('[red]Missing required parameters: input code and the column the stories are grouped by')
+        exit(1)
+
+    _input_code = sys.argv[1]
+    _group_col = sys.argv[2]
+    # optional: comma-separated edges of buckets of a numeric group column (e.g. 3,5,10,20 for payments_count)
+    _bins = None if len(sys.argv) < 4 else [float(_edge) for _edge in sys.argv[3].split(',')]
+
+    predictor_cols = [
+        PaymentStoriesColumns.ScaledDelayMean,
+        PaymentStoriesColumns.SeverityMean,
+        PaymentStoriesColumns.TendencyCoefficient_ForDelay,
+        PaymentStoriesColumns.TendencyCoefficient_ForSeverity,
+        PaymentStoriesColumns.Tendency_ForDelay,
+        PaymentStoriesColumns.Tendency_ForSeverity,
+        PaymentStoriesColumns.TendencyMinusMean_ForDelay,
+        PaymentStoriesColumns.TendencyMinusMean_ForSeverity
+    ]
+
+    actual_cols = [
+        PaymentStoriesColumns.DenotesAnyRisk,
+        PaymentStoriesColumns.DenotesSignificantRisk
+    ]
+
+    reports = []
+    for payment_stories in PaymentStoriesDirectory(DIR_PROCESSING).file_names():
+        evaluator = PaymentStoriesPerformanceEvaluator(payment_stories.file(DIR_PROCESSING), payment_stories.codename())
+
+        if evaluator.count_stories() < 100:
+            print(f'[red]The source <{evaluator.source_codename}> '
+                  f'contains less than 100 stories ({evaluator.count_stories()}), it is skipped')
+            continue
+
+        _mark = datetime.now()
+        with console.status(f'[blue]Evaluating {len(predictor_cols)} predictors of {payment_stories.codename()} '
+                            f'by {_group_col}', spinner="bouncingBall"):
+            _report = evaluator.grouped_report(_group_col, predictor_cols, actual_cols, _bins)
+            _report.insert(0, 'source', payment_stories.codename())
+            reports.append(_report)
+        print(f'[green]<{payment_stories.codename()}> {_report[_group_col].nunique(dropna=False)} groups evaluated '
+              f'in {(datetime.now() - _mark).total_seconds():.1f} s')
+
+    report = pd.concat(reports, ignore_index=True)
+    report.to_csv(report_predictors_grouped(_input_code, _group_col), index=False)
+    print('[green]DONE')
@@ -1,6 +1,7 @@
 import sys
 sys.path.append('../')
 from lib.input_const import *
+from lib.storyindex import story_payments
 import pyarrow.parquet as pq
 import pyarrow.compute as pc
 import pandas as pd
@@ -226,10 +227,9 @@ def fig_sources_rel_risk_rate(input_code: str, name: str):
 
 def fig_story_example(input_code: str, name: str, source_codename: str, story_id: int) -> Path:
     stories = pq.read_table(payment_stories_file(input_code, source_codename))
-    groups = pq.read_table(payments_grouped_by_stories_file(input_code, source_codename))
 
     story = stories.filter(pc.field(PaymentStoriesColumns.StoryId.name) == story_id).to_pylist()[0]
-    payments = groups.filter(pc.field(PaymentGroupsColumns.StoryId.name) == story_id).select([
+    payments = story_payments(input_code, source_codename, story_id, [
         PaymentGroupsColumns.StoryTimeline.name,
         PaymentGroupsColumns.DelayDaysScaled.name
     ]).to_pydict()
@@ -1,7 +1,8 @@
 import sys
 sys.path.append('../')
 from lib.input_const import *
-from lib.perfeval import PaymentStoriesPerformanceEvaluator
+from lib.storyindex import story_payments
+from lib.evalcache import EvaluationCache
 import pyarrow.parquet as pq
 import pyarrow.compute as pc
 import pandas as pd
@@ -28,10 +29,9 @@ def _correct_tab(tex: str) -> str:
 
 def fig_severity_shown(input_code: str, name: str, source_codename: str, story_id: int) -> Path:
     stories = pq.read_table(payment_stories_file(input_code, source_codename))
-    groups = pq.read_table(payments_grouped_by_stories_file(input_code, source_codename))
 
     story = stories.filter(pc.field(PaymentStoriesColumns.StoryId.name) == story_id).to_pylist()[0]
-    payments = groups.filter(pc.field(PaymentGroupsColumns.StoryId.name) == story_id).select([
+    payments = story_payments(input_code, source_codename, story_id, [
         PaymentGroupsColumns.StoryTimeline.name,
         PaymentGroupsColumns.DelayDaysScaled.name,
         PaymentGroupsColumns.Severity.name
@@ -69,10 +69,9 @@ def fig_severity_shown(input_code: str, name: str, source_codename: str, story_i
 
 def fig_h1_delay_mean(input_code: str, name: str, source_codename: str, story_id: int) -> Path:
     stories = pq.read_table(payment_stories_file(input_code, source_codename))
-    groups = pq.read_table(payments_grouped_by_stories_file(input_code, source_codename))
 
     story = stories.filter(pc.field(PaymentStoriesColumns.StoryId.name) == story_id).to_pylist()[0]
-    payments = groups.filter(pc.field(PaymentGroupsColumns.StoryId.name) == story_id).select([
+    payments = story_payments(input_code, source_codename, story_id, [
         PaymentGroupsColumns.StoryTimeline.name,
         PaymentGroupsColumns.DelayDaysScaled.name
     ]).to_pydict()
@@ -122,10 +121,9 @@ def fig_h1_delay_mean(input_code: str, name: str, source_codename: str, story_id
 
 def fig_h3_delay_tendency(input_code: str, name: str, source_codename: str, story_id: int) -> Path:
     stories = pq.read_table(payment_stories_file(input_code, source_codename))
-    groups = pq.read_table(payments_grouped_by_stories_file(input_code, source_codename))
 
     story = stories.filter(pc.field(PaymentStoriesColumns.StoryId.name) == story_id).to_pylist()[0]
-    payments = groups.filter(pc.field(PaymentGroupsColumns.StoryId.name) == story_id).select([
+    payments = story_payments(input_code, source_codename, story_id, [
         PaymentGroupsColumns.StoryTimeline.name,
         PaymentGroupsColumns.DelayDaysScaled.name
     ]).to_pydict()
@@ -169,10 +167,9 @@ def fig_h3_delay_tendency(input_code: str, name: str, source_codename: str, stor
 
 def fig_h5_tendency_value_explained(input_code: str, name: str, source_codename: str, story_id: int) -> Path:
     stories = pq.read_table(payment_stories_file(input_code, source_codename))
-    groups = pq.read_table(payments_grouped_by_stories_file(input_code, source_codename))
 
     story = stories.filter(pc.field(PaymentStoriesColumns.StoryId.name) == story_id).to_pylist()[0]
-    payments = groups.filter(pc.field(PaymentGroupsColumns.StoryId.name) == story_id).select([
+    payments = story_payments(input_code, source_codename, story_id, [
         PaymentGroupsColumns.StoryTimeline.name,
         PaymentGroupsColumns.DelayDaysScaled.name
     ]).to_pydict()
@@ -332,7 +329,7 @@ def tab_sources_f1_overview(input_code: str, name: str) -> Path:
 
 
 def fig_roc_curves(input_code: str, name: str, source_codename: str):
-    evaluator = PaymentStoriesPerformanceEvaluator(payment_stories_file(input_code, source_codename), source_codename)
+    evaluator = EvaluationCache(input_code, source_codename)
     _fpr = 'False Positive Rate'
     _tpr = 'True Positive Rate'
     _actual_col = PaymentStoriesColumns.DenotesAnyRisk.name
@@ -385,7 +382,7 @@ def fig_roc_curves(input_code: str, name: str, source_codename: str):
 
 
 def fig_f1_curves(input_code: str, name: str, source_codename: str):
-    evaluator = PaymentStoriesPerformanceEvaluator(payment_stories_file(input_code, source_codename), source_codename)
+    evaluator = EvaluationCache(input_code, source_codename)
     report = pd.read_csv(report_predictors(input_code), index_col=[0]).merge(
         pd.read_csv(report_overview_file(input_code), index_col=[0]), left_index=True, right_index=True).filter(
         items=[source_codename], axis='index')
@@ -460,8 +457,9 @@ def fig_f1_curves(input_code: str, name: str, source_codename: str):
 
 
 def tab_binary_classifier_metrics(input_code: str, name: str, source_codename: str):
-    evaluator = PaymentStoriesPerformanceEvaluator(payment_stories_file(input_code, source_codename), source_codename)
-    report = pd.read_csv(report_predictors(input_code), index_col=[0]).merge(
+    evaluator = EvaluationCache(input_code, source_codename)
+    # the thresholds read exactly as written by 411_evaluating_performance, their metrics are cached
+    report = pd.read_csv(report_predictors(input_code), index_col=[0], float_precision='round_trip').merge(
         pd.read_csv(report_overview_file(input_code), index_col=[0]), left_index=True, right_index=True).filter(
         items=[source_codename], axis='index')
 
@@ -0,0 +1,33 @@
+import sys
+sys.path.append('../')
+from datetime import datetime
+
+from rich import print
+
+from lib.input_const import PaymentStoriesColumns, report_predictors
+from lib.scoring import RiskScoringService, serve, thresholds_from_report
+
+# the local HTTP stand-in of the scoring service for one source (see lib.scoring.serve for the resources)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print('[red]Missing required parameters: input code and code-name of the source to be served')
+        exit(1)
+
+    _input_code = sys.argv[1]
+    _codename = sys.argv[2]
+    _port = 8765 if len(sys.argv) < 4 else int(sys.argv[3])
+
+    _thresholds = {}
+    if report_predictors(_input_code).exists():
+        _thresholds = thresholds_from_report(_input_code, _codename, PaymentStoriesColumns.DenotesAnyRisk)
+        print(f'[green]F1-max thresholds of {len(_thresholds)} predictors loaded from {report_predictors(_input_code)}')
+    else:
+        print(f'[yellow]No predictors report {report_predictors(_input_code)}, no risk is predicted')
+
+    _mark = datetime.now()
+    service = RiskScoringService(_input_code, _codename, _thresholds)
+    print(f'[green]Stories of {_codename} mapped in {(datetime.now() - _mark).total_seconds():.1f} s')
+
+    print(f'[blue]Serving at http://127.0.0.1:{_port}/entities/<entity-id>')
+    serve(service, port=_port)
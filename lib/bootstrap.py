@@ -0,0 +1,147 @@
+"""
+Bootstrap confidence intervals of ROC AUC and F1-max. The stories are counted per distinct value of the predictor and
+actual value (taken from the ranking the evaluator sorts once and caches). A replicate resamples the stories with random
+weights; the sum of weights of a group of stories is drawn directly (the sum of independent Poisson(1) weights is
+Poisson distributed, multinomial weights summed up per group are multinomial again), so a block of replicates is a
+matrix of distinct values x replicates, and both the area and the F1-max follow from its cumulative sums, as in the
+exact evaluation.
+"""
+from lib.input_const import *
+from lib.perfeval import PaymentStoriesPerformanceEvaluator
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+WEIGHTS_POISSON = 'poisson'
+WEIGHTS_MULTINOMIAL = 'multinomial'
+
+# the (low, high) confidence interval, None if undefined
+Interval = tuple[Optional[float], Optional[float]]
+
+# the maximal count of elements of the matrix of resampled counts of a block (distinct values x replicates)
+BLOCK_ELEMENTS = 1 << 20
+
+
+def _resampled_counts(rng: np.random.Generator, positives: np.ndarray, negatives: np.ndarray, replicates: int,
+                      weights: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    :param positives: the count of actual positives of every distinct value of the predictor
+    :param negatives: the count of actual negatives of every distinct value of the predictor
+    :return: the resampled counts (distinct values x replicates) of positives and negatives: Poisson (the count
+    of stories of a replicate varies) or multinomial (exactly the count of stories, the classic bootstrap)
+    """
+    if weights == WEIGHTS_POISSON:
+        return rng.poisson(positives[:, np.newaxis], size=(len(positives), replicates)).astype(np.float64), \
+            rng.poisson(negatives[:, np.newaxis], size=(len(negatives), replicates)).astype(np.float64)
+    if weights == WEIGHTS_MULTINOMIAL:
+        _stories = int(positives.sum() + negatives.sum())
+        _counts = rng.multinomial(_stories, np.concatenate([positives, negatives]) / _stories, size=replicates).T
+        return _counts[:len(positives)].astype(np.float64), _counts[len(positives):].astype(np.float64)
+    raise ValueError(f'Unknown resample weights: {weights}, possible choices are: '
+                     f'{[WEIGHTS_POISSON, WEIGHTS_MULTINOMIAL]}')
+
+
+def _bootstrap_block(positives: np.ndarray, negatives: np.ndarray, replicates: int, seed: np.random.SeedSequence,
+                     weights: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    :param positives: the count of actual positives of every distinct value of the predictor, descending
+    :param negatives: the count of actual negatives of every distinct value of the predictor, descending
+    :param replicates: the count of replicates of the block
+    :param seed: the seed of the block
+    :param weights: the kind of resample weights
+    :return: the areas under ROC curve and the F1-max of the replicates (NaN if undefined)
+    """
+    _tp, _fp = _resampled_counts(np.random.default_rng(seed), positives, negatives, replicates, weights)
+    _tp_cumulative = np.cumsum(_tp, axis=0)
+    _fp_cumulative = np.cumsum(_fp, axis=0)
+    _p = _tp_cumulative[-1]
+    _n = _fp_cumulative[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # every negative is ranked above the positives with greater value and tied with a half of the equal ones
+        _auc = np.where(_p * _n > 0, np.sum(_fp * (_tp_cumulative - _tp / 2), axis=0) / (_p * _n), np.nan)
+        # the thresholds between distinct values, F1 = 2 tp / (2 tp + fp + fn)
+        _f1 = 2 * _tp_cumulative / (_tp_cumulative + _fp_cumulative + _p)
+    _f1_max = np.where(_p > 0, np.max(np.nan_to_num(_f1, nan=0.0), axis=0), np.nan)
+    return _auc, _f1_max
+
+
+class PerformanceBootstrap:
+    """
+    Bootstrap of the performance of predictors evaluated by PaymentStoriesPerformanceEvaluator (on the same stories)
+    """
+
+    def __init__(self, evaluator: PaymentStoriesPerformanceEvaluator, replicates: int = 1000,
+                 confidence: float = 0.95, seed: Optional[int] = None, weights: str = WEIGHTS_POISSON,
+                 workers: Optional[int] = None):
+        """
+        :param evaluator: the evaluator of the source
+        :param replicates: the count of bootstrap replicates
+        :param confidence: the confidence level of the (percentile) intervals
+        :param seed: the seed, for reproducible intervals
+        :param weights: the resample weights, Poisson (default) or multinomial
+        :param workers: if provided, the blocks of replicates are computed in given count of processes
+        """
+        self._evaluator = evaluator
+        self._replicates = replicates
+        self._confidence = confidence
+        self._seed = seed
+        self._weights = weights
+        self._workers = workers
+
+    def replicates(self, predictor_col: str, actual_col: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :return: the areas under ROC curve and the F1-max of all replicates (NaN if undefined for the replicate)
+        """
+        _values, _positives, _negatives = self._evaluator.value_counts(predictor_col, actual_col)
+        if len(_values) == 0:
+            return np.full(self._replicates, np.nan), np.full(self._replicates, np.nan)
+
+        _block = max(1, min(self._replicates, BLOCK_ELEMENTS // len(_values)))
+        _sizes = [min(_block, self._replicates - _i) for _i in range(0, self._replicates, _block)]
+        _seeds = np.random.SeedSequence(self._seed).spawn(len(_sizes))
+        _args = [[_positives] * len(_sizes), [_negatives] * len(_sizes), _sizes, _seeds,
+                 [self._weights] * len(_sizes)]
+        if self._workers is not None and self._workers > 1 and len(_sizes) > 1:
+            with ProcessPoolExecutor(max_workers=min(self._workers, len(_sizes))) as _executor:
+                _results = list(_executor.map(_bootstrap_block, *_args))
+        else:
+            _results = list(map(_bootstrap_block, *_args))
+        return np.concatenate([_r[0] for _r in _results]), np.concatenate([_r[1] for _r in _results])
+
+    def _interval(self, values: np.ndarray) -> Interval:
+        if np.all(np.isnan(values)):
+            return None, None
+        _low, _high = np.nanpercentile(values, [50 * (1 - self._confidence), 50 * (1 + self._confidence)])
+        return float(_low), float(_high)
+
+    def intervals(self, predictor_col: str, actual_col: str) -> tuple[Interval, Interval]:
+        """
+        :return: the (low, high) confidence interval of the area under ROC curve and of F1-max
+        """
+        _auc, _f1_max = self.replicates(predictor_col, actual_col)
+        return self._interval(_auc), self._interval(_f1_max)
+
+    def report(self, predictor_cols: list[Column], actual_cols: list[Column]) -> pd.DataFrame:
+        """
+        :return: single row (indexed by the code-name of the source) with the confidence intervals of ROC AUC
+        and F1-max of every pair, named as in the predictors report
+        """
+        _row = {}
+        for _predictor_col in predictor_cols:
+            for _actual_col in actual_cols:
+                _auc, _f1_max = self.intervals(_predictor_col.name, _actual_col.name)
+                _row.update({
+                    StoriesPerformanceReportColNames.PredictorPerformanceROCAUCLow(_predictor_col, _actual_col):
+                        _auc[0],
+                    StoriesPerformanceReportColNames.PredictorPerformanceROCAUCHigh(_predictor_col, _actual_col):
+                        _auc[1],
+                    StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMaxLow(_predictor_col, _actual_col):
+                        _f1_max[0],
+                    StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMaxHigh(_predictor_col, _actual_col):
+                        _f1_max[1]
+                })
+        return pd.DataFrame({_name: [_value] for _name, _value in _row.items()},
+                            index=[self._evaluator.source_codename])
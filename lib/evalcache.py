@@ -0,0 +1,144 @@
+"""
+Persistent cache of evaluation results of one source: the curves, the optimal thresholds and the confusion
+matrices are written to the cache directory of the source (see evaluation_cache_dir), one parquet file per result.
+A result is identified by the kind of evaluation and its parameters, and it is valid only for the stories file
+it was evaluated from: the fingerprint of the file (size and modification time) is stored with the result, so
+a result of replaced stories is a miss and it is evaluated (and written) again. The evaluator (and the stories)
+are loaded only on a miss.
+"""
+from lib.input_const import *
+from lib.perfeval import PaymentStoriesPerformanceEvaluator
+
+import hashlib
+import json
+import math
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pyarrow as pa
+
+from typing import Callable, Optional
+
+# changes whenever the evaluation changes its results, so the results cached before are not used
+CACHE_VERSION = 2
+
+KEY_METADATA_KEY = b'evaluation_key'
+FINGERPRINT_METADATA_KEY = b'stories_fingerprint'
+
+
+def stories_fingerprint(stories_file: Path) -> str:
+    _stat = stories_file.stat()
+    return f'{_stat.st_size}-{_stat.st_mtime_ns}'
+
+
+class EvaluationCache:
+
+    def __init__(self, input_code: str, codename: str,
+                 evaluator: Optional[PaymentStoriesPerformanceEvaluator] = None):
+        """
+        :param input_code: the input-code of the stories
+        :param codename: the code-name of the source
+        :param evaluator: the evaluator of the stories of the source, if already loaded (otherwise created on a miss)
+        """
+        self.source_codename = codename
+        self._stories_file = payment_stories_file(input_code, codename)
+        self._dir = evaluation_cache_dir(input_code, codename)
+        self._evaluator = evaluator
+        self._fingerprint: Optional[str] = None
+        self.hits = 0
+        self.misses = 0
+
+    def evaluator(self) -> PaymentStoriesPerformanceEvaluator:
+        if self._evaluator is None:
+            self._evaluator = PaymentStoriesPerformanceEvaluator(self._stories_file, self.source_codename)
+        return self._evaluator
+
+    def _cached(self, kind: str, params: dict, compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """
+        :param kind: the kind of evaluation (part of the file name)
+        :param params: the parameters of the evaluation (JSON serializable)
+        :param compute: evaluates the result on a miss
+        :return: the result, read from the cache if valid, otherwise evaluated and written
+        """
+        if self._fingerprint is None:
+            self._fingerprint = stories_fingerprint(self._stories_file)
+        _key = json.dumps({'version': CACHE_VERSION, 'kind': kind, **params}, sort_keys=True)
+        _file = self._dir / f'{kind}_{hashlib.sha1(_key.encode()).hexdigest()[:16]}{EXTENSION_PARQUET}'
+        if _file.exists():
+            _metadata = pq.read_schema(_file).metadata
+            if _metadata.get(KEY_METADATA_KEY) == _key.encode() and \
+                    _metadata.get(FINGERPRINT_METADATA_KEY) == self._fingerprint.encode():
+                self.hits += 1
+                return pq.read_table(_file).to_pandas()
+
+        self.misses += 1
+        _result = compute()
+        _table = pa.Table.from_pandas(_result)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        # written aside and renamed, so an interrupted write does not leave a broken result
+        _written = _file.with_suffix('.tmp')
+        pq.write_table(_table.replace_schema_metadata({
+            **_table.schema.metadata,
+            KEY_METADATA_KEY: _key.encode(),
+            FINGERPRINT_METADATA_KEY: self._fingerprint.encode()
+        }), _written)
+        os.replace(_written, _file)
+        return _result
+
+    def roc_curve(self, predictor_col: str, actual_col: str, steps: int = 100, exact: bool = False) -> pd.DataFrame:
+        """
+        See PaymentStoriesPerformanceEvaluator.roc_curve (over the default range of thresholds)
+        """
+        return self._cached('roc_curve', {'predictor': predictor_col, 'actual': actual_col, 'steps': steps,
+                                          'exact': exact},
+                            lambda: self.evaluator().roc_curve(predictor_col, actual_col, steps=steps, exact=exact))
+
+    def f1_curve(self, predictor_col: str, actual_col: str, steps: int = 100) -> pd.DataFrame:
+        """
+        See PaymentStoriesPerformanceEvaluator.f1_curve (over the default range of thresholds)
+        """
+        return self._cached('f1_curve', {'predictor': predictor_col, 'actual': actual_col, 'steps': steps},
+                            lambda: self.evaluator().f1_curve(predictor_col, actual_col, steps=steps))
+
+    def f1_max(self, predictor_col: str, actual_col: str, exact: bool = True) -> tuple[Optional[float], float]:
+        """
+        See PaymentStoriesPerformanceEvaluator.f1_max (over the default range of thresholds)
+        """
+        def _compute() -> pd.DataFrame:
+            _f1, _threshold = self.evaluator().f1_max(predictor_col, actual_col, exact=exact)
+            return pd.DataFrame({'f1_max': [math.nan if _f1 is None else _f1], 'threshold': [_threshold]})
+
+        _result = self._cached('f1_max', {'predictor': predictor_col, 'actual': actual_col, 'exact': exact},
+                               _compute)
+        _f1 = float(_result['f1_max'].iloc[0])
+        return None if math.isnan(_f1) else _f1, float(_result['threshold'].iloc[0])
+
+    def confusion_matrix(self, predictor_col: str, threshold: float,
+                         actual_col: str) -> tuple[tuple[int, int], tuple[int, int]]:
+        """
+        See PaymentStoriesPerformanceEvaluator.confusion_matrix
+        """
+        def _compute() -> pd.DataFrame:
+            (_tp, _fn), (_fp, _tn) = self.evaluator().confusion_matrix(predictor_col, threshold, actual_col)
+            return pd.DataFrame({'tp': [_tp], 'fn': [_fn], 'fp': [_fp], 'tn': [_tn]})
+
+        _result = self._cached('confusion_matrix', {'predictor': predictor_col, 'actual': actual_col,
+                                                    'threshold': float(threshold)}, _compute)
+        return (int(_result['tp'].iloc[0]), int(_result['fn'].iloc[0])), \
+            (int(_result['fp'].iloc[0]), int(_result['tn'].iloc[0]))
+
+    def true_positive_rate(self, predictor_col: str, threshold: float, actual_col: str) -> float:
+        (_tp, _fn), _ = self.confusion_matrix(predictor_col, threshold, actual_col)
+        return 0 if _tp + _fn == 0 else _tp / (_tp + _fn)
+
+    recall = true_positive_rate
+
+    def precision(self, predictor_col: str, threshold: float, actual_col: str) -> Optional[float]:
+        (_tp, _), (_fp, _) = self.confusion_matrix(predictor_col, threshold, actual_col)
+        return None if _tp + _fp == 0 else _tp / (_tp + _fp)
+
+    def accuracy(self, predictor_col: str, threshold: float, actual_col: str) -> Optional[float]:
+        (_tp, _fn), (_fp, _tn) = self.confusion_matrix(predictor_col, threshold, actual_col)
+        _all = _tp + _fn + _fp + _tn
+        return None if _all == 0 else (_tp + _tn) / _all
@@ -0,0 +1,271 @@
+"""
+Mergeable histograms of a predictor split by the actual value. The bins are log-linear and derived from the bit
+pattern of the (double) value: the sign, the exponent and the leading precision_bits of the mantissa, so the relative
+width of a bin is at most 2^-precision_bits, no range has to be declared up front and every source (and every shard
+of a source) uses the same bins. Histograms of any subset of sources are merged by summing the counts of equal bins,
+and the ROC curve, its area and F1-max follow from the cumulative counts, as in the exact evaluation with the upper
+edges of the bins as thresholds (with 52 bits of precision the bins are the distinct values and the results are exact).
+"""
+from lib.input_const import *
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pyarrow as pa
+
+from typing import Iterable, Optional
+
+MANTISSA_BITS = 52
+DEFAULT_PRECISION_BITS = 10
+PRECISION_METADATA_KEY = b'precision_bits'
+
+_SIGN = np.uint64(1 << 63)
+
+
+def _sortable_keys(values: np.ndarray) -> np.ndarray:
+    """
+    :return: unsigned keys ordered as the (not NaN) values: the sign bit flipped for positive values, all bits
+    flipped for negative ones
+    """
+    # -0.0 is equal to 0.0, so is its key
+    _bits = (np.asarray(values, dtype=np.float64) + 0.0).view(np.uint64)
+    return np.where(_bits & _SIGN, ~_bits, _bits | _SIGN)
+
+
+def _values_of_keys(keys: np.ndarray) -> np.ndarray:
+    return np.where(keys & _SIGN, keys & ~_SIGN, ~keys).view(np.float64)
+
+
+def _checked_precision(precision_bits: int) -> int:
+    if not 0 <= precision_bits <= MANTISSA_BITS:
+        raise ValueError(f'The precision of bins must be between 0 and {MANTISSA_BITS} bits: {precision_bits}')
+    return precision_bits
+
+
+class PredictorHistogram:
+    """
+    The count of actual positives and negatives per non-empty bin of the predictor
+    """
+
+    def __init__(self, bins: np.ndarray, positives: np.ndarray, negatives: np.ndarray,
+                 precision_bits: int = DEFAULT_PRECISION_BITS):
+        """
+        :param bins: the non-empty bins, ascending (see of)
+        :param positives: the count of actual positives of every bin
+        :param negatives: the count of actual negatives of every bin
+        :param precision_bits: the count of leading bits of the mantissa distinguished by the bins (0 - 52)
+        """
+        self._bins = np.asarray(bins, dtype=np.uint64)
+        self._positives = np.asarray(positives, dtype=np.int64)
+        self._negatives = np.asarray(negatives, dtype=np.int64)
+        self.precision_bits = _checked_precision(precision_bits)
+
+    @staticmethod
+    def of_bins(bins: np.ndarray, positives: np.ndarray, negatives: np.ndarray,
+                precision_bits: int = DEFAULT_PRECISION_BITS) -> 'PredictorHistogram':
+        """
+        The counts summed up per distinct bin (e.g. the rows of predictor-histograms file, see pooled_histograms)
+        :param bins: the bins (as in bins), they do not have to be ordered nor distinct
+        :param positives: the count of actual positives of every bin
+        :param negatives: the count of actual negatives of every bin
+        :param precision_bits: the count of leading bits of the mantissa distinguished by the bins (0 - 52)
+        """
+        _bins, _inverse = np.unique(bins, return_inverse=True)
+        return PredictorHistogram(
+            _bins,
+            np.bincount(_inverse, weights=positives, minlength=len(_bins)).astype(np.int64),
+            np.bincount(_inverse, weights=negatives, minlength=len(_bins)).astype(np.int64),
+            precision_bits
+        )
+
+    @staticmethod
+    def of(values: np.ndarray, actual: np.ndarray,
+           precision_bits: int = DEFAULT_PRECISION_BITS) -> 'PredictorHistogram':
+        """
+        :param values: the values of the predictor (NaN not allowed)
+        :param actual: the actual values, True for positive
+        :param precision_bits: the count of leading bits of the mantissa distinguished by the bins (0 - 52)
+        """
+        _actual = np.asarray(actual, dtype=bool)
+        _shift = np.uint64(MANTISSA_BITS - _checked_precision(precision_bits))
+        return PredictorHistogram.of_bins(_sortable_keys(values) >> _shift,
+                                          _actual, ~_actual, precision_bits)
+
+    def coarsened(self, precision_bits: int) -> 'PredictorHistogram':
+        """
+        :return: the histogram with bins of lower precision (each coarse bin sums up the bins it covers)
+        """
+        if precision_bits > self.precision_bits:
+            raise ValueError(f'The histogram of {self.precision_bits} bits precision can not be refined '
+                             f'to {precision_bits} bits')
+        if precision_bits == self.precision_bits:
+            return self
+        return PredictorHistogram.of_bins(self._bins >> np.uint64(self.precision_bits - precision_bits),
+                                          self._positives, self._negatives, precision_bits)
+
+    @staticmethod
+    def merged(histograms: Iterable['PredictorHistogram']) -> 'PredictorHistogram':
+        """
+        The histogram of all stories of the histograms (e.g. of several sources or of the shards of a source),
+        the histograms of different precision are coarsened to the lowest one
+        """
+        _histograms = list(histograms)
+        if len(_histograms) == 0:
+            return PredictorHistogram(np.array([], dtype=np.uint64), np.array([], dtype=np.int64),
+                                      np.array([], dtype=np.int64))
+        _precision_bits = min(_h.precision_bits for _h in _histograms)
+        _histograms = [_h.coarsened(_precision_bits) for _h in _histograms]
+        return PredictorHistogram.of_bins(np.concatenate([_h._bins for _h in _histograms]),
+                                          np.concatenate([_h._positives for _h in _histograms]),
+                                          np.concatenate([_h._negatives for _h in _histograms]),
+                                          _precision_bits)
+
+    def __add__(self, other: 'PredictorHistogram') -> 'PredictorHistogram':
+        return PredictorHistogram.merged([self, other])
+
+    def __len__(self):
+        return len(self._bins)
+
+    def bins(self) -> np.ndarray:
+        return self._bins
+
+    def positives(self) -> np.ndarray:
+        return self._positives
+
+    def negatives(self) -> np.ndarray:
+        return self._negatives
+
+    def positive_count(self) -> int:
+        return int(self._positives.sum())
+
+    def negative_count(self) -> int:
+        return int(self._negatives.sum())
+
+    def upper_edges(self) -> np.ndarray:
+        """
+        :return: the greatest value of every bin (the greatest finite value, or infinity, for the last bin)
+        """
+        _shift = np.uint64(MANTISSA_BITS - self.precision_bits)
+        _edges = _values_of_keys((self._bins << _shift) | ((np.uint64(1) << _shift) - np.uint64(1)))
+        # the bin of the greatest exponent covers the infinity followed by NaNs
+        return np.where(np.isnan(_edges), np.inf, _edges)
+
+    def thresholds(self) -> np.ndarray:
+        """
+        :return: -inf (all stories predicted as positive) followed by the upper edges of the bins, ascending,
+        a story is predicted as positive if its predictor is greater than the threshold
+        """
+        return np.concatenate([[-np.inf], self.upper_edges()])
+
+    def confusion_matrices(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: the true positives, false negatives, false positives and true negatives for every threshold
+        (see thresholds)
+        """
+        # the counts of the bins above the threshold
+        _tp = np.concatenate([np.cumsum(self._positives[::-1])[::-1], [0]])
+        _fp = np.concatenate([np.cumsum(self._negatives[::-1])[::-1], [0]])
+        return _tp, self.positive_count() - _tp, _fp, self.negative_count() - _fp
+
+    def roc_curve(self) -> pd.DataFrame:
+        """
+        :return: the ROC curve indexed by the thresholds, as PaymentStoriesPerformanceEvaluator.roc_curve
+        """
+        _tp, _fn, _fp, _tn = self.confusion_matrices()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _tpr = np.where(_tp + _fn > 0, _tp / (_tp + _fn), 0.0)
+            _fpr = np.where(_fp + _tn > 0, _fp / (_fp + _tn), 0.0)
+        return pd.DataFrame({"False Positive Rate": _fpr, "True Positive Rate": _tpr}, index=self.thresholds())
+
+    def roc_auc(self) -> float:
+        """
+        :return: the area under ROC curve, the stories of the same bin are tied (0 if there are no positives
+        or no negatives, as in the evaluator)
+        """
+        _p = self.positive_count()
+        _n = self.negative_count()
+        if _p * _n == 0:
+            return 0.0
+        # every negative is ranked above the positives of the bins above and tied with a half of its bin
+        _above = np.concatenate([np.cumsum(self._positives[::-1])[::-1][1:], [0]])
+        return float(np.sum(self._negatives * (_above + self._positives / 2)) / _p / _n)
+
+    def f1_curve(self) -> pd.DataFrame:
+        """
+        :return: the F1 scores indexed by the thresholds, NaN where undefined
+        """
+        _tp, _fn, _fp, _tn = self.confusion_matrices()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _f1 = np.where(_tp > 0, 2 * _tp / (2 * _tp + _fp + _fn), np.nan)
+        return pd.DataFrame({"F1 Score": _f1}, index=self.thresholds())
+
+    def f1_max(self) -> tuple[Optional[float], float]:
+        """
+        :return: the maximal F1 score (None if undefined) and the first threshold reaching it (see thresholds)
+        """
+        _f1 = self.f1_curve()
+        _scores = _f1[_f1.columns[0]].values
+        if np.all(np.isnan(_scores)):
+            return None, float(_f1.index[0])
+        _i = int(np.nanargmax(_scores))
+        return float(_scores[_i]), float(_f1.index[_i])
+
+
+def histograms_table(codename: str, histograms: dict[tuple[str, str], PredictorHistogram]) -> pa.Table:
+    """
+    :param codename: the code-name of the source
+    :param histograms: the histograms by (predictor, actual) column names
+    :return: the rows of predictor-histograms file (see PredictorHistogramColumns)
+    """
+    _keys = list(histograms.keys())
+    _lengths = [len(histograms[_key]) for _key in _keys]
+    return pa.table({
+        PredictorHistogramColumns.Source.name: pa.array([codename] * sum(_lengths),
+                                                        PredictorHistogramColumns.Source.otype),
+        PredictorHistogramColumns.Predictor.name: pa.array(np.repeat([_key[0] for _key in _keys], _lengths).tolist(),
+                                                           PredictorHistogramColumns.Predictor.otype),
+        PredictorHistogramColumns.Actual.name: pa.array(np.repeat([_key[1] for _key in _keys], _lengths).tolist(),
+                                                        PredictorHistogramColumns.Actual.otype),
+        PredictorHistogramColumns.Bin.name: pa.array(
+            np.concatenate([histograms[_key].bins() for _key in _keys] + [np.array([], dtype=np.uint64)]),
+            PredictorHistogramColumns.Bin.otype),
+        PredictorHistogramColumns.Positives.name: pa.array(
+            np.concatenate([histograms[_key].positives() for _key in _keys] + [np.array([], dtype=np.int64)]),
+            PredictorHistogramColumns.Positives.otype),
+        PredictorHistogramColumns.Negatives.name: pa.array(
+            np.concatenate([histograms[_key].negatives() for _key in _keys] + [np.array([], dtype=np.int64)]),
+            PredictorHistogramColumns.Negatives.otype)
+    }, schema=storage_schema(PredictorHistogramColumns.Stored))
+
+
+def write_histograms(tables: list[pa.Table], file: Path, precision_bits: int = DEFAULT_PRECISION_BITS) -> Path:
+    """
+    Writes the histograms of sources (see histograms_table), all of the same precision
+    """
+    _table = pa.concat_tables(tables) if len(tables) > 0 \
+        else storage_schema(PredictorHistogramColumns.Stored).empty_table()
+    pq.write_table(_table.replace_schema_metadata({PRECISION_METADATA_KEY: str(precision_bits).encode()}), file)
+    return file
+
+
+def pooled_histograms(file: Path, sources: list[str] = None) -> dict[tuple[str, str], PredictorHistogram]:
+    """
+    The histograms pooled over the sources, the story files are not read
+    :param file: the file with predictor-histograms (see write_histograms)
+    :param sources: the code-names of the sources to be pooled, if not provided all sources of the file
+    :return: the pooled histograms by (predictor, actual) column names
+    """
+    _table = pq.read_table(file)
+    _precision_bits = int(_table.schema.metadata[PRECISION_METADATA_KEY])
+    _df = _table.replace_schema_metadata(None).to_pandas()
+    if sources is not None:
+        _df = _df[_df[PredictorHistogramColumns.Source.name].isin(sources)]
+    return {
+        (_predictor, _actual): PredictorHistogram.of_bins(
+            _group[PredictorHistogramColumns.Bin.name].values.astype(np.uint64),
+            _group[PredictorHistogramColumns.Positives.name].values,
+            _group[PredictorHistogramColumns.Negatives.name].values,
+            _precision_bits)
+        for (_predictor, _actual), _group in _df.groupby(
+            [PredictorHistogramColumns.Predictor.name, PredictorHistogramColumns.Actual.name], sort=False)
+    }
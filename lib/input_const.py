@@ -16,10 +16,17 @@ DIR_TEX_TAB = Path('../00_the_thesis/tab')
 PREFIX_PAY_DELAY = 'pay_delay'
 PREFIX_PAYMENTS_WITH_DEBTS = 'pay_delay_w_debts'
 PREFIX_PAYMENTS_GROUPED = 'payments_grouped'
+PREFIX_PAYMENTS_DERIVED = 'payments_derived'
 PREFIX_PAYMENT_STORIES = 'payment_stories'
+PREFIX_STORY_STATE = 'story_state'
+PREFIX_SCORING_STORIES = 'scoring_stories'
+PREFIX_SCORING_PAYMENTS = 'scoring_payments'
+PREFIX_PAYMENTS_INDEX = 'payments_index'
+PREFIX_EVALUATION_CACHE = 'evaluation_cache'
 PREFIX_DEBTS = 'debts'
 
 EXTENSION_PARQUET = '.parquet'
+EXTENSION_ARROW = '.arrow'
 
 MALE = "MALE"
 FEMALE = "FEMALE"
@@ -33,6 +40,14 @@ DENOTES_RISK_MAX_TIME_WINDOW_DAYS = 2*365
 Column = namedtuple('Column', ['name', 'otype'])
 
 
+def storage_schema(columns: list[Column]) -> pa.Schema:
+    """
+    :param columns: the columns as stored in the file
+    :return: the schema of the file, with declared types
+    """
+    return pa.schema([pa.field(_c.name, _c.otype) for _c in columns])
+
+
 class DebtColumns:
 
     LiabilityOwner = Column('liability_owner', pa.uint32())
@@ -242,10 +257,18 @@ def PaymentsGroupedDirectory(_dir: Path):
     return PerSourceDirectory(PREFIX_PAYMENTS_GROUPED, _dir)
 
 
+def PaymentsDerivedDirectory(_dir: Path):
+    return PerSourceDirectory(PREFIX_PAYMENTS_DERIVED, _dir)
+
+
 def PaymentStoriesDirectory(_dir: Path):
     return PerSourceDirectory(PREFIX_PAYMENT_STORIES, _dir)
 
 
+def StoryStateDirectory(_dir: Path):
+    return PerSourceDirectory(PREFIX_STORY_STATE, _dir)
+
+
 def report_overview_file(input_code: str) -> Path:
     """
     Provides path to file with stored DataFrame containing overview report on the sources
@@ -259,6 +282,24 @@ def report_predictors(input_code: str) -> Path:
     return DIR_ANALYSIS / f"predictors_{input_code}.csv"
 
 
+def report_predictor_histograms(input_code: str) -> Path:
+    """
+    Provides path to file with the histograms of predictors split by actual values, for every source
+    (see PredictorHistogram), from which the performance of predictors pooled over any sources is evaluated
+    :param input_code: the input-code of interest
+    :return: the path to a parquet file
+    """
+    return DIR_ANALYSIS / f"predictor_histograms_{input_code}.parquet"
+
+
+def report_predictors_pooled(input_code: str) -> Path:
+    return DIR_ANALYSIS / f"predictors_pooled_{input_code}.csv"
+
+
+def report_predictors_grouped(input_code: str, group_col: str) -> Path:
+    return DIR_ANALYSIS / f"predictors_by_{group_col}_{input_code}.csv"
+
+
 def tex_figure_file(chart_name: str) -> Path:
     return DIR_TEX_FIG / f"{chart_name}.pgf"
 
@@ -278,6 +319,28 @@ def payments_grouped_by_stories_file(input_code: str, source_codename: str) -> P
     return DIR_PROCESSING / f'{PREFIX_PAYMENTS_GROUPED}_{source_codename}_{input_code}{EXTENSION_PARQUET}'
 
 
+def payments_derived_file(input_code: str, source_codename: str) -> Path:
+    """
+    Returns path to the sidecar of the file with payments grouped by stories: the columns derived from the grouped
+    payments (scaled delay and amount, severity, story timeline), row-aligned with the grouped payments file
+    :param input_code: the input-code
+    :param source_codename: the source identifier
+    :return: path to a parquet file
+    """
+    return DIR_PROCESSING / f'{PREFIX_PAYMENTS_DERIVED}_{source_codename}_{input_code}{EXTENSION_PARQUET}'
+
+
+def payments_index_file(input_code: str, source_codename: str) -> Path:
+    """
+    Returns path to the offset index of the file with payments grouped by stories: the first row of every story
+    and the first rows of the row-groups of the grouped payments and of the sidecar (see PaymentsIndex)
+    :param input_code: the input-code
+    :param source_codename: the source identifier
+    :return: path to a parquet file
+    """
+    return DIR_PROCESSING / f'{PREFIX_PAYMENTS_INDEX}_{source_codename}_{input_code}{EXTENSION_PARQUET}'
+
+
 def payment_stories_file(input_code: str, source_codename: str) -> Path:
     """
     Returns path to file containing "payment stories", payments grouped by entity and ordered in time-lines
@@ -288,6 +351,50 @@ def payment_stories_file(input_code: str, source_codename: str) -> Path:
     return DIR_PROCESSING / f'{PREFIX_PAYMENT_STORIES}_{source_codename}_{input_code}{EXTENSION_PARQUET}'
 
 
+def evaluation_cache_dir(input_code: str, source_codename: str) -> Path:
+    """
+    Returns path to the directory with the persisted evaluation results (curves, optimal thresholds, confusion
+    matrices) of the payment stories of the source (see EvaluationCache)
+    :param input_code: the input-code
+    :param source_codename: the identification of source
+    :return: directory path
+    """
+    return DIR_PROCESSING / f'{PREFIX_EVALUATION_CACHE}_{source_codename}_{input_code}'
+
+
+def story_state_file(input_code: str, source_codename: str) -> Path:
+    """
+    Returns path to file containing the state of the last (open) story of every entity,
+    from which the stories are updated incrementally with new payments (see IncrementalStories)
+    :param input_code: the input-code of the last payments the state was updated with
+    :param source_codename: the identification of source
+    :return: file path
+    """
+    return DIR_PROCESSING / f'{PREFIX_STORY_STATE}_{source_codename}_{input_code}{EXTENSION_PARQUET}'
+
+
+def scoring_stories_file(input_code: str, source_codename: str) -> Path:
+    """
+    Returns path to the Arrow IPC copy of payment stories, ordered by entity and story-id, memory-mapped by the scoring
+    service (see RiskScoringService)
+    :param input_code: the input-code
+    :param source_codename: the identification of source
+    :return: file path
+    """
+    return DIR_PROCESSING / f'{PREFIX_SCORING_STORIES}_{source_codename}_{input_code}{EXTENSION_ARROW}'
+
+
+def scoring_payments_file(input_code: str, source_codename: str) -> Path:
+    """
+    Returns path to the Arrow IPC copy of payments grouped by stories (with derived columns), ordered by story-id,
+    memory-mapped by the scoring service (see RiskScoringService)
+    :param input_code: the input-code
+    :param source_codename: the identification of source
+    :return: file path
+    """
+    return DIR_PROCESSING / f'{PREFIX_SCORING_PAYMENTS}_{source_codename}_{input_code}{EXTENSION_ARROW}'
+
+
 class PaymentGroupsColumns:
 
     Id = PayDelayColumns.Id
@@ -300,10 +407,15 @@ class PaymentGroupsColumns:
     DividingCreditStatus = Column("dividing_credit_status", PayDelayColumns.LaterDebtsMaxCreditStatus.otype)
     DividingDaysToDebt = Column("dividing_days_to_debt", PayDelayColumns.LaterDebtsMinDaysToValidFrom(1).otype)
 
-    InvoicedAmountScaled = Column(InvoicedAmount.name + '_scaled', pa.float64())
-    DelayDaysScaled = Column(DelayDays.name + '_scaled', pa.float64())
+    InvoicedAmountScaled = Column(InvoicedAmount.name + '_scaled', pa.float32())
+    DelayDaysScaled = Column(DelayDays.name + '_scaled', pa.float32())
     StoryTimeline = Column('days_since_story_begins', pa.uint16())
-    Severity = Column('severity', pa.float64())
+    Severity = Column('severity', pa.float32())
+
+    # the columns stored in grouped-payments file and in its sidecar (see payments_derived_file), in stored order
+    Grouped = [Id, EntityId, DueDate, DelayDays, InvoicedAmount, PriorCreditStatusMax, StoryId, DividingCreditStatus,
+               DividingDaysToDebt]
+    Derived = [DelayDaysScaled, InvoicedAmountScaled, Severity, StoryTimeline]
 
 
 class OverviewReportColNames:
@@ -350,21 +462,108 @@ class PaymentStoriesColumns:
     ScaledDelayMean = Column(PayDelayColumns.DelayDays.name+'_scaled_mean', pa.float32())
     ScaledAmountMean = Column(PayDelayColumns.InvoicedAmount.name+'_scaled_mean', pa.float32())
     SeverityMean = Column('severity_mean', ScaledDelayMean.otype)
-    DaysSinceBeginMean = Column('days_since_begin_mean', None)
+    DaysSinceBeginMean = Column('days_since_begin_mean', pa.float32())
     Tendency_ForDelay = Column(PayDelayColumns.DelayDays.name+'_tendency', ScaledDelayMean.otype)
     TendencyMinusMean_ForDelay = Column(PayDelayColumns.DelayDays.name+'_tendency_minus_mean', ScaledDelayMean.otype)
-    TendencyCoefficient_ForDelay = Column('regression_line_a1_for_delay', pa.float64())
-    TendencyConstant_ForDelay = Column('regression_line_a0_for_delay', pa.float64())
-    TendencyError_ForDelay = Column('regression_line_rsquare_for_delay', pa.float64())
+    TendencyCoefficient_ForDelay = Column('regression_line_a1_for_delay', pa.float32())
+    TendencyConstant_ForDelay = Column('regression_line_a0_for_delay', pa.float32())
+    TendencyError_ForDelay = Column('regression_line_rsquare_for_delay', pa.float32())
     Tendency_ForSeverity = Column('severity_tendency', SeverityMean.otype)
     TendencyMinusMean_ForSeverity = Column('severity_tendency_minus_mean', ScaledDelayMean.otype)
-    TendencyCoefficient_ForSeverity = Column('regression_line_a1_for_severity', pa.float64())
-    TendencyConstant_ForSeverity = Column('regression_line_a0_for_severity', pa.float64())
-    TendencyError_ForSeverity = Column('regression_line_rsquare_for_severity', pa.float64())
+    TendencyCoefficient_ForSeverity = Column('regression_line_a1_for_severity', pa.float32())
+    TendencyConstant_ForSeverity = Column('regression_line_a0_for_severity', pa.float32())
+    TendencyError_ForSeverity = Column('regression_line_rsquare_for_severity', pa.float32())
 
     DenotesAnyRisk = Column('denotes_any_risk', pa.bool_())
     DenotesSignificantRisk = Column('denotes_significant_risk', pa.bool_())
 
+    # the columns stored in payment-stories file, in stored order
+    Stored = [StoryId, FirstPaymentId, EntityId, BeginsWithCreditStatus, EndsWithCreditStatus,
+              LaterDebtMinDaysToValidFrom, BeginsAt, EndsAt, Duration, PaymentsCount, ScaledDelayMean,
+              ScaledAmountMean, SeverityMean, DaysSinceBeginMean, DenotesAnyRisk, DenotesSignificantRisk,
+              TendencyCoefficient_ForDelay, TendencyCoefficient_ForSeverity, TendencyConstant_ForDelay,
+              TendencyConstant_ForSeverity, Tendency_ForDelay, Tendency_ForSeverity, TendencyMinusMean_ForDelay,
+              TendencyMinusMean_ForSeverity, TendencyError_ForDelay, TendencyError_ForSeverity]
+
+
+class StoryStateColumns:
+    """
+    The running statistics of a story (or of its part), from which the story is finalized and which can be merged
+    with the statistics of new payments; the moments of due dates are in days since epoch
+    """
+
+    StoryId = PaymentStoriesColumns.StoryId
+    FirstPaymentId = PaymentStoriesColumns.FirstPaymentId
+    EntityId = PaymentStoriesColumns.EntityId
+    BeginsWithCreditStatus = PaymentStoriesColumns.BeginsWithCreditStatus
+    BeginsAt = PaymentStoriesColumns.BeginsAt
+    EndsAt = PaymentStoriesColumns.EndsAt
+    PaidAtMax = Column('paid_at_max', PayDelayColumns.DueDate.otype)
+    PaymentsCount = Column(PaymentStoriesColumns.PaymentsCount.name, pa.uint32())
+    ScaledDelayMean = Column(PaymentStoriesColumns.ScaledDelayMean.name, pa.float64())
+    ScaledAmountMean = Column(PaymentStoriesColumns.ScaledAmountMean.name, pa.float64())
+    SeverityMean = Column(PaymentStoriesColumns.SeverityMean.name, pa.float64())
+    DueDateMean = Column(PayDelayColumns.DueDate.name + '_mean', pa.float64())
+    # the sums of squared deviations from the mean and of products of deviations of due date and y
+    DueDateSquares = Column(PayDelayColumns.DueDate.name + '_squares', pa.float64())
+    ScaledDelaySquares = Column(PayDelayColumns.DelayDays.name + '_scaled_squares', pa.float64())
+    SeveritySquares = Column('severity_squares', pa.float64())
+    ScaledDelayProducts = Column(PayDelayColumns.DelayDays.name + '_scaled_products', pa.float64())
+    SeverityProducts = Column('severity_products', pa.float64())
+    ScaledDelayMin = Column(PayDelayColumns.DelayDays.name + '_scaled_min', pa.float64())
+    ScaledDelayMax = Column(PayDelayColumns.DelayDays.name + '_scaled_max', pa.float64())
+    SeverityMin = Column('severity_min', pa.float64())
+    SeverityMax = Column('severity_max', pa.float64())
+
+    Statistics = [StoryId, FirstPaymentId, EntityId, BeginsWithCreditStatus, BeginsAt, EndsAt, PaidAtMax,
+                  PaymentsCount, ScaledDelayMean, ScaledAmountMean, SeverityMean, DueDateMean, DueDateSquares,
+                  ScaledDelaySquares, SeveritySquares, ScaledDelayProducts, SeverityProducts, ScaledDelayMin,
+                  ScaledDelayMax, SeverityMin, SeverityMax]
+
+    # the last payment of the entity (its pd-id is the story-id): due date and the days to later debts,
+    # they decide whether the next payment continues the story
+    LastDueDate = Column(PayDelayColumns.DueDate.name + '_of_last_payment', PayDelayColumns.DueDate.otype)
+    # the last payment is followed by an outlier: the story is ended (as by the gap in pd-ids in the batch)
+    FollowedByOutlier = Column('followed_by_outlier', pa.bool_())
+
+    @staticmethod
+    def LastLaterDebtsMinDaysToValidFrom(cs: int) -> Column:
+        return PayDelayColumns.LaterDebtsMinDaysToValidFrom(cs)
+
+    # the columns stored in story-state file, in stored order
+    Stored = Statistics + [LastDueDate, FollowedByOutlier] + [
+        PayDelayColumns.LaterDebtsMinDaysToValidFrom(_cs) for _cs in range(1, 5)
+    ]
+
+
+class PaymentsIndexColumns:
+    """
+    The offset index of grouped payments, one row per story in the order of the payments (by story-id)
+    """
+
+    StoryId = PaymentGroupsColumns.StoryId
+    EntityId = PaymentGroupsColumns.EntityId
+    FirstRow = Column('first_row', pa.uint64())
+
+    # the columns stored in payments-index file, in stored order
+    Stored = [StoryId, EntityId, FirstRow]
+
+
+class PredictorHistogramColumns:
+    """
+    The histograms of predictors split by actual values, one row per non-empty bin (see PredictorHistogram)
+    """
+
+    Source = Column('source', pa.string())
+    Predictor = Column('predictor', pa.string())
+    Actual = Column('actual', pa.string())
+    Bin = Column('bin', pa.uint64())
+    Positives = Column('positives', pa.uint64())
+    Negatives = Column('negatives', pa.uint64())
+
+    # the columns stored in predictor-histograms file, in stored order
+    Stored = [Source, Predictor, Actual, Bin, Positives, Negatives]
+
 
 class StoriesPerformanceReportColNames:
 
@@ -407,3 +606,25 @@ class StoriesPerformanceReportColNames:
     @staticmethod
     def PredictorPerformanceROCAUC(predictor_column: Column, measurement_column: Column):
         return f"{predictor_column.name.replace('_', '-')}-{measurement_column.name.replace('_', '-')}-ROC-AUC"
+
+    @staticmethod
+    def PredictorPerformancePRAUC(predictor_column: Column, measurement_column: Column):
+        return f"{predictor_column.name.replace('_', '-')}-{measurement_column.name.replace('_', '-')}-PR-AUC"
+
+    # the bootstrap confidence intervals (see PerformanceBootstrap)
+
+    @staticmethod
+    def PredictorPerformanceROCAUCLow(predictor_column: Column, measurement_column: Column):
+        return f"{predictor_column.name.replace('_', '-')}-{measurement_column.name.replace('_', '-')}-ROC-AUC-ci-low"
+
+    @staticmethod
+    def PredictorPerformanceROCAUCHigh(predictor_column: Column, measurement_column: Column):
+        return f"{predictor_column.name.replace('_', '-')}-{measurement_column.name.replace('_', '-')}-ROC-AUC-ci-high"
+
+    @staticmethod
+    def PredictorPerformanceF1ScoreMaxLow(predictor_column: Column, measurement_column: Column):
+        return f"{predictor_column.name.replace('_', '-')}-{measurement_column.name.replace('_', '-')}-F1-max-ci-low"
+
+    @staticmethod
+    def PredictorPerformanceF1ScoreMaxHigh(predictor_column: Column, measurement_column: Column):
+        return f"{predictor_column.name.replace('_', '-')}-{measurement_column.name.replace('_', '-')}-F1-max-ci-high"
@@ -1,11 +1,40 @@
 from lib.input_const import *
-from lib.subarrow import ArrowAggregate
+from lib.segments import Segments, segments_if_sorted
+from lib.storyindex import PaymentsIndex
+from lib.subarrow import ArrowAggregate, SpillingAggregate, SPILL_WHEN_LARGER_THAN_BYTES, \
+    shutdown as shutdown_aggregation_workers
+from lib.util import ColumnGraph, compact, declared_sorting, is_sorted, sort_if_needed, sorting_columns
 
 import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import pyarrow as pa
 
-from typing import Optional
+import json
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, Optional
+
+
+EntityRange = tuple[Optional[int], Optional[int]]
+
+
+def _entity_range_filter(entity_range: Optional[EntityRange]) -> Optional[pc.Expression]:
+    """
+    Prepares the filter selecting the entities from given range
+    :param entity_range: the pair (min entity-id inclusive, max entity-id exclusive), None stands for no limit
+    :return: the filter expression or None if there is no limit at all
+    """
+    if entity_range is None:
+        return None
+    _filter = None
+    _from, _to = entity_range
+    if _from is not None:
+        _filter = pc.field(PayDelayColumns.EntityId.name) >= _from
+    if _to is not None:
+        _to_filter = pc.field(PayDelayColumns.EntityId.name) < _to
+        _filter = _to_filter if _filter is None else _filter & _to_filter
+    return _filter
 
 
 class PaymentHistoryGrouper:
@@ -22,37 +51,55 @@ class PaymentHistoryGrouper:
     NEXT = '_next'
     COL_STORY_ID = PaymentGroupsColumns.StoryId.name
 
-    def __init__(self, source_file: Path, codename: str):
+    COLUMNS = [
+        PayDelayColumns.Id.name,
+        PayDelayColumns.EntityId.name,
+        PayDelayColumns.DueDate.name,
+        PayDelayColumns.DelayDays.name,
+        PayDelayColumns.InvoicedAmount.name,
+        PayDelayColumns.PriorDebtsMaxCreditStatus.name,
+        PayDelayColumns.LaterDebtsMinDaysToValidFrom(1).name,
+        PayDelayColumns.LaterDebtsMinDaysToValidFrom(2).name,
+        PayDelayColumns.LaterDebtsMinDaysToValidFrom(3).name,
+        PayDelayColumns.LaterDebtsMinDaysToValidFrom(4).name
+    ]
+
+    STREAMING_BATCH_SIZE = 1000000
+
+    def __init__(self, source_file: Optional[Path], codename: str, entity_range: EntityRange = None,
+                 content: pa.Table = None):
+        """
+        :param source_file: the per-source file with payment delays and debts (not used if content is provided)
+        :param codename: the code-name of the source
+        :param entity_range: optional (min inclusive, max exclusive) range of entity-ids to process,
+        used to split the source into shards
+        :param content: optional, the payment delays with debts (COLUMNS, outliers excluded) already present in memory
+        """
         self._file = source_file
         self.source_codename = codename
-        self._content: Optional[pa.Table] = None
+        self._entity_range = entity_range
+        self._content: Optional[pa.Table] = None if content is None else content.select(self.COLUMNS)
         self._dividers: Optional[pa.Table] = None
         self._story_ids: Optional[pa.Table] = None
 
     def content(self) -> pa.Table:
         """
         Loads the payment-delay data with debt information from parquet file.
-        Only non-outliers are loaded. The loaded content is sorted by pd-id
-        (sic! interestingly the order of records is not preserved when store - restore from parquet file)
+        Only non-outliers are loaded. The loaded content is sorted by pd-id. The sorting is skipped if the file
+        declares to be sorted by pd-id or if the loaded records turn out to be already ordered
         :return: the reference to pyarrow Table (use it to display number of rows and allocated memory)
         """
         if self._content is None:
-            self._content = pq.read_table(
-                self._file, columns=[
-                    PayDelayColumns.Id.name,
-                    PayDelayColumns.EntityId.name,
-                    PayDelayColumns.DueDate.name,
-                    PayDelayColumns.DelayDays.name,
-                    PayDelayColumns.InvoicedAmount.name,
-                    PayDelayColumns.PriorDebtsMaxCreditStatus.name,
-                    PayDelayColumns.LaterDebtsMinDaysToValidFrom(1).name,
-                    PayDelayColumns.LaterDebtsMinDaysToValidFrom(2).name,
-                    PayDelayColumns.LaterDebtsMinDaysToValidFrom(3).name,
-                    PayDelayColumns.LaterDebtsMinDaysToValidFrom(4).name
-                ],
-                filters=~pc.field(PayDelayColumns.IsOutlier.name)
+            _filter = ~pc.field(PayDelayColumns.IsOutlier.name)
+            _range_filter = _entity_range_filter(self._entity_range)
+            self._content = sort_if_needed(
+                pq.read_table(
+                    self._file, columns=self.COLUMNS,
+                    filters=_filter if _range_filter is None else _filter & _range_filter
+                ),
+                PayDelayColumns.Id.name,
+                declared_sorting(self._file)
             )
-        self._content = self._content.sort_by(PayDelayColumns.Id.name)
         return self._content
 
     def detect_dividers(self) -> pa.Table:
@@ -179,7 +226,7 @@ class PaymentHistoryGrouper:
 
         return self._story_ids
 
-    def combine_and_store(self, input_code: str) -> pa.Table:
+    def combine(self) -> pa.Table:
         # construct the final output
         self._content = self._content.join(
             self._story_ids,
@@ -189,170 +236,483 @@ class PaymentHistoryGrouper:
             keys=self.COL_STORY_ID,
             right_keys=self.COL_DIVIDING_ID
         )
+        # the joins do not preserve the order; restoring it keeps the payments of a story (and of an entity) together
+        self._content = self._content.sort_by(PayDelayColumns.Id.name)
+        return self._content
 
-        pq.write_table(self._content, payments_grouped_by_stories_file(input_code, self.source_codename))
+    def combine_and_store(self, input_code: str) -> pa.Table:
+        self.store(payments_grouped_by_stories_file(input_code, self.source_codename))
         return self._content
 
+    def store(self, file: Path) -> Path:
+        _grouped = compact(self.combine(), storage_schema(PaymentGroupsColumns.Grouped))
+        pq.write_table(_grouped, file, sorting_columns=sorting_columns(_grouped, [PayDelayColumns.Id.name]))
+        return file
+
+    def _entity_aligned_batches(self, batch_size: int):
+        """
+        Reads the source file in record batches and yields tables containing only complete entities.
+        Each batch is cut at the last entity boundary, the trailing (possibly incomplete) entity is carried over
+        to the next batch. This requires the source file to be sorted by entity (which is the case if it is sorted
+        by pd-id), ValueError is raised otherwise.
+        :param batch_size: the number of records read at once
+        :return: generator of tables, each covering a range of complete entities (outliers excluded)
+        """
+        _carry: Optional[pa.Table] = None
+        for _batch in pq.ParquetFile(self._file).iter_batches(
+                batch_size=batch_size, columns=self.COLUMNS + [PayDelayColumns.IsOutlier.name]):
+            _chunk = pa.Table.from_batches([_batch])
+            _chunk = _chunk.filter(~pc.field(PayDelayColumns.IsOutlier.name)).select(self.COLUMNS)
+            if _carry is not None:
+                _chunk = pa.concat_tables([_carry, _chunk])
+            if _chunk.num_rows == 0:
+                continue
+
+            _entities = _chunk.column(PayDelayColumns.EntityId.name)
+            if _chunk.num_rows > 1 and not pc.all(
+                    pc.less_equal(_entities.slice(0, _chunk.num_rows - 1), _entities.slice(1))).as_py():
+                raise ValueError(f'The file {self._file} is not sorted by {PayDelayColumns.EntityId.name}, '
+                                 f'it can not be processed in batches')
+
+            _cut = pc.index(_entities, _entities[_chunk.num_rows - 1]).as_py()
+            _carry = _chunk.slice(_cut)
+            if _cut > 0:
+                yield _chunk.slice(0, _cut)
+
+        if _carry is not None and _carry.num_rows > 0:
+            yield _carry
+
+    def stream_and_store(self, input_code: str, batch_size: int = STREAMING_BATCH_SIZE) -> int:
+        """
+        Streaming alternative to content - detect_dividers - calculate_story_ids - combine_and_store sequence.
+        The source is processed in entity-aligned batches and the results are appended to the output file,
+        so the memory consumption is bounded by batch size (plus the biggest entity), not by the size of the source.
+        Stories never cross the entity boundary, hence the result is the same as for the whole source processed at once.
+        :param input_code: the input-code
+        :param batch_size: the number of records read at once
+        :return: the number of records written
+        """
+        _written = 0
+        _schema = storage_schema(PaymentGroupsColumns.Grouped)
+        # opened up front, so the file (with the storage schema) is written even if the source yields no batches
+        with pq.ParquetWriter(payments_grouped_by_stories_file(input_code, self.source_codename), _schema,
+                              sorting_columns=sorting_columns(_schema.empty_table(),
+                                                              [PayDelayColumns.Id.name])) as _writer:
+            for _chunk in self._entity_aligned_batches(batch_size):
+                _batch_grouper = PaymentHistoryGrouper(self._file, self.source_codename, content=_chunk)
+                _batch_grouper.detect_dividers()
+                _batch_grouper.calculate_story_ids()
+                _grouped = compact(_batch_grouper.combine(), _schema)
+                _writer.write_table(_grouped)
+                _written += _grouped.num_rows
+        return _written
+
+
+ScalingParameters = namedtuple('ScalingParameters', [
+    'delay_mean', 'delay_stddev', 'amount_median', 'amount_quantile_range', 'amount_null_ratio', 'amount_min'
+])
+SCALING_PARAMETERS_METADATA_KEY = b'scaling_parameters'
+
+
+def calculate_scaling_parameters(payments: pa.Table) -> ScalingParameters:
+    """
+    Calculates the per-source parameters used to scale delay and amount (and to calculate severity).
+    :param payments: the table with (at least) delay-days and invoiced-amount of all payments of the source
+    :return: the scaling parameters
+    """
+    _delays = payments.column(PaymentGroupsColumns.DelayDays.name)
+    _amounts = payments.column(PaymentGroupsColumns.InvoicedAmount.name)
+    _amount_median = pc.approximate_median(_amounts).as_py()
+    _Q_1, _Q_3 = pc.quantile(_amounts, [0.25, 0.75]).to_pylist()
+    _nulls = pc.count(_amounts, mode='only_null').as_py()
+    # the minimal amount after missing values are replaced with median (see PaymentStoriesBuilder.scaled_amount)
+    _amount_min = [_v for _v in (pc.min(_amounts).as_py(), _amount_median if _nulls > 0 else None) if _v is not None]
+    return ScalingParameters(
+        delay_mean=pc.mean(_delays).as_py(),
+        delay_stddev=pc.stddev(_delays).as_py(),
+        amount_median=_amount_median,
+        amount_quantile_range=None if _Q_1 is None or _Q_3 is None else _Q_3 - _Q_1,
+        amount_null_ratio=_nulls / payments.num_rows if payments.num_rows > 0 else 0.0,
+        amount_min=min(_amount_min) if len(_amount_min) > 0 else None
+    )
+
+
+def scaling_metadata(scaling: ScalingParameters) -> dict[bytes, bytes]:
+    """
+    :return: the scaling parameters as parquet key-value metadata (see read_scaling_parameters)
+    """
+    return {SCALING_PARAMETERS_METADATA_KEY: json.dumps(scaling._asdict()).encode()}
+
+
+def read_scaling_parameters(file: Path) -> Optional[ScalingParameters]:
+    """
+    Reads the scaling parameters persisted in the metadata of the sidecar of payments grouped by stories
+    :param file: the sidecar file written by PaymentStoriesBuilder (see payments_derived_file)
+    :return: the parameters, None if the file has none
+    """
+    _metadata = pq.read_schema(file).metadata or {}
+    if SCALING_PARAMETERS_METADATA_KEY not in _metadata:
+        return None
+    return ScalingParameters(**json.loads(_metadata[SCALING_PARAMETERS_METADATA_KEY]))
+
+
+def frozen_scaling_parameters(input_code: str, codename: str) -> ScalingParameters:
+    """
+    The scaling parameters of a previous run, used to build stories (or score new payments) comparably
+    with the snapshot, without calculating the statistics of the whole source
+    :param input_code: the input-code of the run whose parameters are to be reused
+    :param codename: the code-name of the source
+    """
+    _file = payments_derived_file(input_code, codename)
+    _scaling = read_scaling_parameters(_file) if _file.exists() else None
+    if _scaling is None:
+        raise ValueError(f'No scaling parameters persisted for source {codename} and input {input_code} ({_file})')
+    return _scaling
+
+
+def denotes_risk(stories: pa.Table, credit_status_above: int) -> pa.ChunkedArray:
+    """
+    The story denotes risk if it is ended by a debt of credit status above the given one, which becomes valid within
+    the time window following the story (the duration of the story, but at least DENOTES_RISK_MIN_TIME_WINDOW_DAYS
+    and at most DENOTES_RISK_MAX_TIME_WINDOW_DAYS)
+    :param stories: the stories with (at least) duration, later-debt-min-days-to-valid-from and ends-with-credit-status
+    :param credit_status_above: 0 for any risk, 2 for significant risk
+    """
+    return pc.fill_null(
+        pc.and_(
+            pc.greater(
+                pc.min_element_wise(
+                    pc.max_element_wise(
+                        stories.column(PaymentStoriesColumns.Duration.name),
+                        pa.scalar(DENOTES_RISK_MIN_TIME_WINDOW_DAYS, PaymentStoriesColumns.Duration.otype)
+                    ),
+                    pa.scalar(DENOTES_RISK_MAX_TIME_WINDOW_DAYS, PaymentStoriesColumns.Duration.otype)
+                ),
+                stories.column(PaymentStoriesColumns.LaterDebtMinDaysToValidFrom.name)
+            ),
+            pc.greater(
+                stories.column(PaymentStoriesColumns.EndsWithCreditStatus.name), credit_status_above
+            )
+        ),
+        False
+    )
+
+
+def regression_slope(sxx, sxy, syy) -> tuple:
+    """
+    The least-squares line from the centered sums of squares and products (or from any common multiple of them,
+    e.g. the population variances and covariance)
+    :return: the slope (a1) and the coefficient of determination (r-squared)
+    """
+    # no slope if all payments of the story are due on the same day
+    _a1 = pc.if_else(pc.equal(sxx, 0.0), float('nan'), pc.divide(sxy, sxx))
+    # residual sum of squares of the least-squares line is Syy - a1 * Sxy
+    return _a1, pc.subtract(1.0, pc.divide(pc.subtract(syy, pc.multiply(_a1, sxy)), syy))
+
+
+def regression_tendency(a1, x_mean, x_max, y_mean) -> tuple:
+    """
+    The tendency is the value of the regression line at the last payment of the story
+    (this will be used as the predictor, not the coefficient!)
+    :return: the constant (a0), the tendency and the tendency minus the mean
+    """
+    _a0 = pc.subtract(y_mean, pc.multiply(a1, x_mean))
+    _tendency = pc.add(pc.multiply(a1, x_max), _a0)
+    return _a0, _tendency, pc.subtract(_tendency, y_mean)
+
+
+# the columns appended to stories by PaymentStoriesBuilder.tendencies
+TENDENCY_COLUMNS = [
+    PaymentStoriesColumns.TendencyCoefficient_ForDelay.name,
+    PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name,
+    PaymentStoriesColumns.TendencyConstant_ForDelay.name,
+    PaymentStoriesColumns.TendencyConstant_ForSeverity.name,
+    PaymentStoriesColumns.Tendency_ForDelay.name,
+    PaymentStoriesColumns.Tendency_ForSeverity.name,
+    PaymentStoriesColumns.TendencyMinusMean_ForDelay.name,
+    PaymentStoriesColumns.TendencyMinusMean_ForSeverity.name,
+    PaymentStoriesColumns.TendencyError_ForDelay.name,
+    PaymentStoriesColumns.TendencyError_ForSeverity.name
+]
+
 
 class PaymentStoriesBuilder:
     """
     """
 
     _USE_SUBARROW_WHEN_LARGER_THAN_RECORDS = 10000
+    _SPILL_WHEN_LARGER_THAN_BYTES = SPILL_WHEN_LARGER_THAN_BYTES
+    STREAMING_BATCH_SIZE = PaymentHistoryGrouper.STREAMING_BATCH_SIZE
+
+    COLUMNS = [
+        PaymentGroupsColumns.Id.name,
+        PaymentGroupsColumns.EntityId.name,
+        PaymentGroupsColumns.DueDate.name,
+        PaymentGroupsColumns.DelayDays.name,
+        PaymentGroupsColumns.InvoicedAmount.name,
+        PaymentGroupsColumns.PriorCreditStatusMax.name,
+        PaymentGroupsColumns.StoryId.name,
+        PaymentGroupsColumns.DividingCreditStatus.name,
+        PaymentGroupsColumns.DividingDaysToDebt.name
+    ]
 
-    def __init__(self, source_file: Path, codename: str):
+    def __init__(self, source_file: Optional[Path], codename: str, entity_range: EntityRange = None,
+                 scaling: ScalingParameters = None, payments: pa.Table = None):
+        """
+        :param source_file: the file with payments grouped by stories (not used if payments are provided)
+        :param codename: the code-name of the source
+        :param entity_range: optional (min inclusive, max exclusive) range of entity-ids to process,
+        used to split the source into shards
+        :param scaling: the scaling parameters; if not provided, they are calculated from loaded payments.
+        Note that if the entity-range is provided, the scaling parameters of the whole source shall be provided as well
+        :param payments: optional, the payments grouped by stories already present in memory
+        (see PaymentHistoryGrouper.combine), if provided the file is not read at all
+        """
         self._file = source_file
         self.source_codename = codename
-        self._payments: Optional[pa.Table] = None
+        self._entity_range = entity_range
+        self._columns = ColumnGraph(
+            self._load_payments if payments is None else lambda: payments.select(self.COLUMNS)
+        )
         self._stories: Optional[pa.Table] = None
-        self._delay_mean = None
-        self._delay_stddev = None
-        self._amount_median = None
-        self._amount_Q_3_1 = None
-
-    def payments(self) -> pa.Table:
-        if self._payments is None:
-            # FIXME consider loading only part of the columns
-            # some columns are calculated by this class and then grouped payments are updated!
-            # on one hand it is cool to have them calculated once, on the other: what if something will change?
-            self._payments = pq.read_table(self._file, columns=[
-                PaymentGroupsColumns.Id.name,
-                PaymentGroupsColumns.EntityId.name,
-                PaymentGroupsColumns.DueDate.name,
-                PaymentGroupsColumns.DelayDays.name,
-                PaymentGroupsColumns.InvoicedAmount.name,
-                PaymentGroupsColumns.PriorCreditStatusMax.name,
-                PaymentGroupsColumns.StoryId.name,
-                PaymentGroupsColumns.DividingCreditStatus.name,
-                PaymentGroupsColumns.DividingDaysToDebt.name
-            ])
+        self._scaling = scaling
+        self._segments: Optional[Segments] = None
+        self._segments_detected = False
+        self._streamed: Optional[bool] = None
+        # the derived columns computed per record batch (see streamed)
+        self._streamed_columns: set[str] = set()
+        self._begins: Optional[pa.Table] = None
+        self._derive_columns(self._columns)
 
-        return self._payments
+    def _load_payments(self) -> pa.Table:
+        return pq.read_table(self._file, columns=self.COLUMNS, filters=_entity_range_filter(self._entity_range))
+
+    def _derive_columns(self, columns: ColumnGraph):
+        columns.derive(
+            PaymentGroupsColumns.DelayDaysScaled.name, [PaymentGroupsColumns.DelayDays.name],
+            lambda delays: pc.divide(pc.subtract(delays, self.delay_mean()), self.delay_stddev())
+        )
+        # the missing amounts are replaced with the median (if there are only few of them, see amounts_usable)
+        columns.derive(
+            PaymentGroupsColumns.InvoicedAmount.name, [PaymentGroupsColumns.InvoicedAmount.name],
+            lambda amounts: amounts.fill_null(self.amount_median()) if self.amounts_usable() else amounts
+        )
+        columns.derive(
+            PaymentGroupsColumns.InvoicedAmountScaled.name, [PaymentGroupsColumns.InvoicedAmount.name],
+            lambda amounts: pc.divide(
+                pc.subtract(amounts, self.amount_median()), self.amount_quantile_range()
+            ) if self.amounts_usable() else pa.scalar(0, PaymentGroupsColumns.InvoicedAmount.otype)
+        )
+        columns.derive(
+            PaymentGroupsColumns.Severity.name,
+            [PaymentGroupsColumns.DelayDaysScaled.name, PaymentGroupsColumns.InvoicedAmountScaled.name],
+            lambda delays_scaled, amounts_scaled: pc.multiply(
+                delays_scaled,
+                pc.add(amounts_scaled, pc.add(pc.abs(self.amount_scaled_min()), 1.0))
+            )
+        )
+        columns.derive(
+            PaymentGroupsColumns.StoryTimeline.name,
+            [PaymentGroupsColumns.StoryId.name, PaymentGroupsColumns.DueDate.name],
+            lambda story_ids, due_dates: pc.days_between(self._story_begins(story_ids), due_dates)
+        )
+
+    def payments(self, columns: list[str] = None) -> pa.Table:
+        """
+        The payments with derived columns. The derived columns are computed lazily, only if requested
+        (or needed by requested ones)
+        :param columns: the columns to be returned, if not provided all loaded and all derived columns
+        computed so far are returned
+        """
+        return self._columns.table(columns)
+
+    def scaling_parameters(self) -> ScalingParameters:
+        if self._scaling is None:
+            self._scaling = calculate_scaling_parameters(self._columns.base())
+        return self._scaling
 
     def delay_mean(self) -> pa.float32():
-        if self._delay_mean is None:
-            self._delay_mean = pc.mean(self.payments().column(PaymentGroupsColumns.DelayDays.name))
-        return pc.cast(self._delay_mean, pa.float32())
+        return pc.cast(pa.scalar(self.scaling_parameters().delay_mean, pa.float64()), pa.float32())
 
     def delay_stddev(self) -> pa.float32():
-        if self._delay_stddev is None:
-            self._delay_stddev = pc.stddev(self.payments().column(PaymentGroupsColumns.DelayDays.name))
-        return pc.cast(self._delay_stddev, pa.float32())
+        return pc.cast(pa.scalar(self.scaling_parameters().delay_stddev, pa.float64()), pa.float32())
 
     def amount_median(self):
-        if self._amount_median is None:
-            self._amount_median = pc.approximate_median(self.payments().column(PaymentGroupsColumns.InvoicedAmount.name))
-        return pc.cast(self._amount_median, pa.float32())
+        return pc.cast(pa.scalar(self.scaling_parameters().amount_median, pa.float64()), pa.float32())
 
     def amount_quantile_range(self):
-        if self._amount_Q_3_1 is None:
-            _Q_1 = pc.quantile(self.payments().column(PaymentGroupsColumns.InvoicedAmount.name), 0.25)
-            _Q_3 = pc.quantile(self.payments().column(PaymentGroupsColumns.InvoicedAmount.name), 0.75)
-            self._amount_Q_3_1 = pc.cast(pc.subtract(_Q_3, _Q_1)[0], pa.float32())
-        return self._amount_Q_3_1
+        return pc.cast(pa.scalar(self.scaling_parameters().amount_quantile_range, pa.float64()), pa.float32())
 
-    def scaled_delays(self) -> pa.Table:
-        if PaymentGroupsColumns.DelayDaysScaled.name not in self.payments().column_names:
-            self._payments = self.payments().append_column(
-                PaymentGroupsColumns.DelayDaysScaled.name,
-                pc.divide(
-                    pc.subtract(
-                        self.payments().column(PaymentGroupsColumns.DelayDays.name),
-                        self.delay_mean()
-                    ),
-                    self.delay_stddev())
-            )
-        return self._payments
+    def amounts_usable(self) -> bool:
+        # if count of missing amounts is < 10% then replace it with median
+        # otherwise the records should not be taken into consideration when calculating
+        # features based on amounts
+        return self.scaling_parameters().amount_null_ratio < 0.1
 
-    def scaled_amount(self) -> pa.Table:
-        if PaymentGroupsColumns.InvoicedAmountScaled.name not in self.payments().column_names:
-            # if count of missing amounts is < 10% then replace it with median
-            # otherwise the records should not be taken into consideration when calculating
-            # features based on amounts
-            if (self.payments().column(PaymentGroupsColumns.InvoicedAmount.name).null_count / self.payments().num_rows) < 0.1:
-                self._payments = self.payments().set_column(
-                    self._payments.schema.get_field_index(PaymentGroupsColumns.InvoicedAmount.name),
-                    PaymentGroupsColumns.InvoicedAmount.name,
-                    self.payments().column(PaymentGroupsColumns.InvoicedAmount.name).fill_null(self.amount_median())
-                )
-                self._payments = self.payments().append_column(
-                    PaymentGroupsColumns.InvoicedAmountScaled.name,
-                    pc.divide(
-                        pc.subtract(
-                            self.payments().column(PaymentGroupsColumns.InvoicedAmount.name),
-                            self.amount_median()
-                        ),
-                        self.amount_quantile_range()
-                    )
-                )
-            else:
-                self._payments = self.payments().append_column(
-                    PaymentGroupsColumns.InvoicedAmountScaled.name,
-                    pa.nulls(self._payments.num_rows, PaymentGroupsColumns.InvoicedAmount.otype).fill_null(0)
-                )
-        return self._payments
+    def amount_scaled_min(self):
+        """
+        The minimal value of the scaled amount in the whole source (not only in loaded range of entities)
+        """
+        if not self.amounts_usable():
+            return pa.scalar(0, PaymentGroupsColumns.InvoicedAmount.otype)
+        return pc.divide(
+            pc.subtract(
+                pa.scalar(self.scaling_parameters().amount_min, PaymentGroupsColumns.InvoicedAmount.otype),
+                self.amount_median()
+            ),
+            self.amount_quantile_range()
+        )
 
-    def story_timeline(self) -> pa.Table:
+    def story_segments(self) -> Optional[Segments]:
         """
-        Ensures that in payments table there is a column with days-since-min-due-date.
-        This will play role of x-axis for regression line.
-        :return: the payments table with the desired column
+        The stories as segments of payments. The payments of a story are contiguous in pd-id order
+        (the story-id is the pd-id of its last payment), so if the payments are loaded in this order,
+        the stories are aggregated by segment reductions and per-story values are broadcast back without joins
+        :return: the segments, None if the payments are not ordered by story-id
         """
-        if PaymentGroupsColumns.StoryTimeline.name not in self.payments().column_names:
-            # note that in order to get payments, the method "severity" is invoked
-            # this is to ensure that the step is already executed
-            _min_due_date = self.severity().group_by(
-                PaymentGroupsColumns.StoryId.name
-            ).aggregate(
-                [(PaymentGroupsColumns.DueDate.name, 'min')]
-            )
+        if not self._segments_detected:
+            self._segments = segments_if_sorted(self._columns.base().column(PaymentGroupsColumns.StoryId.name))
+            self._segments_detected = True
+        return self._segments
 
-            self._payments = self._payments.join(
-                _min_due_date,
-                keys=PaymentGroupsColumns.StoryId.name
-            )
+    def streamed(self) -> bool:
+        """
+        The payments read from the file, whose stories are not contiguous, are streamed if they would not fit
+        in memory along with all their derived columns: then the derived columns are never computed for all payments
+        at once, they are derived per record batch read from the file whenever aggregated (see _aggregate_by_story)
+        or written (see write_derived_payments). Only the payments themselves are loaded (for the scaling parameters
+        and to detect the order of stories)
+        :return: True if the payments are streamed
+        """
+        if self._streamed is None:
+            self._streamed = self._file is not None and self.story_segments() is None and \
+                self._columns.base().nbytes + self._columns.base().num_rows * sum(
+                    _c.otype.bit_width // 8 for _c in PaymentGroupsColumns.Derived
+                ) > self._SPILL_WHEN_LARGER_THAN_BYTES
+        return self._streamed
 
-            self._payments = self._payments.append_column(
-                PaymentGroupsColumns.StoryTimeline.name,
-                pc.days_between(
-                    self._payments.column(PaymentGroupsColumns.DueDate.name + '_min'),
-                    self._payments.column(PaymentGroupsColumns.DueDate.name)
-                )
-            )
+    def _payment_columns(self, payments: pa.Table) -> ColumnGraph:
+        """
+        :param payments: the part of payments (COLUMNS)
+        :return: the part of payments with derived columns, as derived for all payments
+        """
+        _columns = ColumnGraph(lambda: payments)
+        self._derive_columns(_columns)
+        return _columns
 
-            self._payments = self._payments.remove_column(self._payments.schema.get_field_index(PaymentGroupsColumns.DueDate.name + '_min'))
+    def _payment_batches(self, columns: Callable[[ColumnGraph], pa.Table]) -> pa.RecordBatchReader:
+        """
+        Reads the payments from the file in record batches, the columns are derived for every batch separately
+        :param columns: builds the table (aligned with the payments) from the payments with derived columns
+        :return: the stream of the tables built
+        """
+        _range_filter = _entity_range_filter(self._entity_range)
 
-        return self._payments
+        def _batches() -> Iterator[pa.RecordBatch]:
+            for _batch in pq.ParquetFile(self._file).iter_batches(batch_size=self.STREAMING_BATCH_SIZE,
+                                                                   columns=self.COLUMNS):
+                _payments = pa.Table.from_batches([_batch])
+                if _range_filter is not None:
+                    _payments = _payments.filter(_range_filter)
+                _columns = self._payment_columns(_payments)
+                yield from columns(_columns).to_batches()
+                self._streamed_columns.update(_columns.computed())
 
-    def severity(self) -> pa.Table:
-        if PaymentGroupsColumns.Severity.name not in self.payments().column_names:
-            delay_scaled = self.scaled_delays().column(PaymentGroupsColumns.DelayDaysScaled.name)
-            amount_scaled = self.scaled_amount().column(PaymentGroupsColumns.InvoicedAmountScaled.name)
-            self._payments = self.payments().append_column(
-                PaymentGroupsColumns.Severity.name,
-                pc.multiply(
-                    delay_scaled,
-                    pc.add(amount_scaled, pc.add(pc.abs(pc.min(amount_scaled)), 1.0))
-                )
+        return pa.RecordBatchReader.from_batches(
+            columns(self._payment_columns(self._columns.base().slice(0, 0))).schema, _batches())
+
+    def _aggregate_by_story(self, columns: Callable[[ColumnGraph], pa.Table], agg: list[tuple]) -> pa.Table:
+        """
+        Groups the records by story-id. If the stories are contiguous, segments are aggregated, otherwise hash
+        group-by is used: large tables are partitioned and spilled to disk, so that the hash table of the group-by
+        (and its intermediate results) holds only one partition of stories at a time. If the payments are streamed,
+        the records are built per record batch as well, so that the memory limit bounds also the input (otherwise
+        the table is materialized first)
+        :param columns: builds the table to be aggregated (aligned with the payments) from the payments with derived
+        columns
+        :param agg: the aggregations, as for pa.TableGroupBy.aggregate
+        """
+        if self.story_segments() is not None:
+            return self.story_segments().aggregate(columns(self._columns), PaymentGroupsColumns.StoryId.name, agg)
+        if self.streamed():
+            return SpillingAggregate(self._payment_batches(columns), PaymentGroupsColumns.StoryId.name, agg,
+                                     memory_limit=self._SPILL_WHEN_LARGER_THAN_BYTES,
+                                     tempdir=DIR_PROCESSING).aggregate()
+        _table = columns(self._columns)
+        if _table.nbytes > self._SPILL_WHEN_LARGER_THAN_BYTES:
+            return SpillingAggregate(_table, PaymentGroupsColumns.StoryId.name, agg,
+                                     memory_limit=self._SPILL_WHEN_LARGER_THAN_BYTES,
+                                     tempdir=DIR_PROCESSING).aggregate()
+        if _table.num_rows > self._USE_SUBARROW_WHEN_LARGER_THAN_RECORDS:
+            return ArrowAggregate(_table, [PaymentGroupsColumns.StoryId.name], agg).aggregate()
+        return _table.group_by(PaymentGroupsColumns.StoryId.name).aggregate(agg)
+
+    def _story_begins(self, story_ids: pa.ChunkedArray) -> pa.ChunkedArray:
+        # the first due date of the story, for each payment (of all payments or of a batch, see streamed)
+        if self._begins is None:
+            self._begins = self._aggregate_by_story(
+                lambda columns: columns.table([PaymentGroupsColumns.StoryId.name, PaymentGroupsColumns.DueDate.name]),
+                [(PaymentGroupsColumns.DueDate.name, 'min')]
             )
+        if self.story_segments() is not None:
+            return self.story_segments().broadcast(self._begins.column(PaymentGroupsColumns.DueDate.name + '_min'))
+        return self._begins.column(PaymentGroupsColumns.DueDate.name + '_min').take(
+            pc.index_in(story_ids, value_set=self._begins.column(PaymentGroupsColumns.StoryId.name))
+        )
 
+    def _derived(self, name: str) -> pa.Table:
+        # the derived column is computed for all payments, unless they are streamed
+        if not self.streamed():
+            self._columns.value(name)
         return self.payments()
 
+    def scaled_delays(self) -> pa.Table:
+        return self._derived(PaymentGroupsColumns.DelayDaysScaled.name)
+
+    def scaled_amount(self) -> pa.Table:
+        return self._derived(PaymentGroupsColumns.InvoicedAmountScaled.name)
+
+    def story_timeline(self) -> pa.Table:
+        """
+        Ensures that in payments table there is a column with days-since-min-due-date (unless the payments
+        are streamed). This will play role of x-axis for regression line.
+        :return: the payments table with the desired column
+        """
+        return self._derived(PaymentGroupsColumns.StoryTimeline.name)
+
+    def severity(self) -> pa.Table:
+        return self._derived(PaymentGroupsColumns.Severity.name)
+
     def stories(self) -> pa.Table:
         if self._stories is None:
-            self.story_timeline()
             _col_paid = 'paid_after_days_since_story_start'
-            _payments = self.severity().append_column(
+            # the means of scalar columns (e.g. the scaled amount of a source without usable amounts) are the scalars,
+            # they are not aggregated (nor broadcast to every payment), only to the stories
+            _means = {
+                PaymentGroupsColumns.DelayDaysScaled.name: PaymentStoriesColumns.ScaledDelayMean.name,
+                PaymentGroupsColumns.InvoicedAmountScaled.name: PaymentStoriesColumns.ScaledAmountMean.name,
+                PaymentGroupsColumns.Severity.name: PaymentStoriesColumns.SeverityMean.name,
+                PaymentGroupsColumns.StoryTimeline.name: PaymentStoriesColumns.DaysSinceBeginMean.name
+            }
+            # (the streamed payments are not derived as a whole, the columns of none of them tell)
+            _derived = self._payment_columns(self._columns.base().slice(0, 0)) if self.streamed() else self._columns
+            _scalar_means = {_c: _mean for _c, _mean in _means.items() if _derived.is_scalar(_c)}
+
+            self._stories = self._aggregate_by_story(lambda columns: columns.table([
+                PaymentGroupsColumns.StoryId.name,
+                PaymentGroupsColumns.Id.name,
+                PaymentGroupsColumns.EntityId.name,
+                PaymentGroupsColumns.PriorCreditStatusMax.name,
+                PaymentGroupsColumns.DividingCreditStatus.name,
+                PaymentGroupsColumns.DividingDaysToDebt.name,
+                PaymentGroupsColumns.DueDate.name
+            ] + [_c for _c in _means if _c not in _scalar_means]).append_column(
                 _col_paid,
                 pc.add(
-                    self.severity().column(PaymentGroupsColumns.StoryTimeline.name),
-                    self.severity().column(PaymentGroupsColumns.DelayDays.name)
+                    columns.value(PaymentGroupsColumns.StoryTimeline.name),
+                    columns.value(PaymentGroupsColumns.DelayDays.name)
                 )
-            )
-
-            self._stories = _payments.group_by(
-                PaymentGroupsColumns.StoryId.name
-            ).aggregate([
+            ), [
                 (PaymentGroupsColumns.Id.name, 'min'),
                 (PaymentGroupsColumns.EntityId.name, 'min'),
                 (PaymentGroupsColumns.PriorCreditStatusMax.name, 'min'),
@@ -361,12 +721,8 @@ class PaymentStoriesBuilder:
                 (PaymentGroupsColumns.DueDate.name, 'min'),
                 (PaymentGroupsColumns.DueDate.name, 'max'),
                 (_col_paid, 'max'),
-                (PaymentGroupsColumns.Id.name, 'count'),
-                (PaymentGroupsColumns.DelayDaysScaled.name, 'mean'),
-                (PaymentGroupsColumns.InvoicedAmountScaled.name, 'mean'),
-                (PaymentGroupsColumns.Severity.name, 'mean'),
-                (PaymentGroupsColumns.StoryTimeline.name, 'mean')
-            ]).rename_columns([
+                (PaymentGroupsColumns.Id.name, 'count')
+            ] + [(_c, 'mean') for _c in _means if _c not in _scalar_means]).rename_columns([
                 PaymentStoriesColumns.StoryId.name,
                 PaymentStoriesColumns.FirstPaymentId.name,
                 PaymentStoriesColumns.EntityId.name,
@@ -376,358 +732,353 @@ class PaymentStoriesBuilder:
                 PaymentStoriesColumns.BeginsAt.name,
                 PaymentStoriesColumns.EndsAt.name,
                 PaymentStoriesColumns.Duration.name,
-                PaymentStoriesColumns.PaymentsCount.name,
-                PaymentStoriesColumns.ScaledDelayMean.name,
-                PaymentStoriesColumns.ScaledAmountMean.name,
-                PaymentStoriesColumns.SeverityMean.name,
-                PaymentStoriesColumns.DaysSinceBeginMean.name,
-            ])
+                PaymentStoriesColumns.PaymentsCount.name
+            ] + [_mean for _c, _mean in _means.items() if _c not in _scalar_means])
+            for _c, _mean in _scalar_means.items():
+                self._stories = self._stories.append_column(
+                    _mean, pa.repeat(pc.cast(_derived.value(_c), pa.float64()), self._stories.num_rows))
+            _order = self._stories.column_names[:-len(_means)] + list(_means.values())
+            self._stories = self._stories.select(_order)
 
-            self._stories = self.stories().append_column(
+            self._stories = self._stories.append_column(
                 pa.field(
                     PaymentStoriesColumns.DenotesAnyRisk.name, PaymentStoriesColumns.DenotesAnyRisk.otype, False
                 ),
-                pc.fill_null(
-                    pc.and_(
-                        pc.greater(
-                            pc.min_element_wise(
-                                pc.max_element_wise(
-                                    self.stories().column(PaymentStoriesColumns.Duration.name),
-                                    pa.nulls(
-                                        self._stories.num_rows, PaymentStoriesColumns.Duration.otype
-                                    ).fill_null(DENOTES_RISK_MIN_TIME_WINDOW_DAYS)
-                                ),
-                                pa.nulls(
-                                    self._stories.num_rows, PaymentStoriesColumns.Duration.otype
-                                ).fill_null(DENOTES_RISK_MAX_TIME_WINDOW_DAYS)
-                            ),
-                            self.stories().column(PaymentStoriesColumns.LaterDebtMinDaysToValidFrom.name)
-                        ),
-                        pc.greater(
-                            self._stories.column(PaymentStoriesColumns.EndsWithCreditStatus.name), 0
-                        )
-                    ),
-                    False
-                )
+                denotes_risk(self._stories, 0)
             ).append_column(
                 pa.field(
                     PaymentStoriesColumns.DenotesSignificantRisk.name,
                     PaymentStoriesColumns.DenotesSignificantRisk.otype, False
                 ),
-                pc.fill_null(
-                    pc.and_(
-                        pc.greater(
-                            pc.min_element_wise(
-                                pc.max_element_wise(
-                                    self.stories().column(PaymentStoriesColumns.Duration.name),
-                                    pa.nulls(
-                                        self._stories.num_rows, PaymentStoriesColumns.Duration.otype
-                                    ).fill_null(DENOTES_RISK_MIN_TIME_WINDOW_DAYS)
-                                ),
-                                pa.nulls(
-                                    self._stories.num_rows, PaymentStoriesColumns.Duration.otype
-                                ).fill_null(DENOTES_RISK_MAX_TIME_WINDOW_DAYS)
-                            ),
-                            self.stories().column(PaymentStoriesColumns.LaterDebtMinDaysToValidFrom.name)
-                        ),
-                        pc.greater(
-                            self._stories.column(PaymentStoriesColumns.EndsWithCreditStatus.name), 2
-                        )
-                    ),
-                    False
-                )
+                denotes_risk(self._stories, 2)
             )
 
         return self._stories
 
     def tendencies(self) -> pa.Table:
+        """
+        Fits the regression line of scaled delay and of severity over days-since-story-begin to every story.
+        The payments are aggregated only once, to the sums of x, y, xy, x^2 and y^2 per story,
+        the coefficients, the tendency at the end of the story and r-squared follow from them in closed form
+        :return: the stories with tendencies
+        """
         if PaymentStoriesColumns.TendencyCoefficient_ForDelay.name in self.stories().column_names:
             return self.stories()
 
-        # 1. calculate regression line parameters a0 and a1
-        _col_distance_to_mean_x = 'distance-to-mean-x'
-        _col_distance_to_mean_x_squared = 'distance-to-mean-x-squared'
-        _col_distance_to_mean_y_delay = 'distance-to-mean-y-delay'
-        _col_distance_to_mean_y_severity = 'distance-to-mean-y-severity'
-        _col_xdist_m_ydist_delay = 'distance-to-mean-x-multiplied-by-distance-to-mean-y-delay'
-        _col_xdist_m_ydist_severity = 'distance-to-mean-x-multiplied-by-distance-to-mean-y-severity'
-        _payments = self.story_timeline().select([
-            PaymentGroupsColumns.StoryId.name,
-            PaymentGroupsColumns.EntityId.name,
-            PaymentGroupsColumns.StoryTimeline.name,
-            PaymentGroupsColumns.DelayDaysScaled.name,
-            PaymentGroupsColumns.Severity.name
-        ]).join(
-            self.stories().select([
-                PaymentStoriesColumns.StoryId.name,
-                PaymentStoriesColumns.EntityId.name,
-                PaymentStoriesColumns.DaysSinceBeginMean.name,
-                PaymentStoriesColumns.ScaledDelayMean.name,
-                PaymentStoriesColumns.SeverityMean.name
-            ]), keys=[PaymentGroupsColumns.StoryId.name, PaymentGroupsColumns.EntityId.name]
-        )
-        _payments = _payments.append_column(
-            _col_distance_to_mean_x,
-            pc.subtract(
-                _payments.column(PaymentGroupsColumns.StoryTimeline.name),
-                _payments.column(PaymentStoriesColumns.DaysSinceBeginMean.name)
-            )
-        ).append_column(
-            _col_distance_to_mean_y_delay,
-            pc.subtract(
-                _payments.column(PaymentGroupsColumns.DelayDaysScaled.name),
-                _payments.column(PaymentStoriesColumns.ScaledDelayMean.name)
-            )
-        ).append_column(
-            _col_distance_to_mean_y_severity,
-            pc.subtract(
-                _payments.column(PaymentGroupsColumns.Severity.name),
-                _payments.column(PaymentStoriesColumns.SeverityMean.name)
-            )
-        )
-        _payments = _payments.append_column(
-            _col_distance_to_mean_x_squared,
-            pc.power(_payments.column(_col_distance_to_mean_x), 2)
-        )
-        _payments = _payments.append_column(
-            _col_xdist_m_ydist_delay,
-            pc.multiply(
-                _payments.column(_col_distance_to_mean_x),
-                _payments.column(_col_distance_to_mean_y_delay)
-            )
-        ).append_column(
-            _col_xdist_m_ydist_severity,
-            pc.multiply(
-                _payments.column(_col_distance_to_mean_x),
-                _payments.column(_col_distance_to_mean_y_severity)
-            )
-        )
-
-        if _payments.num_rows > self._USE_SUBARROW_WHEN_LARGER_THAN_RECORDS:
-            _a1_components = ArrowAggregate(_payments, [PaymentGroupsColumns.StoryId.name], [
-                (_col_xdist_m_ydist_delay, 'sum'),
-                (_col_xdist_m_ydist_severity, 'sum'),
-                (_col_distance_to_mean_x_squared, 'sum')
-            ], tempdir=DIR_PROCESSING.absolute()).aggregate()
-        else:
-            _a1_components = _payments.group_by(
-                PaymentGroupsColumns.StoryId.name
-            ).aggregate([
-                (_col_xdist_m_ydist_delay, 'sum'),
-                (_col_xdist_m_ydist_severity, 'sum'),
-                (_col_distance_to_mean_x_squared, 'sum')
-            ])
-
-        _a1_components = _a1_components.append_column(
-            PaymentStoriesColumns.TendencyCoefficient_ForDelay.name,
-            pc.divide(
-                _a1_components.column(_col_xdist_m_ydist_delay + '_sum'),
-                _a1_components.column(_col_distance_to_mean_x_squared + '_sum'),
-            )
-        ).append_column(
-            PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name,
-            pc.divide(
-                _a1_components.column(_col_xdist_m_ydist_severity + '_sum'),
-                _a1_components.column(_col_distance_to_mean_x_squared + '_sum'),
-            )
-        )
-
-        self._stories = self.stories().join(
-            _a1_components.select([
-                PaymentStoriesColumns.StoryId.name,
-                PaymentStoriesColumns.TendencyCoefficient_ForDelay.name,
-                PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name
-            ]),
-            keys=PaymentStoriesColumns.StoryId.name
-        )
+        # 1. sufficient statistics of both regressions (x: days since begin, y: scaled delay and severity)
+        # the second moments are collected as population variances (ddof=0), aggregated in numerically stable way,
+        # the covariance is obtained from variances of x + y and x - y
+        _col_x = 'x'
+        _col_x_plus_y_delay = 'x-plus-y-delay'
+        _col_x_minus_y_delay = 'x-minus-y-delay'
+        _col_x_plus_y_severity = 'x-plus-y-severity'
+        _col_x_minus_y_severity = 'x-minus-y-severity'
+        def _moments_of(columns: ColumnGraph) -> pa.Table:
+            # the kernels broadcast scalar inputs, the columns are materialized only for the aggregated table
+            _x = pc.cast(columns.column(PaymentGroupsColumns.StoryTimeline.name), pa.float64())
+            _y_delay = columns.value(PaymentGroupsColumns.DelayDaysScaled.name)
+            _y_severity = columns.value(PaymentGroupsColumns.Severity.name)
+            return pa.table({
+                PaymentGroupsColumns.StoryId.name: columns.column(PaymentGroupsColumns.StoryId.name),
+                _col_x: _x,
+                PaymentGroupsColumns.DelayDaysScaled.name: columns.column(PaymentGroupsColumns.DelayDaysScaled.name),
+                PaymentGroupsColumns.Severity.name: columns.column(PaymentGroupsColumns.Severity.name),
+                _col_x_plus_y_delay: pc.add(_x, _y_delay),
+                _col_x_minus_y_delay: pc.subtract(_x, _y_delay),
+                _col_x_plus_y_severity: pc.add(_x, _y_severity),
+                _col_x_minus_y_severity: pc.subtract(_x, _y_severity)
+            })
 
-        self._stories = self.stories().append_column(
-            PaymentStoriesColumns.TendencyConstant_ForDelay.name,
-            pc.subtract(
-                self.stories().column(PaymentStoriesColumns.ScaledDelayMean.name),
-                pc.multiply(
-                    self.stories().column(PaymentStoriesColumns.TendencyCoefficient_ForDelay.name),
-                    self.stories().column(PaymentStoriesColumns.DaysSinceBeginMean.name)
-                )
-            )
-        ).append_column(
-            PaymentStoriesColumns.TendencyConstant_ForSeverity.name,
-            pc.subtract(
-                self.stories().column(PaymentStoriesColumns.SeverityMean.name),
-                pc.multiply(
-                    self.stories().column(PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name),
-                    self.stories().column(PaymentStoriesColumns.DaysSinceBeginMean.name)
-                )
-            )
-        )
-
-        # 2. calculate theoretical value to each payment
-        _col_theoretical_delay_scaled_from_regrline = 'theoretical-delay-scaled-from-regression-line'
-        _col_theoretical_severity_from_regression_line = 'theoretical-severity-from-regression-line'
-        _payments = _payments.join(
-            self.stories().select([
-                PaymentStoriesColumns.StoryId.name,
-                PaymentStoriesColumns.TendencyConstant_ForDelay.name,
-                PaymentStoriesColumns.TendencyConstant_ForSeverity.name,
-                PaymentStoriesColumns.TendencyCoefficient_ForDelay.name,
-                PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name
-            ]),
-            keys=PaymentStoriesColumns.StoryId.name
-        )
-        _payments = _payments.append_column(
-            _col_theoretical_delay_scaled_from_regrline,
-            pc.add(
-                pc.multiply(
-                    _payments.column(PaymentStoriesColumns.TendencyCoefficient_ForDelay.name),
-                    _payments.column(PaymentGroupsColumns.StoryTimeline.name)
-                ),
-                _payments.column(PaymentStoriesColumns.TendencyConstant_ForDelay.name)
-            )
-        ).append_column(
-            _col_theoretical_severity_from_regression_line,
-            pc.add(
-                pc.multiply(
-                    _payments.column(PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name),
-                    _payments.column(PaymentGroupsColumns.StoryTimeline.name)
-                ),
-                _payments.column(PaymentStoriesColumns.TendencyConstant_ForSeverity.name)
-            )
-        )
-
-        # 2A. keep the value of last point - this will be used as the predictor (not the coefficient!)
-        _last_story_record = _payments.group_by(
-            PaymentGroupsColumns.StoryId.name
-        ).aggregate(
-            [(PaymentGroupsColumns.StoryTimeline.name, 'max')]
-        )
-        _tendencies_values = self.stories().join(_last_story_record, PaymentGroupsColumns.StoryId.name)
-        _tendencies_values = _tendencies_values.append_column(
-            PaymentStoriesColumns.Tendency_ForDelay.name,
-            pc.add(
-                pc.multiply(
-                    _tendencies_values.column(PaymentStoriesColumns.TendencyCoefficient_ForDelay.name),
-                    _tendencies_values.column(PaymentGroupsColumns.StoryTimeline.name+'_max')
-                ),
-                _tendencies_values.column(PaymentStoriesColumns.TendencyConstant_ForDelay.name)
-            )
-        ).append_column(
-            PaymentStoriesColumns.Tendency_ForSeverity.name,
-            pc.add(
-                pc.multiply(
-                    _tendencies_values.column(PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name),
-                    _tendencies_values.column(PaymentGroupsColumns.StoryTimeline.name+'_max')
-                ),
-                _tendencies_values.column(PaymentStoriesColumns.TendencyConstant_ForSeverity.name)
-            )
-        )
-        _tendencies_values = _tendencies_values.append_column(
-            PaymentStoriesColumns.TendencyMinusMean_ForDelay.name,
-            pc.subtract(
-                _tendencies_values.column(PaymentStoriesColumns.Tendency_ForDelay.name),
-                _tendencies_values.column(PaymentStoriesColumns.ScaledDelayMean.name)
-            )
-        ).append_column(
-            PaymentStoriesColumns.TendencyMinusMean_ForSeverity.name,
-            pc.subtract(
-                _tendencies_values.column(PaymentStoriesColumns.Tendency_ForSeverity.name),
-                _tendencies_values.column(PaymentStoriesColumns.SeverityMean.name)
-            )
-        ).select([
-            PaymentGroupsColumns.StoryId.name,
-            PaymentStoriesColumns.Tendency_ForDelay.name,
-            PaymentStoriesColumns.Tendency_ForSeverity.name,
-            PaymentStoriesColumns.TendencyMinusMean_ForDelay.name,
-            PaymentStoriesColumns.TendencyMinusMean_ForSeverity.name
+        _moments = self._aggregate_by_story(_moments_of, [
+            (_col_x, 'max'),
+            (_col_x, 'variance'),
+            (PaymentGroupsColumns.DelayDaysScaled.name, 'variance'),
+            (PaymentGroupsColumns.DelayDaysScaled.name, 'min_max'),
+            (PaymentGroupsColumns.Severity.name, 'variance'),
+            (PaymentGroupsColumns.Severity.name, 'min_max'),
+            (_col_x_plus_y_delay, 'variance'),
+            (_col_x_minus_y_delay, 'variance'),
+            (_col_x_plus_y_severity, 'variance'),
+            (_col_x_minus_y_severity, 'variance')
         ])
-        self._stories = self.stories().join(_tendencies_values, PaymentGroupsColumns.StoryId.name)
-
-        # 3. calculate r-squared (coefficient of determination)
-        _col_distance_to_mean_y_theoretical_delay_squared = 'distance-to-mean-y-delay-theoretical-squared'
-        _col_distance_to_mean_y_theoretical_severity_squared = 'distance-to-mean-y-severity-theoretical-squared'
-        _col_distance_to_mean_y_delay_squared = 'distance-to-mean-y-delay-squared'
-        _col_distance_to_mean_y_severity_squared = 'distance-to-mean-y-severity-squared'
-        _payments = _payments.append_column(
-            _col_distance_to_mean_y_theoretical_delay_squared,
-            pc.power(
-                pc.subtract(
-                    _payments.column(_col_theoretical_delay_scaled_from_regrline),
-                    _payments.column(PaymentGroupsColumns.DelayDaysScaled.name)
-                ), 2
-            )
-        ).append_column(
-            _col_distance_to_mean_y_theoretical_severity_squared,
-            pc.power(
-                pc.subtract(
-                    _payments.column(_col_theoretical_severity_from_regression_line),
-                    _payments.column(PaymentGroupsColumns.Severity.name)
-                ), 2
-            )
-        ).append_column(
-            _col_distance_to_mean_y_delay_squared,
-            pc.power(_payments.column(_col_distance_to_mean_y_delay), 2)
-        ).append_column(
-            _col_distance_to_mean_y_severity_squared,
-            pc.power(_payments.column(_col_distance_to_mean_y_severity), 2)
-        )
 
-        if _payments.num_rows > self._USE_SUBARROW_WHEN_LARGER_THAN_RECORDS:
-            _rsquare_components = ArrowAggregate(_payments, [PaymentGroupsColumns.StoryId.name], [
-                    (_col_distance_to_mean_y_theoretical_delay_squared, 'sum'),
-                    (_col_distance_to_mean_y_theoretical_severity_squared, 'sum'),
-                    (_col_distance_to_mean_y_delay_squared, 'sum'),
-                    (_col_distance_to_mean_y_severity_squared, 'sum')
-            ], tempdir=DIR_PROCESSING.absolute()).aggregate()
-        else:
-            _rsquare_components = _payments.group_by(
-                PaymentGroupsColumns.StoryId.name
-            ).aggregate([
-                (_col_distance_to_mean_y_theoretical_delay_squared, 'sum'),
-                (_col_distance_to_mean_y_theoretical_severity_squared, 'sum'),
-                (_col_distance_to_mean_y_delay_squared, 'sum'),
-                (_col_distance_to_mean_y_severity_squared, 'sum')
-            ])
+        # (the sums of squares and products are n-multiples of the variances and covariance, n cancels out)
+        _sxx = _moments.column(_col_x + '_variance')
+        _regression = {PaymentStoriesColumns.StoryId.name: _moments.column(PaymentGroupsColumns.StoryId.name)}
+        for _y, _col_x_plus_y, _col_x_minus_y, _col_a1, _col_rsquare in [
+            (PaymentGroupsColumns.DelayDaysScaled.name, _col_x_plus_y_delay, _col_x_minus_y_delay,
+             PaymentStoriesColumns.TendencyCoefficient_ForDelay.name, PaymentStoriesColumns.TendencyError_ForDelay.name),
+            (PaymentGroupsColumns.Severity.name, _col_x_plus_y_severity, _col_x_minus_y_severity,
+             PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name,
+             PaymentStoriesColumns.TendencyError_ForSeverity.name)
+        ]:
+            # the centered sums are exactly zero if y is constant, do not let the rounding errors in
+            _min_max = _moments.column(_y + '_min_max')
+            _constant = pc.equal(pc.struct_field(_min_max, 'min'), pc.struct_field(_min_max, 'max'))
+            _sxy = pc.if_else(_constant, 0.0, pc.divide(
+                pc.subtract(_moments.column(_col_x_plus_y + '_variance'), _moments.column(_col_x_minus_y + '_variance')),
+                4.0
+            ))
+            _syy = pc.if_else(_constant, 0.0, _moments.column(_y + '_variance'))
+            _regression[_col_a1], _regression[_col_rsquare] = regression_slope(_sxx, _sxy, _syy)
+        _regression[_col_x + '_max'] = _moments.column(_col_x + '_max')
 
-        _rsquare_components = _rsquare_components.append_column(
-            PaymentStoriesColumns.TendencyError_ForDelay.name,
-            pc.subtract(
-                pa.nulls(_rsquare_components.num_rows, PaymentStoriesColumns.TendencyError_ForDelay.otype).fill_null(1.0),
-                pc.divide(
-                    _rsquare_components.column(_col_distance_to_mean_y_theoretical_delay_squared + '_sum'),
-                    _rsquare_components.column(_col_distance_to_mean_y_delay_squared + '_sum')
-                )
+        _stories_columns = self.stories().column_names
+        self._stories = self.stories().join(pa.table(_regression), keys=PaymentStoriesColumns.StoryId.name)
+
+        # 2. a0 from the means, the tendency is the value of the regression line at the last payment of the story
+        # (this will be used as the predictor, not the coefficient!)
+        _x_mean = self._stories.column(PaymentStoriesColumns.DaysSinceBeginMean.name)
+        _x_max = self._stories.column(_col_x + '_max')
+        for _col_y_mean, _col_a1, _col_a0, _col_tendency, _col_tendency_minus_mean in [
+            (PaymentStoriesColumns.ScaledDelayMean.name,
+             PaymentStoriesColumns.TendencyCoefficient_ForDelay.name,
+             PaymentStoriesColumns.TendencyConstant_ForDelay.name,
+             PaymentStoriesColumns.Tendency_ForDelay.name,
+             PaymentStoriesColumns.TendencyMinusMean_ForDelay.name),
+            (PaymentStoriesColumns.SeverityMean.name,
+             PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name,
+             PaymentStoriesColumns.TendencyConstant_ForSeverity.name,
+             PaymentStoriesColumns.Tendency_ForSeverity.name,
+             PaymentStoriesColumns.TendencyMinusMean_ForSeverity.name)
+        ]:
+            _a0, _tendency, _tendency_minus_mean = regression_tendency(
+                self._stories.column(_col_a1), _x_mean, _x_max, self._stories.column(_col_y_mean)
             )
-        ).append_column(
-            PaymentStoriesColumns.TendencyError_ForSeverity.name,
-            pc.subtract(
-                pa.nulls(_rsquare_components.num_rows, PaymentStoriesColumns.TendencyError_ForSeverity.otype).fill_null(1.0),
-                pc.divide(
-                    _rsquare_components.column(_col_distance_to_mean_y_theoretical_severity_squared + '_sum'),
-                    _rsquare_components.column(_col_distance_to_mean_y_severity_squared + '_sum')
-                )
+            self._stories = self._stories.append_column(
+                _col_a0, _a0
+            ).append_column(
+                _col_tendency, _tendency
+            ).append_column(
+                _col_tendency_minus_mean, _tendency_minus_mean
             )
-        )
-
-        self._stories = self.stories().join(
-            _rsquare_components.select([
-                PaymentStoriesColumns.StoryId.name,
-                PaymentStoriesColumns.TendencyError_ForDelay.name,
-                PaymentStoriesColumns.TendencyError_ForSeverity.name
-            ]),
-            keys=PaymentStoriesColumns.StoryId.name
-        )
 
+        self._stories = self._stories.select(_stories_columns + TENDENCY_COLUMNS)
         return self._stories
 
     def write_stories(self, input_code: str) -> Path:
         _file = payment_stories_file(input_code, self.source_codename)
-        pq.write_table(self.stories(), _file)
+        pq.write_table(self.stored_stories(), _file)
         return _file
 
+    def stored_stories(self) -> pa.Table:
+        """
+        :return: the stories with tendencies, in storage schema
+        """
+        return compact(self.tendencies(), storage_schema(PaymentStoriesColumns.Stored))
+
+    def _derived_schema(self) -> pa.Schema:
+        # the derived columns computed so far (for all payments or per batch), the filled amount is not stored,
+        # it would only duplicate the grouped payments (see amount_median)
+        _computed = set(self._columns.computed()) | self._streamed_columns
+        return storage_schema([_c for _c in PaymentGroupsColumns.Derived if _c.name in _computed]).with_metadata(
+            scaling_metadata(self.scaling_parameters()))
+
+    def derived_payments(self) -> pa.Table:
+        """
+        :return: the derived columns computed so far in storage schema, with the scaling parameters in the metadata
+        (the columns computed per batch are computed for all payments, see write_derived_payments)
+        """
+        _schema = self._derived_schema()
+        return compact(self.payments(_schema.names).replace_schema_metadata(_schema.metadata), _schema)
+
+    def write_derived_payments(self, file: Path) -> Path:
+        """
+        Writes the derived columns computed so far (see derived_payments). If the payments are streamed,
+        the columns are derived and written per record batch read from the file again
+        :param file: the file to be written
+        :return: the file
+        """
+        if not self.streamed():
+            pq.write_table(self.derived_payments(), file)
+            return file
+        _schema = self._derived_schema()
+        with pq.ParquetWriter(file, _schema) as _writer:
+            for _batch in self._payment_batches(lambda columns: compact(columns.table(_schema.names), _schema)):
+                _writer.write_batch(_batch)
+        return file
+
     def update_payment_groups(self, input_code: str) -> Path:
+        """
+        Writes the derived columns computed so far into the sidecar of the grouped-payments file
+        (see payments_derived_file), the grouped payments themselves are not rewritten. The payments must have been
+        loaded from the grouped-payments file (as a whole), so that the sidecar is row-aligned with it.
+        The scaling parameters are persisted in the metadata of the sidecar (see read_scaling_parameters)
+        :return: the sidecar file
+        """
+        return self.write_derived_payments(payments_derived_file(input_code, self.source_codename))
+
+    def write_payment_groups(self, input_code: str) -> Path:
+        """
+        Writes both the grouped payments (as loaded or provided) and their derived columns (see update_payment_groups)
+        :return: the grouped-payments file
+        """
         _file = payments_grouped_by_stories_file(input_code, self.source_codename)
-        pq.write_table(self.payments(), _file)
+        _payments = compact(self._columns.base(), storage_schema(PaymentGroupsColumns.Grouped))
+        pq.write_table(
+            _payments, _file,
+            sorting_columns=sorting_columns(_payments, [PaymentGroupsColumns.Id.name])
+            if is_sorted(_payments.column(PaymentGroupsColumns.Id.name)) else None
+        )
+        self.update_payment_groups(input_code)
         return _file
 
+
+def group_and_build_stories(source_file: Path, codename: str, input_code: str,
+                            scaling: ScalingParameters = None) -> PaymentStoriesBuilder:
+    """
+    Fused grouping and story building: the payments grouped by PaymentHistoryGrouper are handed over
+    to PaymentStoriesBuilder in memory, so the grouped payments are written only once (with all derived columns)
+    instead of being written, read back and rewritten.
+    :param source_file: the per-source file with payment delays and debts
+    :param codename: the code-name of the source
+    :param input_code: the input-code
+    :param scaling: optional frozen scaling parameters (see frozen_scaling_parameters)
+    :return: the builder with stories and tendencies calculated (both files and the offset index of grouped
+    payments are already written)
+    """
+    _grouper = PaymentHistoryGrouper(source_file, codename)
+    _grouper.content()
+    _grouper.detect_dividers()
+    _grouper.calculate_story_ids()
+    _builder = PaymentStoriesBuilder(None, codename, scaling=scaling, payments=_grouper.combine())
+    _grouper = None
+    _builder.tendencies()
+    _builder.write_stories(input_code)
+    _builder.write_payment_groups(input_code)
+    PaymentsIndex.of(input_code, codename)
+    return _builder
+
+
+def entity_ranges(file: Path, shards: int) -> list[EntityRange]:
+    """
+    Splits the source into (at most) given number of contiguous ranges of entities, having similar number of records.
+    If the file is sorted, the ranges begin at the first entity of a row-group, so that each shard reads only its own
+    row-groups (plus the one shared with neighbouring shard). Otherwise, the ranges are based on quantiles of entity-ids.
+    :param file: the per-source file (payment delays or grouped payments)
+    :param shards: the desired number of ranges
+    :return: list of (min inclusive, max exclusive) entity-id ranges, the first and the last one are open
+    """
+    if shards <= 1:
+        return [(None, None)]
+    _metadata = pq.read_metadata(file)
+    _begins = []
+    if declared_sorting(file)[:1] in ([PayDelayColumns.Id.name], [PayDelayColumns.EntityId.name]):
+        _entity_idx = _metadata.schema.to_arrow_schema().get_field_index(PayDelayColumns.EntityId.name)
+        _rows_per_shard = _metadata.num_rows / shards
+        _rows = 0
+        for _rg in range(_metadata.num_row_groups):
+            if _rows >= _rows_per_shard * (len(_begins) + 1):
+                _begins.append(_metadata.row_group(_rg).column(_entity_idx).statistics.min)
+            _rows += _metadata.row_group(_rg).num_rows
+    else:
+        _entities = pq.read_table(file, columns=[PayDelayColumns.EntityId.name]).column(0)
+        _begins = pc.quantile(
+            _entities, q=[_i / shards for _i in range(1, shards)], interpolation='lower').to_pylist()
+    _begins = sorted(set(_begins))
+    return list(zip([None] + _begins, _begins + [None]))
+
+
+def _concatenate(parts: list[Path], file: Path, sorted_by: list[str] = None, metadata: dict = None) -> int:
+    _written = 0
+    _writer: Optional[pq.ParquetWriter] = None
+    try:
+        for _part in parts:
+            _table = pq.read_table(_part)
+            if _writer is None:
+                _writer = pq.ParquetWriter(
+                    file, _table.schema if metadata is None else _table.schema.with_metadata(metadata),
+                    sorting_columns=None if sorted_by is None else sorting_columns(_table, sorted_by))
+            _writer.write_table(_table)
+            _written += _table.num_rows
+    finally:
+        if _writer is not None:
+            _writer.close()
+    return _written
+
+
+def _group_shard(source_file: Path, codename: str, entity_range: EntityRange, part: Path) -> Path:
+    _grouper = PaymentHistoryGrouper(source_file, codename, entity_range)
+    _grouper.content()
+    _grouper.detect_dividers()
+    _grouper.calculate_story_ids()
+    return _grouper.store(part)
+
+
+def group_in_shards(source_file: Path, codename: str, input_code: str, shards: int) -> int:
+    """
+    Groups the payments of a single source in parallel processes, each one processing a contiguous range of entities.
+    The results are the same as if PaymentHistoryGrouper processed the whole source at once.
+    :param source_file: the per-source file with payment delays and debts
+    :param codename: the code-name of the source
+    :param input_code: the input-code
+    :param shards: the number of processes (ranges of entities)
+    :return: the number of records written to grouped-payments file
+    """
+    _ranges = entity_ranges(source_file, shards)
+    with tempfile.TemporaryDirectory(dir=DIR_PROCESSING) as _tempdir:
+        _parts = [Path(_tempdir) / f'{codename}_{_i}{EXTENSION_PARQUET}' for _i in range(len(_ranges))]
+        with ProcessPoolExecutor(max_workers=len(_ranges)) as _executor:
+            list(_executor.map(
+                _group_shard, [source_file] * len(_ranges), [codename] * len(_ranges), _ranges, _parts))
+        # each part is sorted by pd-id and the parts are ordered by entity, hence the whole file is sorted as well
+        return _concatenate(_parts, payments_grouped_by_stories_file(input_code, codename), [PayDelayColumns.Id.name])
+
+
+def _build_stories_shard(grouped_file: Path, codename: str, entity_range: EntityRange, scaling: ScalingParameters,
+                         stories_part: Path, payments_part: Path):
+    _builder = PaymentStoriesBuilder(grouped_file, codename, entity_range, scaling)
+    try:
+        _builder.tendencies()
+    finally:
+        # the shard's process would not exit otherwise, waiting for its own aggregation worker
+        shutdown_aggregation_workers()
+    pq.write_table(_builder.stored_stories(), stories_part)
+    _builder.write_derived_payments(payments_part)
+
+
+def build_stories_in_shards(grouped_file: Path, codename: str, input_code: str,
+                            shards: int, scaling: ScalingParameters = None) -> tuple[ScalingParameters, int]:
+    """
+    Builds the payment stories of a single source in parallel processes, each one processing a contiguous range
+    of entities. The scaling parameters are calculated once for the whole source and passed to each process,
+    so the results are the same as if PaymentStoriesBuilder processed the whole source at once.
+    Both the stories file and the sidecar with derived columns of grouped payments are written.
+    The sidecar must be row-aligned with the grouped payments, hence if the file is not declared to be sorted
+    (by pd-id or entity-id), the shards would not follow its order and the stories are built in a single process.
+    :param grouped_file: the file with payments grouped by stories
+    :param codename: the code-name of the source
+    :param input_code: the input-code
+    :param shards: the number of processes (ranges of entities)
+    :param scaling: optional frozen scaling parameters (see frozen_scaling_parameters)
+    :return: the scaling parameters and the number of stories
+    """
+    _scaling = scaling if scaling is not None else calculate_scaling_parameters(pq.read_table(grouped_file, columns=[
+        PaymentGroupsColumns.DelayDays.name,
+        PaymentGroupsColumns.InvoicedAmount.name
+    ]))
+    if declared_sorting(grouped_file)[:1] not in ([PaymentGroupsColumns.Id.name], [PaymentGroupsColumns.EntityId.name]):
+        _builder = PaymentStoriesBuilder(grouped_file, codename, scaling=_scaling)
+        _builder.tendencies()
+        _builder.write_stories(input_code)
+        _builder.update_payment_groups(input_code)
+        return _scaling, _builder.stories().num_rows
+
+    _ranges = entity_ranges(grouped_file, shards)
+    with tempfile.TemporaryDirectory(dir=DIR_PROCESSING) as _tempdir:
+        _stories_parts = [Path(_tempdir) / f'{PREFIX_PAYMENT_STORIES}_{_i}{EXTENSION_PARQUET}'
+                          for _i in range(len(_ranges))]
+        _payments_parts = [Path(_tempdir) / f'{PREFIX_PAYMENTS_DERIVED}_{_i}{EXTENSION_PARQUET}'
+                           for _i in range(len(_ranges))]
+        with ProcessPoolExecutor(max_workers=len(_ranges)) as _executor:
+            list(_executor.map(
+                _build_stories_shard, [grouped_file] * len(_ranges), [codename] * len(_ranges), _ranges,
+                [_scaling] * len(_ranges), _stories_parts, _payments_parts))
+        _stories = _concatenate(_stories_parts, payment_stories_file(input_code, codename))
+        _concatenate(_payments_parts, payments_derived_file(input_code, codename),
+                     metadata=scaling_metadata(_scaling))
+    return _scaling, _stories
+
 #
 # class PaymentHistoryBuilderPandas:
 #     """
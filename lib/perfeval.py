@@ -1,84 +1,184 @@
+import numpy as np
 import pandas as pd
 import math
 
+from lib.histogram import DEFAULT_PRECISION_BITS, PredictorHistogram
 from lib.input_const import *
+from lib.util import LruCache
 
 import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import pyarrow as pa
 
+from collections import namedtuple
 from typing import Optional
 from typing import Union
 
+# the filtered predictor and actual values as contiguous arrays (the stories with unknown actual value excluded)
+# with the counts of actual positives and negatives
+PredictorVectors = namedtuple('PredictorVectors', ['values', 'actual', 'positives', 'negatives'])
+
 
 class PaymentStoriesPerformanceEvaluator:
 
-    def __init__(self, source_file: Path, codename: str):
+    def __init__(self, source_file: Path, codename: str, cache_size: int = 32):
+        """
+        :param source_file: the file with payment stories
+        :param codename: the code-name of the source
+        :param cache_size: the count of (predictor, actual) pairs whose vectors (and rankings) are kept in memory
+        """
         self._file = source_file
         self.source_codename = codename
         self._stories: Optional[pa.Table] = None
-        self._confusion_matrices = {}
+        # only the columns evaluated are read (see _column)
+        self._columns: dict[str, pa.ChunkedArray] = {}
+        self._vectors_cache = LruCache(cache_size)
+        self._rankings = LruCache(cache_size)
 
     def stories(self) -> pa.Table:
         if self._stories is None:
             self._stories = pq.read_table(self._file)
         return self._stories
 
+    def _column(self, name: str) -> pa.ChunkedArray:
+        if name not in self._columns:
+            self._columns[name] = self._stories.column(name) if self._stories is not None \
+                else pq.read_table(self._file, columns=[name]).column(name)
+        return self._columns[name]
+
     def count_stories(self) -> int:
-        return self.stories().num_rows
+        return self._stories.num_rows if self._stories is not None else pq.read_metadata(self._file).num_rows
 
     def story_length_mean(self) -> float:
-        return pc.mean(self.stories().column(PaymentStoriesColumns.PaymentsCount.name)).as_py()
+        return pc.mean(self._column(PaymentStoriesColumns.PaymentsCount.name)).as_py()
 
     def story_duration_mean(self) -> float:
-        return pc.mean(self.stories().column(PaymentStoriesColumns.Duration.name)).as_py()
+        return pc.mean(self._column(PaymentStoriesColumns.Duration.name)).as_py()
 
     def stories_per_legal_entity(self) -> float:
-        _entities = pc.count_distinct(self.stories().column(PaymentStoriesColumns.EntityId.name)).as_py()
+        _entities = pc.count_distinct(self._column(PaymentStoriesColumns.EntityId.name)).as_py()
         return None if _entities == 0 else self.count_stories() / _entities
 
     def risk_rate(self, actual_col: str) -> float:
-        return pc.sum(self.stories().column(actual_col)).as_py() / self.count_stories()
+        return pc.sum(self._column(actual_col)).as_py() / self.count_stories()
 
-    def _predictor(self, predictor_col: str,
-                   actual_col: str = None) -> Union[pa.ChunkedArray, tuple[pa.ChunkedArray, pa.ChunkedArray]]:
+    def _projection(self, names: list[str]) -> pa.Table:
+        """
+        :return: the stories with only the columns provided
+        """
+        _missing = [_name for _name in dict.fromkeys(names) if _name not in self._columns]
+        if len(_missing) > 1 and self._stories is None:
+            # read at once
+            self._columns.update(zip(_missing, pq.read_table(self._file, columns=_missing).columns))
+        return pa.table({_name: self._column(_name) for _name in dict.fromkeys(names)})
+
+    @staticmethod
+    def _predictor_filter(predictor_col: str) -> pc.Expression:
+        """
+        :return: the stories the predictor is evaluated on: defined, and with enough payments to be meaningful
+        """
         if predictor_col in (PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name,
                              PaymentStoriesColumns.TendencyCoefficient_ForDelay.name,
-                             PaymentStoriesColumns.Tendency_ForSeverity,
-                             PaymentStoriesColumns.Tendency_ForDelay):
-            _filtered = self.stories().filter(
-                pc.field(predictor_col).is_valid()
-                & (pc.field(PaymentStoriesColumns.PaymentsCount.name) > 2)
+                             PaymentStoriesColumns.Tendency_ForSeverity.name,
+                             PaymentStoriesColumns.Tendency_ForDelay.name):
+            return pc.field(predictor_col).is_valid() \
+                & (pc.field(PaymentStoriesColumns.PaymentsCount.name) > 2) \
                 & ~pc.field(predictor_col).is_nan()
-            )
-            _pred = _filtered.column(predictor_col)
-            return (_pred, _filtered.column(actual_col)) if actual_col is not None else _pred
-
-        _filtered = self.stories().filter(
-            pc.field(predictor_col).is_valid()
-            & ~pc.field(predictor_col).is_nan()
+        return pc.field(predictor_col).is_valid() \
+            & ~pc.field(predictor_col).is_nan() \
             & (pc.field(PaymentStoriesColumns.PaymentsCount.name) > 1)
-        )
+
+    def _predictor(self, predictor_col: str,
+                   actual_col: str = None) -> Union[pa.ChunkedArray, tuple[pa.ChunkedArray, pa.ChunkedArray]]:
+        _filtered = self._projection(
+            [predictor_col, PaymentStoriesColumns.PaymentsCount.name] + ([actual_col] if actual_col else [])
+        ).filter(self._predictor_filter(predictor_col))
         return (_filtered.column(predictor_col), _filtered.column(actual_col)) if actual_col is not None \
             else _filtered.column(predictor_col)
 
+    def _vectors(self, predictor_col: str, actual_col: str) -> PredictorVectors:
+        """
+        The filtered predictor (see _predictor) and actual values, cached (see cache_size)
+        """
+        return self._vectors_cache.get((predictor_col, actual_col),
+                                       lambda: self._filtered_vectors(predictor_col, actual_col))
+
+    def predictor_vectors(self, predictor_col: str, actual_col: str) -> PredictorVectors:
+        """
+        :return: the filtered predictor and actual values (the stories with unknown actual value excluded),
+        as contiguous arrays (read-only, shared with the cache)
+        """
+        return self._vectors(predictor_col, actual_col)
+
+    def value_counts(self, predictor_col: str, actual_col: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: the distinct values of the filtered predictor (descending), the count of actual positives
+        and of negatives of every value (from the cached ranking, see _ranking)
+        """
+        _values, _positives, _negatives = self._ranking(predictor_col, actual_col)
+        return _values, np.diff(_positives, prepend=0), np.diff(_negatives, prepend=0)
+
+    def predictor_histogram(self, predictor_col: str, actual_col: str,
+                            precision_bits: int = DEFAULT_PRECISION_BITS) -> PredictorHistogram:
+        """
+        :return: the histogram of the filtered predictor split by the actual values, mergeable with the histograms
+        of other sources (see PredictorHistogram)
+        """
+        _vectors = self._vectors(predictor_col, actual_col)
+        return PredictorHistogram.of(_vectors.values, _vectors.actual, precision_bits)
+
+    def _filtered_vectors(self, predictor_col: str, actual_col: str) -> PredictorVectors:
+        _predictor, _actual = self._predictor(predictor_col, actual_col)
+        _known = pc.is_valid(_actual)
+        _values = np.ascontiguousarray(pc.filter(_predictor, _known).to_numpy())
+        _actual = np.ascontiguousarray(pc.filter(_actual, _known).to_numpy(zero_copy_only=False).astype(bool))
+        _positives = int(np.count_nonzero(_actual))
+        return PredictorVectors(_values, _actual, _positives, len(_actual) - _positives)
+
+    def _ranking(self, predictor_col: str, actual_col: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The predictor sorted once (descending) with cumulative counts of actual positives and negatives, from which
+        the confusion matrix for every distinct threshold follows (the stories with unknown actual value are ignored,
+        as in confusion_matrix)
+        :return: the distinct values of the predictor (descending), the count of positives and of negatives
+        with the predictor greater or equal to the value
+        """
+        return self._rankings.get((predictor_col, actual_col), lambda: self._ranked(predictor_col, actual_col))
+
+    def _ranked(self, predictor_col: str, actual_col: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        _vectors = self._vectors(predictor_col, actual_col)
+        _order = np.argsort(-_vectors.values, kind='stable')
+        _values = _vectors.values[_order]
+        _positives = np.cumsum(_vectors.actual[_order], dtype=np.int64)
+        _negatives = np.arange(1, len(_values) + 1, dtype=np.int64) - _positives
+        # the last occurrence of every distinct value: the ties are predicted together
+        _last = np.append(np.flatnonzero(_values[1:] != _values[:-1]), len(_values) - 1) if len(_values) > 0 \
+            else np.array([], dtype=np.int64)
+        return _values[_last], _positives[_last], _negatives[_last]
+
+    def confusion_matrices(self, predictor_col: str, thresholds: Union[list[float], np.ndarray],
+                           actual_col: str) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The confusion matrices for any number of thresholds at once: the thresholds are located by binary search
+        in the predictor sorted once (see _ranking), the counts are read from the cumulative counts of actual values
+        :param predictor_col: the predictor, the risk is predicted if it is greater than the threshold
+        :param thresholds: the thresholds
+        :param actual_col: the actual risk
+        :return: the true positives, false negatives, false positives and true negatives, aligned with thresholds
+        """
+        _values, _positives, _negatives = self._ranking(predictor_col, actual_col)
+        _vectors = self._vectors(predictor_col, actual_col)
+        # the count of distinct values greater than the threshold, the values are descending
+        _greater = len(_values) - np.searchsorted(_values[::-1], np.asarray(thresholds, dtype=np.float64),
+                                                  side='right')
+        _tp = np.concatenate([[0], _positives])[_greater]
+        _fp = np.concatenate([[0], _negatives])[_greater]
+        return _tp, _vectors.positives - _tp, _fp, _vectors.negatives - _fp
+
     def confusion_matrix(self, predictor_col: str,
                          threshold: float, actual_col: str) -> tuple[tuple[int, int], tuple[int, int]]:
-        _cached_cm_per_column = self._confusion_matrices.get(predictor_col+actual_col)
-        if _cached_cm_per_column is None:
-            _cached_cm_per_column = {}
-            self._confusion_matrices[predictor_col+actual_col] = _cached_cm_per_column
-        if threshold not in _cached_cm_per_column:
-            _predictor, _actual = self._predictor(predictor_col, actual_col)
-            _pred = pc.greater(_predictor, threshold)
-            _tp = pc.sum(pc.and_(_pred, _actual)).as_py()
-            _tn = pc.sum(pc.and_(pc.invert(_pred), pc.invert(_actual))).as_py()
-            _fp = pc.sum(pc.and_(_pred, pc.invert(_actual))).as_py()
-            _fn = pc.sum(pc.and_(pc.invert(_pred), _actual)).as_py()
-            _cached_cm_per_column[threshold] = \
-                (_tp if _tp is not None else 0, _fn if _fn is not None else 0), \
-                (_fp if _fp is not None else 0, _tn if _tn is not None else 0)
-        return _cached_cm_per_column[threshold]
+        _tp, _fn, _fp, _tn = self.confusion_matrices(predictor_col, [threshold], actual_col)
+        return (int(_tp[0]), int(_fn[0])), (int(_fp[0]), int(_tn[0]))
 
     def _true_positives(self, predictor_col: str, threshold: float, actual_col: str):
         return self.confusion_matrix(predictor_col, threshold, actual_col)[0][0]
@@ -93,10 +193,10 @@ class PaymentStoriesPerformanceEvaluator:
         return self.confusion_matrix(predictor_col, threshold, actual_col)[0][1]
 
     def _actual_positive_count(self, predictor_col: str, actual_col: str) -> int:
-        return pc.sum(self._predictor(predictor_col, actual_col)[1]).as_py()
+        return self._vectors(predictor_col, actual_col).positives
 
     def _actual_negative_count(self, predictor_col: str, actual_col: str) -> int:
-        return pc.sum(pc.invert(self._predictor(predictor_col, actual_col)[1])).as_py()
+        return self._vectors(predictor_col, actual_col).negatives
 
     def true_positive_rate(self, predictor_col: str, threshold: float, actual_col: str) -> float:
         """
@@ -138,8 +238,33 @@ class PaymentStoriesPerformanceEvaluator:
               self._false_positives(predictor_col, threshold, actual_col)
         return None if _pp == 0 else self._true_positives(predictor_col, threshold, actual_col) / _pp
 
-    def precision_recall_auc(self, predictor_col: str, actual_col: str):
-        raise NotImplementedError()
+    def precision_recall_curve(self, predictor_col: str, actual_col: str) -> pd.DataFrame:
+        """
+        The precision-recall curve with a point for every distinct value of the predictor (see _exact_thresholds),
+        the precision is NaN where no story is predicted as positive (None in precision)
+        """
+        _thresholds = self._exact_thresholds(predictor_col, actual_col)
+        _tp, _fn, _fp, _tn = self.confusion_matrices(predictor_col, _thresholds, actual_col)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _recall = np.where(_tp + _fn > 0, _tp / (_tp + _fn), 0.0)
+            _precision = np.where(_tp + _fp > 0, _tp / (_tp + _fp), np.nan)
+        return pd.DataFrame({"Recall": _recall, "Precision": _precision}, index=_thresholds)
+
+    def precision_recall_auc(self, predictor_col: str, actual_col: str) -> Optional[float]:
+        """
+        The area under precision-recall curve as the average precision: the precision at every distinct value
+        of the predictor weighted by the increase of recall (the ties are predicted together, the curve is not
+        interpolated linearly, which would be optimistic), from a single sort (see _ranking)
+        :return: the average precision, None if there are no actual positives
+        """
+        _, _tp, _fp = self._ranking(predictor_col, actual_col)
+        if len(_tp) == 0 or _tp[-1] == 0:
+            return None
+        # the precision is defined at every value where recall increases (at least one positive predicted)
+        _gained = np.diff(_tp, prepend=0)
+        return float(np.sum(_gained * (_tp / np.maximum(_tp + _fp, 1))) / _tp[-1])
+
+    average_precision = precision_recall_auc
 
     def predictor_min(self, predictor_col: str) -> float:
         return pc.min(self._predictor(predictor_col)).as_py()
@@ -171,26 +296,55 @@ class PaymentStoriesPerformanceEvaluator:
         return _mean + 3 * _stddev \
             if _mean is not None and not math.isnan(_mean) and _stddev is not None and not math.isnan(_stddev) else 1
 
-    def roc_curve(self, predictor_col: str, actual_col: str,
-                  threshold_min: float = None, threshold_max: float = None, steps: int = 100) -> pd.DataFrame:
+    def _thresholds(self, predictor_col: str, threshold_min: Optional[float], threshold_max: Optional[float],
+                    steps: int) -> list[float]:
         if threshold_min is None:
             threshold_min = self._default_threshold_min(predictor_col)
         if threshold_max is None:
             threshold_max = self._default_threshold_max(predictor_col)
+        return [threshold_min + _i*(threshold_max - threshold_min)/steps for _i in range(steps+1)]
+
+    def _exact_thresholds(self, predictor_col: str, actual_col: str) -> np.ndarray:
+        """
+        The confusion matrix changes only at the observed values of the predictor, hence the thresholds
+        -inf (all stories predicted as positive) and every distinct value, ascending, cover all confusion matrices
+        """
+        return np.concatenate([[-np.inf], self._ranking(predictor_col, actual_col)[0][::-1].astype(np.float64)])
 
-        _thresholds = [threshold_min + _i*(threshold_max - threshold_min)/steps for _i in range(steps+1)]
-        _tpr = [
-            self.recall(predictor_col=predictor_col, threshold=_th, actual_col=actual_col) for _th in _thresholds
-        ]
-        _fpr = [
-            self.false_positive_rate(
-                predictor_col=predictor_col, threshold=_th, actual_col=actual_col
-            ) for _th in _thresholds
-        ]
+    def roc_curve(self, predictor_col: str, actual_col: str,
+                  threshold_min: float = None, threshold_max: float = None, steps: int = 100,
+                  exact: bool = False) -> pd.DataFrame:
+        """
+        :param exact: if True, the curve has a point for every distinct value of the predictor (see exact_roc_curve)
+        and the range of thresholds and steps are ignored
+        """
+        _thresholds = self._exact_thresholds(predictor_col, actual_col) if exact \
+            else self._thresholds(predictor_col, threshold_min, threshold_max, steps)
+        _tp, _fn, _fp, _tn = self.confusion_matrices(predictor_col, _thresholds, actual_col)
+        # the rates are 0 if there are no actual positives (negatives), as in true_positive_rate
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _tpr = np.where(_tp + _fn > 0, _tp / (_tp + _fn), 0.0)
+            _fpr = np.where(_fp + _tn > 0, _fp / (_fp + _tn), 0.0)
         return pd.DataFrame({"False Positive Rate": _fpr, "True Positive Rate": _tpr}, index=_thresholds)
 
-    def roc_auc(self, predictor_col: str, actual_col: str, sampling: int = 100):
-        _roc = self.roc_curve(predictor_col=predictor_col, actual_col=actual_col, steps=sampling)
+    def exact_roc_curve(self, predictor_col: str, actual_col: str) -> pd.DataFrame:
+        """
+        The ROC curve with a point for every distinct value of the predictor, computed from a single sort
+        (see _ranking). The thresholds are ascending as in roc_curve, the first one (-inf) predicts all stories
+        as positive, each of the others predicts the stories with the predictor greater than the threshold
+        """
+        return self.roc_curve(predictor_col, actual_col, exact=True)
+
+    def roc_auc(self, predictor_col: str, actual_col: str, sampling: int = 100, exact: bool = False):
+        """
+        :param exact: if True, the exact area (see exact_roc_curve), the ties of the predictor count as a half
+        (the area equals the Mann-Whitney U statistic normalized), the sampling is ignored
+        """
+        _roc = self.roc_curve(predictor_col=predictor_col, actual_col=actual_col, steps=sampling, exact=exact)
+        if exact:
+            _fpr = _roc[_roc.columns[0]].values[::-1]
+            _tpr = _roc[_roc.columns[1]].values[::-1]
+            return float(np.sum(np.diff(_fpr) * (_tpr[:-1] + _tpr[1:]) / 2))
         _fpr = list(reversed(_roc[_roc.columns[0]].values))
         _tpr = list(reversed(_roc[_roc.columns[1]].values))
         return sum([
@@ -198,24 +352,251 @@ class PaymentStoriesPerformanceEvaluator:
             for _fpr_p, _fpr_n, _tpr_p, _tpr_n in zip(_fpr[:-1], _fpr[1:], _tpr[:-1], _tpr[1:])
         ])
 
+    @staticmethod
+    def _average_ranks(values: np.ndarray) -> np.ndarray:
+        """
+        :return: the ranks of the values (from 1), the tied values share the mean of their ranks
+        """
+        _order = np.argsort(values, kind='stable')
+        _sorted = values[_order]
+        _first = np.concatenate([[True], _sorted[1:] != _sorted[:-1]]) if len(values) > 0 else np.array([], bool)
+        _starts = np.flatnonzero(_first)
+        _ends = np.append(_starts[1:], len(values))
+        _ranks = np.empty(len(values), dtype=np.float64)
+        _ranks[_order] = ((_starts + 1 + _ends) / 2)[np.cumsum(_first) - 1]
+        return _ranks
+
+    @staticmethod
+    def _rank_sum_aucs(ranks: np.ndarray, actual: np.ndarray) -> np.ndarray:
+        """
+        The area under ROC curve from Mann-Whitney U statistic, for several actual columns at once
+        :param ranks: the average ranks of the predictor (see _average_ranks)
+        :param actual: the actual values (stories x actual columns), all known
+        :return: the areas, 0 if there are no actual positives or negatives (as in roc_auc)
+        """
+        _positives = actual.sum(axis=0).astype(np.float64)
+        _negatives = len(ranks) - _positives
+        _u = ranks @ actual - _positives * (_positives + 1) / 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(_positives * _negatives > 0, _u / (_positives * _negatives), 0.0)
+
+    def predictors_report(self, predictor_cols: list[Column], actual_cols: list[Column]) -> pd.DataFrame:
+        """
+        Batch evaluation of several predictors against several actual columns: the columns are read at once, every
+        predictor is filtered and ranked once and the area under ROC curve is calculated for all actual columns from
+        the rank-sum (Mann-Whitney U) statistic, which equals the exact roc_auc
+        :param predictor_cols: the predictors
+        :param actual_cols: the actual columns
+        :return: single row (indexed by the code-name of the source) with the mean, median, stddev and count of valid
+        values of every predictor and the ROC AUC of every pair, named as in the predictors report
+        """
+        _actual_names = [_actual_col.name for _actual_col in actual_cols]
+        self._projection([_predictor_col.name for _predictor_col in predictor_cols] +
+                         [PaymentStoriesColumns.PaymentsCount.name] + _actual_names)
+        _row = {}
+        for _predictor_col in predictor_cols:
+            _filtered = self._projection(
+                [_predictor_col.name, PaymentStoriesColumns.PaymentsCount.name] + _actual_names
+            ).filter(self._predictor_filter(_predictor_col.name))
+            _predictor = _filtered.column(_predictor_col.name)
+            _row[StoriesPerformanceReportColNames.PredictorMean(_predictor_col)] = pc.mean(_predictor).as_py()
+            _row[StoriesPerformanceReportColNames.PredictorMedian(_predictor_col)] = \
+                pc.approximate_median(_predictor).as_py()
+            _row[StoriesPerformanceReportColNames.PredictorStddev(_predictor_col)] = pc.stddev(_predictor).as_py()
+            _row[StoriesPerformanceReportColNames.PredictorCountValid(_predictor_col)] = pc.count(_predictor).as_py()
+
+            _values = _predictor.to_numpy()
+            _known = [pc.is_valid(_filtered.column(_name)).to_numpy(zero_copy_only=False) for _name in _actual_names]
+            _actual = [_filtered.column(_name).to_numpy(zero_copy_only=False) for _name in _actual_names]
+            _all_known = [bool(np.all(_k)) for _k in _known]
+            _aucs = {}
+            if any(_all_known):
+                # one ranking shared by all actual columns known for every story
+                _shared = [_i for _i, _k in enumerate(_all_known) if _k]
+                _shared_aucs = self._rank_sum_aucs(
+                    self._average_ranks(_values),
+                    np.column_stack([_actual[_i].astype(np.float64) for _i in _shared]))
+                _aucs.update(zip(_shared, _shared_aucs))
+            for _i in [_i for _i, _k in enumerate(_all_known) if not _k]:
+                _aucs[_i] = self._rank_sum_aucs(
+                    self._average_ranks(_values[_known[_i]]),
+                    _actual[_i][_known[_i]].astype(np.float64)[:, np.newaxis])[0]
+            for _i, _actual_col in enumerate(actual_cols):
+                _row[StoriesPerformanceReportColNames.PredictorPerformanceROCAUC(_predictor_col, _actual_col)] = \
+                    float(_aucs[_i])
+        return pd.DataFrame({_name: [_value] for _name, _value in _row.items()}, index=[self.source_codename])
+
+    def _group_codes(self, group_col: str, bins: Optional[list[float]]) -> tuple[np.ndarray, list]:
+        """
+        :param group_col: the column the stories are grouped by
+        :param bins: if provided, the (ascending) edges of buckets of numeric group column
+        :return: the group of every story and the label of every group (None for the stories without the value;
+        the lower edge of the bucket if bucketed, -inf for the values below the first edge)
+        """
+        _column = self._column(group_col)
+        if bins is None:
+            _encoded = pc.dictionary_encode(_column, null_encoding='encode').combine_chunks()
+            # the groups ordered by their values (the dictionary is in the order of appearance)
+            _order = pc.array_sort_indices(_encoded.dictionary, null_placement='at_end').to_numpy()
+            _ranks = np.empty(len(_order), dtype=np.int64)
+            _ranks[_order] = np.arange(len(_order))
+            return _ranks[_encoded.indices.to_numpy(zero_copy_only=False)], \
+                _encoded.dictionary.take(pa.array(_order)).to_pylist()
+        _values = np.asarray(_column.to_numpy(), dtype=np.float64)
+        _missing = pc.is_null(_column, nan_is_null=True).to_numpy(zero_copy_only=False)
+        return np.where(_missing, len(bins) + 1, np.digitize(np.where(_missing, 0.0, _values), bins)), \
+            [-math.inf] + list(bins) + [None]
+
+    @staticmethod
+    def _grouped_metrics(codes: np.ndarray, values: np.ndarray,
+                         actual: np.ndarray) -> dict[str, np.ndarray]:
+        """
+        The exact ROC AUC, F1-max (with its threshold, see f1_max) and average precision of every group, from a single
+        sort by (group, predictor descending) and cumulative counts restarted at every group
+        :param codes: the group of every story
+        :param values: the predictor of every story
+        :param actual: the actual value of every story (all known)
+        :return: the metrics of the groups with at least one story, aligned with the 'group' (code)
+        """
+        _order = np.lexsort((-values, codes))
+        _codes = codes[_order]
+        _values = values[_order]
+        # the runs of equal values of a group are predicted together (see _ranking)
+        _run_starts = np.flatnonzero(np.concatenate([[True], (_codes[1:] != _codes[:-1]) |
+                                                     (_values[1:] != _values[:-1])]))
+        _run_positives = np.add.reduceat(actual[_order].astype(np.int64), _run_starts)
+        _run_negatives = np.diff(np.append(_run_starts, len(_values))) - _run_positives
+        _run_codes = _codes[_run_starts]
+        _group_first = np.concatenate([[True], _run_codes[1:] != _run_codes[:-1]])
+        _group_starts = np.flatnonzero(_group_first)
+        _run_groups = np.cumsum(_group_first) - 1
+
+        # the positives (negatives) of the group with the predictor greater or equal to the value of the run
+        _tp = np.cumsum(_run_positives)
+        _fp = np.cumsum(_run_negatives)
+        _tp = _tp - (_tp - _run_positives)[_group_starts][_run_groups]
+        _fp = _fp - (_fp - _run_negatives)[_group_starts][_run_groups]
+        _p = np.add.reduceat(_run_positives, _group_starts)
+        _n = np.add.reduceat(_run_negatives, _group_starts)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _auc = np.where(_p * _n > 0,
+                            np.add.reduceat(_run_negatives * (_tp - _run_positives / 2), _group_starts) / (_p * _n),
+                            0.0)
+            _ap = np.where(_p > 0, np.add.reduceat(_run_positives * _tp / (_tp + _fp), _group_starts) / _p, np.nan)
+            _f1 = np.where(_tp > 0, 2 * _tp / (_tp + _fp + _p[_run_groups]), -1.0)
+        _f1_max = np.maximum.reduceat(_f1, _group_starts)
+        # the first threshold (ascending) reaching the maximum is the last run (descending) reaching it, the threshold
+        # is the next lower value of the group (-inf for the lowest one)
+        _runs = np.arange(len(_run_starts))
+        _best = np.maximum.reduceat(np.where(_f1 == _f1_max[_run_groups], _runs, -1), _group_starts)
+        _next = np.minimum(_best + 1, len(_runs) - 1)
+        _threshold = np.where((_best + 1 < len(_runs)) & (_run_groups[_next] == _run_groups[_best]),
+                              _values[_run_starts][_next].astype(np.float64), -np.inf)
+        return {
+            'group': _run_codes[_group_starts],
+            'stories': _p + _n,
+            'positives': _p,
+            'roc_auc': _auc,
+            'f1_max': np.where(_f1_max > 0, _f1_max, np.nan),
+            'f1_max_threshold': _threshold,
+            'pr_auc': _ap
+        }
+
+    def grouped_report(self, group_col: str, predictor_cols: list[Column], actual_cols: list[Column],
+                       bins: list[float] = None) -> pd.DataFrame:
+        """
+        Evaluation of predictors per group of stories (e.g. per credit status or bucket of story length): every
+        predictor is sorted once by the group and its value, the metrics of all groups follow from the cumulative
+        counts restarted at every group, so the stories are not filtered per group
+        :param group_col: the column the stories are grouped by
+        :param predictor_cols: the predictors
+        :param actual_cols: the actual columns
+        :param bins: if provided, the numeric group column is bucketed by the (ascending) edges
+        :return: tidy table, one row per group, predictor and actual column with the count of stories and positives,
+        ROC AUC, F1-max with its threshold and average precision (PR AUC), NaN where undefined
+        """
+        _codes, _labels = self._group_codes(group_col, bins)
+        _actual_names = [_actual_col.name for _actual_col in actual_cols]
+        _group_name = '__group'
+        _rows = []
+        for _predictor_col in predictor_cols:
+            _filtered = self._projection(
+                [_predictor_col.name, PaymentStoriesColumns.PaymentsCount.name] + _actual_names
+            ).append_column(_group_name, pa.array(_codes)).filter(self._predictor_filter(_predictor_col.name))
+            _values = _filtered.column(_predictor_col.name).to_numpy()
+            _groups = _filtered.column(_group_name).to_numpy()
+            for _actual_col in actual_cols:
+                _known = pc.is_valid(_filtered.column(_actual_col.name)).to_numpy(zero_copy_only=False)
+                if not np.any(_known):
+                    continue
+                _actual = _filtered.column(_actual_col.name).to_numpy(zero_copy_only=False)[_known].astype(bool)
+                _metrics = self._grouped_metrics(_groups[_known], _values[_known], _actual)
+                _metrics['group'] = [_labels[_code] for _code in _metrics['group']]
+                _rows.append(pd.DataFrame({
+                    group_col: _metrics.pop('group'),
+                    'predictor': _predictor_col.name,
+                    'actual': _actual_col.name,
+                    **_metrics
+                }))
+        return pd.concat(_rows, ignore_index=True) if len(_rows) > 0 else pd.DataFrame(
+            columns=[group_col, 'predictor', 'actual', 'stories', 'positives', 'roc_auc', 'f1_max',
+                     'f1_max_threshold', 'pr_auc'])
+
     def f1_score(self, predictor_col: str, threshold: float, actual_col: str) -> float:
         _p = self.precision(predictor_col, threshold, actual_col)
         _r = self.recall(predictor_col, threshold, actual_col)
         return None if _p is None or _r is None or _p + _r == 0 else 2 * _p * _r / (_p + _r)
 
+    def _f1_scores(self, predictor_col: str, thresholds: list[float], actual_col: str) -> np.ndarray:
+        """
+        :return: the F1 scores for all thresholds, NaN where undefined (None in f1_score)
+        """
+        _tp, _fn, _fp, _tn = self.confusion_matrices(predictor_col, thresholds, actual_col)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _precision = np.where(_tp + _fp > 0, _tp / (_tp + _fp), np.nan)
+            _recall = np.where(_tp + _fn > 0, _tp / (_tp + _fn), 0.0)
+            return np.where(_precision + _recall > 0, 2 * _precision * _recall / (_precision + _recall), np.nan)
+
+    def _accuracies(self, predictor_col: str, thresholds: list[float], actual_col: str) -> np.ndarray:
+        """
+        :return: the accuracies for all thresholds, NaN where undefined (None in accuracy)
+        """
+        _tp, _fn, _fp, _tn = self.confusion_matrices(predictor_col, thresholds, actual_col)
+        _all = _tp + _fn + _fp + _tn
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(_all > 0, (_tp + _tn) / _all, np.nan)
+
+    def _cohen_kappas(self, predictor_col: str, thresholds: list[float], actual_col: str) -> np.ndarray:
+        _p_random = self.risk_rate(actual_col)
+        return (self._accuracies(predictor_col, thresholds, actual_col) - _p_random) / (1 - _p_random)
+
+    @staticmethod
+    def _first_max(scores: np.ndarray, thresholds: list[float]) -> tuple[Optional[float], float]:
+        """
+        :return: the maximal score (None if no score is defined) and the first threshold reaching it
+        """
+        if np.all(np.isnan(scores)):
+            return None, thresholds[0]
+        _i = int(np.nanargmax(scores))
+        return float(scores[_i]), float(thresholds[_i])
+
     def f1_curve(self, predictor_col: str, actual_col: str, threshold_min: float = None,
                  threshold_max: float = None, steps: int = 100) -> pd.DataFrame:
-        if threshold_min is None:
-            threshold_min = self._default_threshold_min(predictor_col)
-        if threshold_max is None:
-            threshold_max = self._default_threshold_max(predictor_col)
-
-        _thresholds = [threshold_min + _i*(threshold_max - threshold_min)/steps for _i in range(steps+1)]
-        f1s = [self.f1_score(predictor_col=predictor_col, threshold=_th, actual_col=actual_col) for _th in _thresholds]
-        return pd.DataFrame({"F1 Score": f1s}, index=_thresholds)
+        _thresholds = self._thresholds(predictor_col, threshold_min, threshold_max, steps)
+        return pd.DataFrame({"F1 Score": self._f1_scores(predictor_col, _thresholds, actual_col)}, index=_thresholds)
 
     def f1_max(self, predictor_col: str, actual_col: str, threshold_min: float = None,
-               threshold_max: float = None, min_precision=0.001) -> tuple[float, float]:
+               threshold_max: float = None, min_precision=0.001,
+               exact: bool = False) -> tuple[float, float]:
+        """
+        :param exact: if True, the maximum over all distinct values of the predictor (see _exact_thresholds)
+        found in a single pass, instead of the grid narrowed down to min_precision (the range is ignored);
+        the threshold is the observed value the predictor has to be greater than (-inf for all stories)
+        """
+        if exact:
+            _thresholds = self._exact_thresholds(predictor_col, actual_col)
+            return self._first_max(self._f1_scores(predictor_col, _thresholds, actual_col), _thresholds)
         if threshold_min is None:
             threshold_min = self._default_threshold_min(predictor_col)
         if threshold_max is None:
@@ -224,22 +605,15 @@ class PaymentStoriesPerformanceEvaluator:
         _steps = 100
         _step = (threshold_max - threshold_min) / _steps
         _thresholds = [threshold_min + _i*_step for _i in range(_steps+1)]
-        f1s = [(self.f1_score(predictor_col, _th, actual_col), _th) for _th in _thresholds]
-        f1m = f1s[0][0]
-        thm = f1s[0][1]
-        for f1, th in f1s:
-            if f1 is not None and f1 > f1m:
-                f1m = f1
-                thm = th
+        f1m, thm = self._first_max(self._f1_scores(predictor_col, _thresholds, actual_col), _thresholds)
         if _step <= min_precision:
             return f1m, thm
         return self.f1_max(predictor_col, actual_col, thm, thm+_step, min_precision)
 
     def accuracy_curve(self, predictor_col: str, threshold_min: float, threshold_max: float,
                        steps: int, actual_col: str) -> pd.DataFrame:
-        _thresholds = [threshold_min + _i*(threshold_max - threshold_min)/steps for _i in range(steps+1)]
-        f1s = [self.accuracy(predictor_col=predictor_col, threshold=_th, actual_col=actual_col) for _th in _thresholds]
-        return pd.DataFrame({"Accuracy": f1s}, index=_thresholds)
+        _thresholds = self._thresholds(predictor_col, threshold_min, threshold_max, steps)
+        return pd.DataFrame({"Accuracy": self._accuracies(predictor_col, _thresholds, actual_col)}, index=_thresholds)
 
     def cohen_kappa(self, predictor_col: str, threshold: float, actual_col: str) -> float:
         _p = self.accuracy(predictor_col, threshold, actual_col)
@@ -248,20 +622,21 @@ class PaymentStoriesPerformanceEvaluator:
 
     def cohen_kappa_curve(self, predictor_col: str, actual_col: str, threshold_min: float = None,
                           threshold_max: float = None, steps: int = 100) -> pd.DataFrame:
-        if threshold_min is None:
-            threshold_min = self._default_threshold_min(predictor_col)
-        if threshold_max is None:
-            threshold_max = self._default_threshold_max(predictor_col)
-
-        _thresholds = [threshold_min + _i*(threshold_max - threshold_min)/steps for _i in range(steps+1)]
-        cp = [
-            self.cohen_kappa(predictor_col=predictor_col, threshold=_th, actual_col=actual_col)
-            for _th in _thresholds
-        ]
-        return pd.DataFrame({"Cohen-Kappa": cp}, index=_thresholds)
+        _thresholds = self._thresholds(predictor_col, threshold_min, threshold_max, steps)
+        return pd.DataFrame({"Cohen-Kappa": self._cohen_kappas(predictor_col, _thresholds, actual_col)},
+                            index=_thresholds)
 
     def cohen_kappa_max(self, predictor_col: str, actual_col: str, threshold_min: float = None,
-                        threshold_max: float = None, min_precision=0.001) -> tuple[float, float]:
+                        threshold_max: float = None, min_precision=0.001,
+                        exact: bool = False) -> tuple[float, float]:
+        """
+        :param exact: if True, the maximum over all distinct values of the predictor (see _exact_thresholds)
+        found in a single pass, instead of the grid narrowed down to min_precision (the range is ignored);
+        the threshold is the observed value the predictor has to be greater than (-inf for all stories)
+        """
+        if exact:
+            _thresholds = self._exact_thresholds(predictor_col, actual_col)
+            return self._first_max(self._cohen_kappas(predictor_col, _thresholds, actual_col), _thresholds)
         if threshold_min is None:
             threshold_min = self._default_threshold_min(predictor_col)
         if threshold_max is None:
@@ -270,13 +645,7 @@ class PaymentStoriesPerformanceEvaluator:
         _steps = 100
         _step = (threshold_max - threshold_min) / _steps
         _thresholds = [threshold_min + _i*_step for _i in range(_steps+1)]
-        cps = [(self.cohen_kappa(predictor_col, _th, actual_col), _th) for _th in _thresholds]
-        cpm = cps[0][0]
-        thm = cps[0][1]
-        for cp, th in cps:
-            if cp > cpm:
-                cpm = cp
-                thm = th
+        cpm, thm = self._first_max(self._cohen_kappas(predictor_col, _thresholds, actual_col), _thresholds)
         if _step <= min_precision:
             return cpm, thm
         return self.cohen_kappa_max(predictor_col, actual_col, thm, thm+_step, min_precision)
@@ -0,0 +1,236 @@
+"""
+Scoring of single entities: the latest payment story of an entity, the risk predicted from its features
+(each predictor compared with its threshold, the way DenotesAnyRisk is compared with the actual debts)
+and the payments of a story. The stories and the payments are kept in Arrow IPC files ordered by entity
+(and by story, respectively), memory-mapped at startup; a lookup is a binary search in the offset index
+followed by a zero-copy slice, so it takes microseconds and does not depend on the size of the source.
+"""
+from lib.input_const import *
+from lib.storyindex import OffsetIndex
+from lib.util import is_up_to_date, read_with_sidecar, sort_if_needed
+
+import datetime
+import json
+import math
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyarrow as pa
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+# the predictors evaluated by 411_evaluating_performance
+PREDICTOR_COLUMNS = [
+    PaymentStoriesColumns.ScaledDelayMean,
+    PaymentStoriesColumns.SeverityMean,
+    PaymentStoriesColumns.TendencyCoefficient_ForDelay,
+    PaymentStoriesColumns.TendencyCoefficient_ForSeverity,
+    PaymentStoriesColumns.Tendency_ForDelay,
+    PaymentStoriesColumns.Tendency_ForSeverity,
+    PaymentStoriesColumns.TendencyMinusMean_ForDelay,
+    PaymentStoriesColumns.TendencyMinusMean_ForSeverity
+]
+
+# the payment columns served with a story
+PAYMENT_COLUMNS = [
+    PaymentGroupsColumns.StoryId.name,
+    PaymentGroupsColumns.Id.name,
+    PaymentGroupsColumns.DueDate.name,
+    PaymentGroupsColumns.DelayDays.name,
+    PaymentGroupsColumns.InvoicedAmount.name,
+    PaymentGroupsColumns.DelayDaysScaled.name,
+    PaymentGroupsColumns.Severity.name,
+    PaymentGroupsColumns.StoryTimeline.name
+]
+
+PREDICTION_SUFFIX = '_above_threshold'
+
+
+def thresholds_from_report(input_code: str, codename: str, actual_col: Column) -> dict[str, float]:
+    """
+    The thresholds maximizing F1 score of the predictors of the source (see 411_evaluating_performance)
+    :param input_code: the input-code of the report
+    :param codename: the code-name of the source
+    :param actual_col: the actual risk the thresholds were tuned for (DenotesAnyRisk or DenotesSignificantRisk)
+    :return: the thresholds per predictor column, empty if the source is not in the report
+    """
+    _report = pd.read_csv(report_predictors(input_code), index_col=0)
+    if codename not in _report.index:
+        return {}
+    _thresholds = {}
+    for _predictor_col in PREDICTOR_COLUMNS:
+        _col = StoriesPerformanceReportColNames.PredictorPerformanceF1ScoreMaxTh(_predictor_col, actual_col)
+        if _col in _report.columns and not pd.isna(_report.loc[codename, _col]):
+            _thresholds[_predictor_col.name] = float(_report.loc[codename, _col])
+    return _thresholds
+
+
+def _write_arrow(table: pa.Table, file: Path):
+    with pa.OSFile(str(file), 'wb') as _sink:
+        with pa.ipc.new_file(_sink, table.schema) as _writer:
+            _writer.write_table(table)
+
+
+def _map_arrow(file: Path) -> pa.Table:
+    # zero-copy: the buffers of the table point into the mapped file
+    return pa.ipc.open_file(pa.memory_map(str(file), 'r')).read_all()
+
+
+def prepare_scoring_files(input_code: str, codename: str) -> tuple[Path, Optional[Path]]:
+    """
+    Writes the Arrow IPC copies of stories and payments for the scoring service, unless they are up-to-date
+    :return: the stories file and the payments file (None if there are no grouped payments, e.g. for stories
+    updated incrementally)
+    """
+    _stories_source = payment_stories_file(input_code, codename)
+    _stories_file = scoring_stories_file(input_code, codename)
+    if not is_up_to_date(_stories_file, [_stories_source]):
+        _write_arrow(pq.read_table(_stories_source).sort_by([
+            (PaymentStoriesColumns.EntityId.name, 'ascending'), (PaymentStoriesColumns.StoryId.name, 'ascending')
+        ]), _stories_file)
+
+    _payments_sources = [payments_grouped_by_stories_file(input_code, codename),
+                         payments_derived_file(input_code, codename)]
+    if not all(_source.exists() for _source in _payments_sources):
+        return _stories_file, None
+    _payments_file = scoring_payments_file(input_code, codename)
+    if not is_up_to_date(_payments_file, _payments_sources):
+        # the story-id is the pd-id of the last payment of the story, so the order by pd-id is the order by story
+        _write_arrow(sort_if_needed(read_with_sidecar(*_payments_sources, columns=PAYMENT_COLUMNS),
+                                    PaymentGroupsColumns.Id.name), _payments_file)
+    return _stories_file, _payments_file
+
+
+class RiskScoringService:
+
+    def __init__(self, input_code: str, codename: str, thresholds: dict[str, float] = None):
+        """
+        :param input_code: the input-code of the stories
+        :param codename: the code-name of the source
+        :param thresholds: the thresholds of predictor columns, the risk is predicted if the predictor is above
+        (see thresholds_from_report)
+        """
+        self.source_codename = codename
+        self._thresholds = {} if thresholds is None else thresholds
+        _stories_file, _payments_file = prepare_scoring_files(input_code, codename)
+        self._stories = _map_arrow(_stories_file)
+        self._entities = OffsetIndex.of(self._stories.column(PaymentStoriesColumns.EntityId.name))
+        self._payments: Optional[pa.Table] = None
+        self._stories_payments: Optional[OffsetIndex] = None
+        if _payments_file is not None:
+            self._payments = _map_arrow(_payments_file)
+            self._stories_payments = OffsetIndex.of(self._payments.column(PaymentGroupsColumns.StoryId.name))
+
+    def thresholds(self) -> dict[str, float]:
+        return self._thresholds
+
+    def entity_stories(self, entity_id: int) -> pa.Table:
+        """
+        :return: all stories of the entity, ordered by story-id
+        """
+        _range = self._entities.range(entity_id)
+        return self._stories.slice(0, 0) if _range is None else self._stories.slice(_range[0], _range[1] - _range[0])
+
+    def latest_stories(self, entity_ids: list[int]) -> pa.Table:
+        """
+        :return: the latest story of every entity, in the order of entities (null row if the entity is unknown)
+        """
+        _, _ends, _found = self._entities.ranges(np.asarray(entity_ids, dtype=np.int64))
+        return self._stories.take(pa.array(_ends - 1, pa.int64(), mask=~_found))
+
+    def predictions(self, stories: pa.Table) -> pa.Table:
+        """
+        :param stories: the stories (e.g. the latest stories of entities)
+        :return: for every predictor with threshold, whether it predicts the risk (null if the predictor is undefined)
+        """
+        _predictions = {}
+        for _predictor, _threshold in self._thresholds.items():
+            _values = stories.column(_predictor)
+            _predictions[_predictor + PREDICTION_SUFFIX] = pc.if_else(
+                pc.is_nan(_values), pa.scalar(None, pa.bool_()), pc.greater(_values, _threshold)
+            )
+        return pa.table(_predictions) if len(_predictions) > 0 else stories.select([])
+
+    def score(self, entity_ids: list[int]) -> pa.Table:
+        """
+        Batched lookup: the latest story of every entity together with the predictions
+        """
+        _stories = self.latest_stories(entity_ids)
+        _predictions = self.predictions(_stories)
+        for _name in _predictions.column_names:
+            _stories = _stories.append_column(_name, _predictions.column(_name))
+        return _stories
+
+    def story_payments(self, story_id: int) -> pa.Table:
+        """
+        :return: the payments of the story (with derived columns), ordered by pd-id
+        """
+        if self._payments is None:
+            raise ValueError(f'No grouped payments of source {self.source_codename} available')
+        _range = self._stories_payments.range(story_id)
+        return self._payments.slice(0, 0) if _range is None \
+            else self._payments.slice(_range[0], _range[1] - _range[0])
+
+
+def _json_value(value):
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def _json_rows(table: pa.Table) -> list[dict]:
+    return [{_k: _json_value(_v) for _k, _v in _row.items()} for _row in table.to_pylist()]
+
+
+def serve(service: RiskScoringService, host: str = '127.0.0.1', port: int = 8765):
+    """
+    Local HTTP stand-in of the scoring service, answers with JSON:
+    GET /entities/<entity-id> - the latest story of the entity with predictions
+    GET /entities?ids=<entity-id>,<entity-id>,... - the same for several entities (null if unknown)
+    GET /entities/<entity-id>/stories - all stories of the entity
+    GET /stories/<story-id>/payments - the payments of the story
+    """
+    class _Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, status: int, content):
+            _body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(_body)))
+            self.end_headers()
+            self.wfile.write(_body)
+
+        def do_GET(self):
+            _url = urlparse(self.path)
+            _path = _url.path.strip('/').split('/')
+            try:
+                if _path == ['entities']:
+                    _ids = [int(_id) for _id in parse_qs(_url.query).get('ids', [''])[0].split(',') if _id != '']
+                    _scored = _json_rows(service.score(_ids))
+                    self._reply(200, [None if _row[PaymentStoriesColumns.StoryId.name] is None else _row
+                                      for _row in _scored])
+                elif len(_path) == 2 and _path[0] == 'entities':
+                    _scored = _json_rows(service.score([int(_path[1])]))[0]
+                    if _scored[PaymentStoriesColumns.StoryId.name] is None:
+                        self._reply(404, {'error': f'Unknown entity {_path[1]}'})
+                    else:
+                        self._reply(200, _scored)
+                elif len(_path) == 3 and _path[0] == 'entities' and _path[2] == 'stories':
+                    self._reply(200, _json_rows(service.entity_stories(int(_path[1]))))
+                elif len(_path) == 3 and _path[0] == 'stories' and _path[2] == 'payments':
+                    self._reply(200, _json_rows(service.story_payments(int(_path[1]))))
+                else:
+                    self._reply(404, {'error': f'Unknown resource {_url.path}'})
+            except ValueError as _e:
+                self._reply(400, {'error': str(_e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    ThreadingHTTPServer((host, port), _Handler).serve_forever()
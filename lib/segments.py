@@ -0,0 +1,143 @@
+"""
+Aggregation over segments: the table is ordered so that all records of a group are contiguous,
+the group boundaries are detected once and the aggregates are computed by numpy segment reductions
+(ufunc.reduceat), the per-group values are broadcast back to the records without a join
+"""
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from typing import Optional, Union
+
+from lib.util import is_sorted
+
+Column = Union[pa.Array, pa.ChunkedArray]
+
+
+class Segments:
+
+    FUNCTIONS = ['count', 'sum', 'mean', 'min', 'max', 'min_max', 'variance']
+
+    def __init__(self, keys: Column):
+        """
+        :param keys: the group keys, the records of a group must be contiguous (use segments_if_sorted)
+        """
+        _keys = keys.to_numpy()
+        self.num_rows = len(_keys)
+        self._starts = np.concatenate([[0], np.flatnonzero(np.diff(_keys)) + 1]) if self.num_rows > 0 \
+            else np.array([], dtype=np.int64)
+        self._lengths = np.diff(np.append(self._starts, self.num_rows))
+        self._keys = keys.take(pa.array(self._starts, pa.int64()))
+        self._record_segment: Optional[pa.Array] = None
+
+    def __len__(self):
+        return len(self._starts)
+
+    def keys(self) -> Column:
+        return self._keys
+
+    def lengths(self) -> np.ndarray:
+        return self._lengths
+
+    def _values(self, values: Column, fill) -> tuple[np.ndarray, Optional[np.ndarray]]:
+        # numpy view of the values with nulls replaced (by the neutral element of the reduction)
+        # and the numbers of valid values per segment (None if there are no nulls)
+        if values.null_count == 0:
+            return values.to_numpy(), None
+        _valid = pc.is_valid(values).to_numpy(zero_copy_only=False)
+        return pc.fill_null(values, fill).to_numpy(), np.add.reduceat(_valid, self._starts)
+
+    @staticmethod
+    def _with_nulls(result: np.ndarray, valid: Optional[np.ndarray], otype: pa.DataType) -> pa.Array:
+        return pa.array(result, otype, mask=None if valid is None else valid == 0)
+
+    def count(self, values: Column) -> pa.Array:
+        if values.null_count == 0:
+            return pa.array(self._lengths, pa.int64())
+        return pa.array(np.add.reduceat(pc.is_valid(values).to_numpy(zero_copy_only=False), self._starts), pa.int64())
+
+    def sum(self, values: Column) -> pa.Array:
+        _otype = pa.float64() if pa.types.is_floating(values.type) else \
+            pa.uint64() if pa.types.is_unsigned_integer(values.type) else pa.int64()
+        _values, _valid = self._values(pc.cast(values, _otype), 0)
+        return self._with_nulls(np.add.reduceat(_values, self._starts), _valid, _otype)
+
+    def mean(self, values: Column) -> pa.Array:
+        _values, _valid = self._values(pc.cast(values, pa.float64()), 0.0)
+        _counts = self._lengths if _valid is None else _valid
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._with_nulls(np.add.reduceat(_values, self._starts) / _counts, _valid, pa.float64())
+
+    def _extreme(self, values: Column, ufunc: np.ufunc, fill_attr: str) -> pa.Array:
+        # temporal values are reduced as their integer representation
+        _storage = pa.int32() if values.type == pa.date32() else pa.int64() if pa.types.is_temporal(values.type) \
+            else values.type
+        _storage_values = values.cast(_storage) if _storage != values.type else values
+        _info = np.finfo if pa.types.is_floating(_storage) else np.iinfo
+        _fill = getattr(_info(_storage.to_pandas_dtype()), fill_attr)
+        _values, _valid = self._values(_storage_values, pa.scalar(_fill, _storage))
+        return self._with_nulls(ufunc.reduceat(_values, self._starts), _valid, _storage).cast(values.type)
+
+    def min(self, values: Column) -> pa.Array:
+        return self._extreme(values, np.minimum, 'max')
+
+    def max(self, values: Column) -> pa.Array:
+        return self._extreme(values, np.maximum, 'min')
+
+    def min_max(self, values: Column) -> pa.StructArray:
+        return pa.StructArray.from_arrays([self.min(values), self.max(values)], names=['min', 'max'])
+
+    def variance(self, values: Column) -> pa.Array:
+        """
+        Population variance (ddof=0), two-pass: the distances are taken to the mean of the segment
+        """
+        _distances = pc.subtract(pc.cast(values, pa.float64()), self.broadcast(self.mean(values)))
+        return pc.divide(self.sum(pc.multiply(_distances, _distances)), pc.cast(self.count(values), pa.float64()))
+
+    def first(self, values: Column) -> Column:
+        """
+        :return: the value of the first record of every segment (null if that value is null)
+        """
+        return values.take(pa.array(self._starts, pa.int64()))
+
+    def last(self, values: Column) -> Column:
+        """
+        :return: the value of the last record of every segment (null if that value is null)
+        """
+        return values.take(pa.array(self._starts + self._lengths - 1, pa.int64()))
+
+    def aggregate(self, table: pa.Table, by: str, agg: list[tuple]) -> pa.Table:
+        """
+        The equivalent of table.group_by(by).aggregate(agg), the groups are in order of the segments
+        :param table: the table whose records are aligned with the keys the segments were detected from
+        :param by: the name of the key column in the result
+        :param agg: the aggregations (column, function), functions listed in FUNCTIONS are supported
+        """
+        if table.num_rows != self.num_rows:
+            raise ValueError(f'The table has {table.num_rows} records, the segments were detected on {self.num_rows}')
+        _columns = {by: self._keys}
+        for _column, _function in agg:
+            if _function not in self.FUNCTIONS:
+                raise ValueError(f'The aggregation function {_function} is not supported, possible: {self.FUNCTIONS}')
+            _columns[f'{_column}_{_function}'] = getattr(self, _function)(table.column(_column))
+        return pa.table(_columns)
+
+    def broadcast(self, values: Column) -> Column:
+        """
+        Repeats the value of every segment for all records of the segment
+        :param values: one value per segment
+        :return: one value per record
+        """
+        if self._record_segment is None:
+            self._record_segment = pa.array(np.repeat(np.arange(len(self._starts)), self._lengths), pa.int64())
+        return values.take(self._record_segment)
+
+
+def segments_if_sorted(keys: Column) -> Optional[Segments]:
+    """
+    :param keys: the group keys
+    :return: the segments if the keys are ordered (so the groups are contiguous), None otherwise
+    """
+    if keys.null_count > 0 or not is_sorted(keys):
+        return None
+    return Segments(keys)
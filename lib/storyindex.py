@@ -0,0 +1,248 @@
+"""
+Random access to the payments of a single story (or entity) without reading the whole file of grouped payments.
+The grouped payments are ordered by pd-id, the story-id is the pd-id of the last payment of the story and the stories
+of an entity follow each other, hence the payments of a story (and of an entity) are a contiguous range of rows.
+The offset index keeps the first row of every story and the first rows of the row-groups of the grouped payments
+and of their sidecar, so a lookup is a binary search followed by reading the row-group(s) covering the range.
+"""
+from lib.input_const import *
+from lib.util import is_up_to_date
+
+import json
+
+import numpy as np
+import pyarrow.parquet as pq
+import pyarrow as pa
+
+from typing import Optional, Union
+
+ROW_GROUPS_METADATA_KEY = b'row_groups'
+
+
+class OffsetIndex:
+    """
+    Maps the keys of a table ordered by the key to the ranges of its rows
+    """
+
+    def __init__(self, keys: np.ndarray, offsets: np.ndarray):
+        """
+        :param keys: the distinct keys, ascending
+        :param offsets: the first row of every key, followed by the number of rows
+        """
+        self._keys = keys
+        self._offsets = offsets
+
+    @staticmethod
+    def of(column: Union[pa.Array, pa.ChunkedArray]) -> 'OffsetIndex':
+        """
+        :param column: the key column, ascending
+        """
+        _keys = column.to_numpy()
+        if len(_keys) > 1 and np.any(_keys[1:] < _keys[:-1]):
+            raise ValueError('The keys are not ordered, the offset index can not be built')
+        _starts = np.flatnonzero(np.diff(_keys)) + 1 if len(_keys) > 0 else np.array([], dtype=np.int64)
+        return OffsetIndex(
+            _keys[np.concatenate([[0], _starts])] if len(_keys) > 0 else _keys,
+            np.concatenate([[0], _starts, [len(_keys)]]).astype(np.int64) if len(_keys) > 0
+            else np.array([0], dtype=np.int64)
+        )
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self) -> np.ndarray:
+        return self._keys
+
+    def offsets(self) -> np.ndarray:
+        return self._offsets
+
+    def range(self, key) -> Optional[tuple[int, int]]:
+        """
+        :return: the (first, last exclusive) rows of the key, None if the key is not present
+        """
+        _i = int(np.searchsorted(self._keys, key))
+        if _i == len(self._keys) or self._keys[_i] != key:
+            return None
+        return int(self._offsets[_i]), int(self._offsets[_i + 1])
+
+    def ranges(self, keys: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: the first rows, the last rows (exclusive) and the mask of keys present
+        """
+        _i = np.searchsorted(self._keys, keys)
+        _found = _i < len(self._keys)
+        _found[_found] = self._keys[_i[_found]] == keys[_found]
+        _i = np.where(_found, _i, 0)
+        return self._offsets[_i], self._offsets[_i + 1], _found
+
+
+def _row_group_offsets(file: Path) -> list[int]:
+    """
+    :return: the first row of every row-group of the parquet file, followed by the number of rows
+    """
+    _metadata = pq.read_metadata(file)
+    return np.cumsum([0] + [_metadata.row_group(_rg).num_rows for _rg in range(_metadata.num_row_groups)]).tolist()
+
+
+def _read_rows(file: Path, row_groups: np.ndarray, first: int, last: int, columns: list[str]) -> pa.Table:
+    """
+    Reads the range of rows, only the row-groups covering the range are read
+    :param row_groups: the first row of every row-group, followed by the number of rows (see _row_group_offsets)
+    :param first: the first row
+    :param last: the last row (exclusive)
+    """
+    if last <= first:
+        return pq.read_schema(file).empty_table().select(columns)
+    _first_rg = int(np.searchsorted(row_groups, first, side='right')) - 1
+    _last_rg = int(np.searchsorted(row_groups, last - 1, side='right')) - 1
+    return pq.ParquetFile(file).read_row_groups(list(range(_first_rg, _last_rg + 1)), columns=columns).slice(
+        first - int(row_groups[_first_rg]), last - first)
+
+
+class PaymentsIndex:
+    """
+    The offset index of the file with payments grouped by stories (story-id -> rows, entity-id -> stories)
+    together with the row-groups of the file and of its row-aligned sidecar with derived columns
+    """
+
+    def __init__(self, file: Path, sidecar: Path, index: pa.Table, row_groups: dict[str, list[int]]):
+        """
+        :param file: the file with grouped payments
+        :param sidecar: the sidecar with derived columns (see payments_derived_file), it does not have to exist
+        :param index: the first row of every story, ordered by story-id (see PaymentsIndexColumns)
+        :param row_groups: the first rows of the row-groups of the file and of the sidecar, by file name
+        """
+        self._file = file
+        self._sidecar = sidecar
+        self._index = index
+        self._row_groups = {_name: np.asarray(_offsets, dtype=np.int64) for _name, _offsets in row_groups.items()}
+        _rows = self._row_groups[file.name][-1]
+        self._stories = OffsetIndex(
+            index.column(PaymentsIndexColumns.StoryId.name).to_numpy(),
+            np.append(index.column(PaymentsIndexColumns.FirstRow.name).to_numpy().astype(np.int64), _rows)
+        )
+        # the rows of the index (the stories) by entity
+        self._entities = OffsetIndex.of(index.column(PaymentsIndexColumns.EntityId.name))
+
+    @staticmethod
+    def build(file: Path, sidecar: Path) -> 'PaymentsIndex':
+        """
+        Builds the index from the story-ids and entity-ids of the grouped payments (the other columns are not read)
+        :raise ValueError: if the payments are not ordered by story or the sidecar is not row-aligned
+        """
+        _keys = pq.read_table(file, columns=[PaymentGroupsColumns.StoryId.name, PaymentGroupsColumns.EntityId.name])
+        _stories = OffsetIndex.of(_keys.column(PaymentGroupsColumns.StoryId.name))
+        _first_rows = _stories.offsets()[:-1]
+        _index = pa.table({
+            PaymentsIndexColumns.StoryId.name: pa.array(_stories.keys(), PaymentsIndexColumns.StoryId.otype),
+            PaymentsIndexColumns.EntityId.name: _keys.column(PaymentGroupsColumns.EntityId.name).take(_first_rows),
+            PaymentsIndexColumns.FirstRow.name: pa.array(_first_rows, PaymentsIndexColumns.FirstRow.otype)
+        }, schema=storage_schema(PaymentsIndexColumns.Stored))
+
+        _row_groups = {file.name: _row_group_offsets(file)}
+        if sidecar.exists():
+            _row_groups[sidecar.name] = _row_group_offsets(sidecar)
+            if _row_groups[sidecar.name][-1] != _keys.num_rows:
+                raise ValueError(f'The sidecar {sidecar} ({_row_groups[sidecar.name][-1]} records) is not aligned '
+                                 f'with {file} ({_keys.num_rows} records)')
+        return PaymentsIndex(file, sidecar, _index, _row_groups)
+
+    @staticmethod
+    def read(index_file: Path, file: Path, sidecar: Path) -> 'PaymentsIndex':
+        _index = pq.read_table(index_file)
+        _row_groups = json.loads(_index.schema.metadata[ROW_GROUPS_METADATA_KEY])
+        return PaymentsIndex(file, sidecar, _index.replace_schema_metadata(None), _row_groups)
+
+    @staticmethod
+    def of(input_code: str, codename: str) -> 'PaymentsIndex':
+        """
+        The index of grouped payments of the source, read from the index file if it is up-to-date with both
+        the grouped payments and the sidecar, otherwise built (and written)
+        """
+        _file = payments_grouped_by_stories_file(input_code, codename)
+        _sidecar = payments_derived_file(input_code, codename)
+        _index_file = payments_index_file(input_code, codename)
+        if is_up_to_date(_index_file, [_file] + ([_sidecar] if _sidecar.exists() else [])):
+            return PaymentsIndex.read(_index_file, _file, _sidecar)
+        _index = PaymentsIndex.build(_file, _sidecar)
+        _index.write(_index_file)
+        return _index
+
+    def write(self, index_file: Path) -> Path:
+        pq.write_table(self._index.replace_schema_metadata({
+            ROW_GROUPS_METADATA_KEY: json.dumps({_name: _offsets.tolist()
+                                                 for _name, _offsets in self._row_groups.items()}).encode()
+        }), index_file)
+        return index_file
+
+    def __len__(self):
+        return len(self._stories)
+
+    def story_rows(self, story_id: int) -> Optional[tuple[int, int]]:
+        """
+        :return: the (first, last exclusive) rows of the payments of the story, None if the story is not present
+        """
+        return self._stories.range(story_id)
+
+    def entity_rows(self, entity_id: int) -> Optional[tuple[int, int]]:
+        """
+        :return: the (first, last exclusive) rows of the payments of the entity, None if the entity is not present
+        """
+        _range = self._entities.range(entity_id)
+        if _range is None:
+            return None
+        return int(self._stories.offsets()[_range[0]]), int(self._stories.offsets()[_range[1]])
+
+    def entity_story_ids(self, entity_id: int) -> np.ndarray:
+        """
+        :return: the story-ids of the entity, ascending (empty if the entity is not present)
+        """
+        _range = self._entities.range(entity_id)
+        return self._stories.keys()[:0] if _range is None else self._stories.keys()[_range[0]:_range[1]]
+
+    def read_rows(self, first: int, last: int, columns: list[str] = None) -> pa.Table:
+        """
+        Reads the range of rows of grouped payments; a sidecar column replaces the column of the same name
+        (see read_with_sidecar)
+        :param first: the first row
+        :param last: the last row (exclusive)
+        :param columns: the columns to read (from either file), if not provided all columns of both files
+        """
+        _base_names = pq.read_schema(self._file).names
+        _sidecar_names = pq.read_schema(self._sidecar).names if self._sidecar.name in self._row_groups else []
+        if columns is None:
+            columns = _base_names + [_c for _c in _sidecar_names if _c not in _base_names]
+        _table = _read_rows(self._file, self._row_groups[self._file.name], first, last,
+                            [_c for _c in columns if _c not in _sidecar_names])
+        _derived_names = [_c for _c in columns if _c in _sidecar_names]
+        if len(_derived_names) > 0:
+            _derived = _read_rows(self._sidecar, self._row_groups[self._sidecar.name], first, last, _derived_names)
+            for _c in _derived_names:
+                _table = _table.append_column(_derived.schema.field(_c), _derived.column(_c))
+        return _table.select(columns)
+
+    def story_payments(self, story_id: int, columns: list[str] = None) -> pa.Table:
+        """
+        :return: the payments of the story (empty if the story is not present), ordered by pd-id
+        """
+        _range = self.story_rows(story_id)
+        return self.read_rows(0, 0, columns) if _range is None else self.read_rows(*_range, columns)
+
+    def entity_payments(self, entity_id: int, columns: list[str] = None) -> pa.Table:
+        """
+        :return: the payments of all stories of the entity (empty if the entity is not present), ordered by pd-id
+        """
+        _range = self.entity_rows(entity_id)
+        return self.read_rows(0, 0, columns) if _range is None else self.read_rows(*_range, columns)
+
+
+def story_payments(input_code: str, codename: str, story_id: int, columns: list[str] = None) -> pa.Table:
+    """
+    The payments of a single story read through the offset index (see PaymentsIndex.of)
+    :param input_code: the input-code
+    :param codename: the code-name of the source
+    :param story_id: the story-id
+    :param columns: the columns to read (grouped or derived), if not provided all of them
+    :return: the payments of the story, ordered by pd-id
+    """
+    return PaymentsIndex.of(input_code, codename).story_payments(story_id, columns)
@@ -0,0 +1,527 @@
+"""
+Incremental update of payment stories. When new payments of an entity arrive, only its last story may change:
+it is either ended by the debt that follows its last payment, or continued by the new payments. All the earlier
+stories are final. So for every entity only the state of its last (open) story is kept: the running statistics
+(count, means, sums of squared deviations and of products of deviations, min and max) and the days to later debts
+of the last payment. The statistics of the new payments are merged into it (pairwise update of Chan, Golub
+and LeVeque), the stories are finalized from the statistics in closed form, without re-reading older payments.
+"""
+from lib.input_const import *
+from lib.paystories import PaymentHistoryGrouper, PaymentStoriesBuilder, ScalingParameters, denotes_risk, \
+    read_scaling_parameters, regression_slope, regression_tendency, scaling_metadata
+from lib.segments import Segments
+from lib.util import compact, sort_if_needed
+
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyarrow as pa
+
+from collections import namedtuple
+
+
+StoryUpdate = namedtuple('StoryUpdate', ['stories', 'retracted', 'ignored_debts'])
+StoryUpdate.__doc__ = """
+The stories changed by the update (new, continued or ended, with the same columns as stored payment stories),
+the story-ids of stories which no longer exist as they were continued by new payments (under new story-id)
+and the count of debts ignored as valid from before the last processed payment of their entity
+"""
+
+# the greatest pd-id processed so far (the pd-ids of every update are shifted past it, see IncrementalStories)
+PD_ID_MAX_METADATA_KEY = b'pd_id_max'
+
+
+def updated_stories(stories: pa.Table, update: StoryUpdate) -> pa.Table:
+    """
+    Applies the update to the (stored) payment stories
+    :param stories: the payment stories before the update
+    :param update: the result of IncrementalStories.update
+    :return: the payment stories after the update, ordered by story-id
+    """
+    _replaced = pa.concat_arrays([
+        update.retracted, update.stories.column(PaymentStoriesColumns.StoryId.name).combine_chunks()
+    ])
+    return pa.concat_tables([
+        stories.filter(~pc.is_in(pc.field(PaymentStoriesColumns.StoryId.name), value_set=_replaced)),
+        update.stories.cast(stories.schema)
+    ]).sort_by(PaymentStoriesColumns.StoryId.name)
+
+
+class IncrementalStories:
+    """
+    Maintains the payment stories of a source incrementally. The first update (of empty state) with all payments
+    builds the same stories as PaymentStoriesBuilder; every following update with the next payments of entities
+    changes only the stories affected by them. The first new payment of an entity is taken as the one following
+    its last processed payment (so it must not be due before it), the scaling parameters are frozen.
+    The pd-ids are numbered from 1 in every input, so the pd-ids of an update are shifted past the greatest pd-id
+    processed before (persisted with the state): the ids of stories (and of their first payments) are unique over
+    all updates and a new story never takes the id of an earlier one.
+    An outlier ends the story as in the batch, also over the updates (see StoryStateColumns.FollowedByOutlier).
+    Such a story is final with the debts known when the payment following the outlier is processed, while the batch
+    takes any later debt for it (its next payment is unknown to PaymentHistoryGrouper.detect_dividers).
+    """
+
+    COL_FIRST_STORY_ID = 'first_story_id'
+    NEXT = PaymentHistoryGrouper.NEXT
+
+    def __init__(self, codename: str, scaling: ScalingParameters, state: pa.Table = None, pd_id_max: int = None):
+        """
+        :param codename: the code-name of the source
+        :param scaling: the scaling parameters (see frozen_scaling_parameters)
+        :param state: the state of stories (see state and read), if not provided the update starts from scratch
+        :param pd_id_max: the greatest (shifted) pd-id processed, if not provided the greatest one in the state
+        """
+        self.source_codename = codename
+        self._scaling = scaling
+        self._state = storage_schema(StoryStateColumns.Stored).empty_table() if state is None \
+            else compact(state, storage_schema(StoryStateColumns.Stored))
+        if pd_id_max is None:
+            # the story-id in the state is the pd-id of the last payment of the entity
+            pd_id_max = pc.max(self._state.column(StoryStateColumns.StoryId.name)).as_py() or 0
+        self._pd_id_max = pd_id_max
+
+    @staticmethod
+    def read(file: Path, codename: str) -> 'IncrementalStories':
+        """
+        :param file: the story-state file (see story_state_file)
+        :param codename: the code-name of the source
+        """
+        _scaling = read_scaling_parameters(file)
+        if _scaling is None:
+            raise ValueError(f'No scaling parameters persisted with the story state {file}')
+        _state = pq.read_table(file)
+        _pd_id_max = (_state.schema.metadata or {}).get(PD_ID_MAX_METADATA_KEY)
+        return IncrementalStories(codename, _scaling, _state, None if _pd_id_max is None else int(_pd_id_max))
+
+    def write(self, file: Path) -> Path:
+        """
+        Writes the state, the scaling parameters and the greatest pd-id processed are persisted in the metadata
+        """
+        pq.write_table(self._state.replace_schema_metadata({
+            **scaling_metadata(self._scaling),
+            PD_ID_MAX_METADATA_KEY: str(self._pd_id_max).encode()
+        }), file)
+        return file
+
+    def state(self) -> pa.Table:
+        return self._state
+
+    def scaling_parameters(self) -> ScalingParameters:
+        return self._scaling
+
+    def pd_id_max(self) -> int:
+        return self._pd_id_max
+
+    @staticmethod
+    def _dividing(table: pa.Table, next_suffix: str = None) -> tuple[pa.ChunkedArray, pa.ChunkedArray]:
+        """
+        The dividing credit status and days to debt for the last payments (as in PaymentHistoryGrouper.detect_dividers)
+        :param table: the table with days to later debts of the last payments
+        :param next_suffix: the suffix of days to later debts of the next payments, None if there are no next payments
+        """
+        _cs = pa.repeat(pa.scalar(0, PaymentGroupsColumns.DividingCreditStatus.otype), table.num_rows)
+        _days = pa.nulls(table.num_rows, PaymentGroupsColumns.DividingDaysToDebt.otype)
+        for _credit_status in range(1, 5):
+            _col = StoryStateColumns.LastLaterDebtsMinDaysToValidFrom(_credit_status).name
+            _dividing = pc.is_valid(table.column(_col))
+            if next_suffix is not None:
+                _next = table.column(_col + next_suffix)
+                _dividing = pc.fill_null(pc.and_kleene(
+                    _dividing, pc.or_kleene(pc.is_null(_next), pc.greater(_next, table.column(_col)))
+                ), False)
+            # the highest credit status wins
+            _cs = pc.if_else(_dividing, pa.scalar(_credit_status, PaymentGroupsColumns.DividingCreditStatus.otype), _cs)
+            _days = pc.if_else(_dividing, table.column(_col), _days)
+        return _cs, _days
+
+    def _apply_debts(self, debts: pa.Table) -> tuple[pa.Array, int]:
+        """
+        Updates the days to later debts of the last payments with new debts. The debts valid from before (or on)
+        the last processed payment of the entity are ignored: they were joined to the processed payments already
+        (see 121_join_debts_to_pd) or they would change finalized stories. A debt valid from after the last payment
+        may have been joined to it already as well, it is applied again to no effect (the minimal days are kept)
+        :return: the entities affected and the count of debts ignored
+        """
+        _debts = debts.select([
+            DebtColumns.LiabilityOwner.name, DebtColumns.CreditStatus.name, DebtColumns.ValidFrom.name
+        ]).join(
+            self._state.select([StoryStateColumns.EntityId.name, StoryStateColumns.LastDueDate.name]),
+            keys=DebtColumns.LiabilityOwner.name,
+            right_keys=StoryStateColumns.EntityId.name,
+            join_type='inner'
+        )
+        _later = pc.greater(_debts.column(DebtColumns.ValidFrom.name),
+                            _debts.column(StoryStateColumns.LastDueDate.name))
+        _ignored = _debts.num_rows - pc.sum(_later).as_py() if _debts.num_rows > 0 else 0
+        _debts = _debts.filter(_later)
+        _debts = _debts.append_column(
+            'days_to_valid_from',
+            pc.days_between(_debts.column(StoryStateColumns.LastDueDate.name),
+                            _debts.column(DebtColumns.ValidFrom.name))
+        )
+
+        for _credit_status in range(1, 5):
+            _col = StoryStateColumns.LastLaterDebtsMinDaysToValidFrom(_credit_status)
+            _later = _debts.filter(
+                pc.field(DebtColumns.CreditStatus.name) == _credit_status
+            ).group_by(DebtColumns.LiabilityOwner.name).aggregate([('days_to_valid_from', 'min')])
+            _days = pc.cast(_later.column('days_to_valid_from_min'), _col.otype).take(
+                pc.index_in(self._state.column(StoryStateColumns.EntityId.name),
+                            value_set=_later.column(DebtColumns.LiabilityOwner.name))
+            )
+            self._state = self._state.set_column(
+                self._state.schema.get_field_index(_col.name), _col.name,
+                pc.min_element_wise(self._state.column(_col.name), _days)
+            )
+        return pc.unique(_debts.column(DebtColumns.LiabilityOwner.name)), _ignored
+
+    def _statistics(self, grouped: pa.Table) -> pa.Table:
+        """
+        :param grouped: the new payments grouped into stories (see PaymentHistoryGrouper.combine)
+        :return: the statistics of the new stories (or of their new parts), with dividing credit status and days
+        """
+        _builder = PaymentStoriesBuilder(None, self.source_codename, scaling=self._scaling, payments=grouped)
+        _segments = _builder.story_segments()
+        if _segments is None:
+            raise ValueError('The grouped payments are not ordered by story-id')
+        _payments = _builder.payments([
+            PaymentGroupsColumns.Id.name,
+            PaymentGroupsColumns.EntityId.name,
+            PaymentGroupsColumns.PriorCreditStatusMax.name,
+            PaymentGroupsColumns.DividingCreditStatus.name,
+            PaymentGroupsColumns.DividingDaysToDebt.name,
+            PaymentGroupsColumns.DueDate.name,
+            PaymentGroupsColumns.DelayDays.name,
+            PaymentGroupsColumns.DelayDaysScaled.name,
+            PaymentGroupsColumns.InvoicedAmountScaled.name,
+            PaymentGroupsColumns.Severity.name
+        ])
+        _days = pc.cast(_payments.column(PaymentGroupsColumns.DueDate.name), pa.int32())
+        _x = pc.cast(_days, pa.float64())
+        _counts = pc.cast(_segments.count(_payments.column(PaymentGroupsColumns.Id.name)), pa.float64())
+
+        _statistics = {
+            StoryStateColumns.StoryId.name: _segments.keys(),
+            StoryStateColumns.FirstPaymentId.name: _segments.min(_payments.column(PaymentGroupsColumns.Id.name)),
+            StoryStateColumns.EntityId.name: _segments.first(_payments.column(PaymentGroupsColumns.EntityId.name)),
+            StoryStateColumns.BeginsWithCreditStatus.name: _segments.min(
+                _payments.column(PaymentGroupsColumns.PriorCreditStatusMax.name)),
+            StoryStateColumns.BeginsAt.name: _segments.min(_payments.column(PaymentGroupsColumns.DueDate.name)),
+            StoryStateColumns.EndsAt.name: _segments.max(_payments.column(PaymentGroupsColumns.DueDate.name)),
+            StoryStateColumns.PaidAtMax.name: pc.cast(_segments.max(
+                pc.add(_days, _payments.column(PaymentGroupsColumns.DelayDays.name))), pa.int32()),
+            StoryStateColumns.PaymentsCount.name: _segments.count(_payments.column(PaymentGroupsColumns.Id.name)),
+            StoryStateColumns.ScaledDelayMean.name: _segments.mean(
+                _payments.column(PaymentGroupsColumns.DelayDaysScaled.name)),
+            StoryStateColumns.ScaledAmountMean.name: _segments.mean(
+                _payments.column(PaymentGroupsColumns.InvoicedAmountScaled.name)),
+            StoryStateColumns.SeverityMean.name: _segments.mean(_payments.column(PaymentGroupsColumns.Severity.name)),
+            StoryStateColumns.DueDateMean.name: _segments.mean(_x),
+            StoryStateColumns.DueDateSquares.name: pc.multiply(_segments.variance(_x), _counts),
+            PaymentGroupsColumns.DividingCreditStatus.name: _segments.min(
+                _payments.column(PaymentGroupsColumns.DividingCreditStatus.name)),
+            PaymentGroupsColumns.DividingDaysToDebt.name: _segments.min(
+                _payments.column(PaymentGroupsColumns.DividingDaysToDebt.name)),
+        }
+        for _y_column, _col_squares, _col_products, _col_min, _col_max in [
+            (PaymentGroupsColumns.DelayDaysScaled.name, StoryStateColumns.ScaledDelaySquares.name,
+             StoryStateColumns.ScaledDelayProducts.name, StoryStateColumns.ScaledDelayMin.name,
+             StoryStateColumns.ScaledDelayMax.name),
+            (PaymentGroupsColumns.Severity.name, StoryStateColumns.SeveritySquares.name,
+             StoryStateColumns.SeverityProducts.name, StoryStateColumns.SeverityMin.name,
+             StoryStateColumns.SeverityMax.name)
+        ]:
+            _y = pc.cast(_payments.column(_y_column), pa.float64())
+            _statistics[_col_squares] = pc.multiply(_segments.variance(_y), _counts)
+            # the covariance from variances of x + y and x - y (as in PaymentStoriesBuilder.tendencies)
+            _statistics[_col_products] = pc.multiply(pc.divide(
+                pc.subtract(_segments.variance(pc.add(_x, _y)), _segments.variance(pc.subtract(_x, _y))), 4.0
+            ), _counts)
+            _statistics[_col_min] = _segments.min(_y)
+            _statistics[_col_max] = _segments.max(_y)
+
+        return compact(pa.table(_statistics), storage_schema(
+            StoryStateColumns.Statistics +
+            [PaymentGroupsColumns.DividingCreditStatus, PaymentGroupsColumns.DividingDaysToDebt]
+        ))
+
+    def _merged(self, joined: pa.Table) -> pa.Table:
+        """
+        Merges the statistics of the open stories with the statistics of their continuations
+        :param joined: the statistics of both, those of the continuations are suffixed with NEXT
+        (their story-id is in COL_FIRST_STORY_ID)
+        :return: the statistics of the continued stories (with dividing credit status and days of the continuations)
+        """
+        def _old(column: Column):
+            return joined.column(column.name)
+
+        def _new(column: Column):
+            return joined.column(column.name + self.NEXT)
+
+        _count_old = pc.cast(_old(StoryStateColumns.PaymentsCount), pa.float64())
+        _count_new = pc.cast(_new(StoryStateColumns.PaymentsCount), pa.float64())
+        _count = pc.add(_count_old, _count_new)
+        _weight = pc.divide(pc.multiply(_count_old, _count_new), _count)
+
+        def _delta(mean: Column):
+            return pc.subtract(_new(mean), _old(mean))
+
+        _merged = {
+            StoryStateColumns.StoryId.name: joined.column(self.COL_FIRST_STORY_ID),
+            StoryStateColumns.FirstPaymentId.name: _old(StoryStateColumns.FirstPaymentId),
+            StoryStateColumns.EntityId.name: _old(StoryStateColumns.EntityId),
+            StoryStateColumns.BeginsWithCreditStatus.name: pc.min_element_wise(
+                _old(StoryStateColumns.BeginsWithCreditStatus), _new(StoryStateColumns.BeginsWithCreditStatus)),
+            StoryStateColumns.BeginsAt.name: pc.min_element_wise(
+                _old(StoryStateColumns.BeginsAt), _new(StoryStateColumns.BeginsAt)),
+            StoryStateColumns.EndsAt.name: pc.max_element_wise(
+                _old(StoryStateColumns.EndsAt), _new(StoryStateColumns.EndsAt)),
+            StoryStateColumns.PaidAtMax.name: pc.max_element_wise(
+                _old(StoryStateColumns.PaidAtMax), _new(StoryStateColumns.PaidAtMax)),
+            StoryStateColumns.PaymentsCount.name: _count,
+        }
+        for _mean in [StoryStateColumns.ScaledDelayMean, StoryStateColumns.ScaledAmountMean,
+                      StoryStateColumns.SeverityMean, StoryStateColumns.DueDateMean]:
+            _merged[_mean.name] = pc.add(_old(_mean), pc.multiply(_delta(_mean), pc.divide(_count_new, _count)))
+
+        _delta_x = _delta(StoryStateColumns.DueDateMean)
+        for _squares, _products, _mean in [
+            (StoryStateColumns.DueDateSquares, None, StoryStateColumns.DueDateMean),
+            (StoryStateColumns.ScaledDelaySquares, StoryStateColumns.ScaledDelayProducts,
+             StoryStateColumns.ScaledDelayMean),
+            (StoryStateColumns.SeveritySquares, StoryStateColumns.SeverityProducts, StoryStateColumns.SeverityMean)
+        ]:
+            _merged[_squares.name] = pc.add(pc.add(_old(_squares), _new(_squares)),
+                                            pc.multiply(pc.multiply(_delta(_mean), _delta(_mean)), _weight))
+            if _products is not None:
+                _merged[_products.name] = pc.add(pc.add(_old(_products), _new(_products)),
+                                                 pc.multiply(pc.multiply(_delta_x, _delta(_mean)), _weight))
+        for _min, _max in [(StoryStateColumns.ScaledDelayMin, StoryStateColumns.ScaledDelayMax),
+                           (StoryStateColumns.SeverityMin, StoryStateColumns.SeverityMax)]:
+            _merged[_min.name] = pc.min_element_wise(_old(_min), _new(_min))
+            _merged[_max.name] = pc.max_element_wise(_old(_max), _new(_max))
+        _merged[PaymentGroupsColumns.DividingCreditStatus.name] = _new(PaymentGroupsColumns.DividingCreditStatus)
+        _merged[PaymentGroupsColumns.DividingDaysToDebt.name] = _new(PaymentGroupsColumns.DividingDaysToDebt)
+
+        return compact(pa.table(_merged), storage_schema(
+            StoryStateColumns.Statistics +
+            [PaymentGroupsColumns.DividingCreditStatus, PaymentGroupsColumns.DividingDaysToDebt]
+        ))
+
+    @staticmethod
+    def stories(statistics: pa.Table) -> pa.Table:
+        """
+        Finalizes the stories from their statistics (see PaymentStoriesBuilder.stories and tendencies)
+        :param statistics: the statistics of stories with dividing credit status and days to debt
+        :return: the stories with tendencies, in storage schema
+        """
+        _begins_at = statistics.column(StoryStateColumns.BeginsAt.name)
+        _x_mean = pc.subtract(statistics.column(StoryStateColumns.DueDateMean.name),
+                              pc.cast(pc.cast(_begins_at, pa.int32()), pa.float64()))
+        _x_max = pc.cast(pc.days_between(_begins_at, statistics.column(StoryStateColumns.EndsAt.name)), pa.float64())
+        _stories = pa.table({
+            PaymentStoriesColumns.StoryId.name: statistics.column(StoryStateColumns.StoryId.name),
+            PaymentStoriesColumns.FirstPaymentId.name: statistics.column(StoryStateColumns.FirstPaymentId.name),
+            PaymentStoriesColumns.EntityId.name: statistics.column(StoryStateColumns.EntityId.name),
+            PaymentStoriesColumns.BeginsWithCreditStatus.name: statistics.column(
+                StoryStateColumns.BeginsWithCreditStatus.name),
+            PaymentStoriesColumns.EndsWithCreditStatus.name: statistics.column(
+                PaymentGroupsColumns.DividingCreditStatus.name),
+            PaymentStoriesColumns.LaterDebtMinDaysToValidFrom.name: statistics.column(
+                PaymentGroupsColumns.DividingDaysToDebt.name),
+            PaymentStoriesColumns.BeginsAt.name: _begins_at,
+            PaymentStoriesColumns.EndsAt.name: statistics.column(StoryStateColumns.EndsAt.name),
+            PaymentStoriesColumns.Duration.name: pc.days_between(
+                _begins_at, statistics.column(StoryStateColumns.PaidAtMax.name)),
+            PaymentStoriesColumns.PaymentsCount.name: statistics.column(StoryStateColumns.PaymentsCount.name),
+            PaymentStoriesColumns.ScaledDelayMean.name: statistics.column(StoryStateColumns.ScaledDelayMean.name),
+            PaymentStoriesColumns.ScaledAmountMean.name: statistics.column(StoryStateColumns.ScaledAmountMean.name),
+            PaymentStoriesColumns.SeverityMean.name: statistics.column(StoryStateColumns.SeverityMean.name),
+            PaymentStoriesColumns.DaysSinceBeginMean.name: _x_mean,
+        })
+        _stories = _stories.append_column(
+            PaymentStoriesColumns.DenotesAnyRisk.name, denotes_risk(_stories, 0)
+        ).append_column(
+            PaymentStoriesColumns.DenotesSignificantRisk.name, denotes_risk(_stories, 2)
+        )
+
+        for _squares, _products, _min, _max, _col_y_mean, _col_a1, _col_a0, _col_tendency, \
+                _col_tendency_minus_mean, _col_rsquare in [
+            (StoryStateColumns.ScaledDelaySquares.name, StoryStateColumns.ScaledDelayProducts.name,
+             StoryStateColumns.ScaledDelayMin.name, StoryStateColumns.ScaledDelayMax.name,
+             PaymentStoriesColumns.ScaledDelayMean.name,
+             PaymentStoriesColumns.TendencyCoefficient_ForDelay.name,
+             PaymentStoriesColumns.TendencyConstant_ForDelay.name,
+             PaymentStoriesColumns.Tendency_ForDelay.name,
+             PaymentStoriesColumns.TendencyMinusMean_ForDelay.name,
+             PaymentStoriesColumns.TendencyError_ForDelay.name),
+            (StoryStateColumns.SeveritySquares.name, StoryStateColumns.SeverityProducts.name,
+             StoryStateColumns.SeverityMin.name, StoryStateColumns.SeverityMax.name,
+             PaymentStoriesColumns.SeverityMean.name,
+             PaymentStoriesColumns.TendencyCoefficient_ForSeverity.name,
+             PaymentStoriesColumns.TendencyConstant_ForSeverity.name,
+             PaymentStoriesColumns.Tendency_ForSeverity.name,
+             PaymentStoriesColumns.TendencyMinusMean_ForSeverity.name,
+             PaymentStoriesColumns.TendencyError_ForSeverity.name)
+        ]:
+            # the centered sums are exactly zero if y is constant
+            _constant = pc.equal(statistics.column(_min), statistics.column(_max))
+            _a1, _rsquare = regression_slope(
+                statistics.column(StoryStateColumns.DueDateSquares.name),
+                pc.if_else(_constant, 0.0, statistics.column(_products)),
+                pc.if_else(_constant, 0.0, statistics.column(_squares))
+            )
+            _a0, _tendency, _tendency_minus_mean = regression_tendency(
+                _a1, _x_mean, _x_max, statistics.column(_col_y_mean))
+            _stories = _stories.append_column(_col_a1, _a1).append_column(_col_a0, _a0).append_column(
+                _col_tendency, _tendency).append_column(_col_tendency_minus_mean, _tendency_minus_mean).append_column(
+                _col_rsquare, _rsquare)
+
+        return compact(_stories, storage_schema(PaymentStoriesColumns.Stored))
+
+    def update(self, payments: pa.Table = None, debts: pa.Table = None) -> StoryUpdate:
+        """
+        Updates the stories with new payments and debts. The cost is proportional to the number of new payments
+        (plus the lookups of their entities in the state), not to the number of all payments
+        :param payments: the new payment delays with debts of the source (PaymentHistoryGrouper.COLUMNS,
+        the outliers flagged, the pd-ids numbered from 1 as in every input), the payments of an entity must follow
+        all its processed payments. The outliers may be excluded, but then an outlier before the first (or after
+        the last) new payment of an entity does not end its story
+        :param debts: the debts of the input (DebtColumns), only those valid from after the last processed payment
+        of the entity are applied (see _apply_debts)
+        :return: the changed stories
+        """
+        _changed_entities = pa.array([], StoryStateColumns.EntityId.otype)
+        _ignored_debts = 0
+        if debts is not None and debts.num_rows > 0:
+            _changed_entities, _ignored_debts = self._apply_debts(debts)
+
+        _statistics = []
+        _retracted = pa.array([], StoryStateColumns.StoryId.otype)
+        _updated_entities = pa.array([], StoryStateColumns.EntityId.otype)
+        if payments is not None and payments.num_rows > 0:
+            _ids = payments.column(PayDelayColumns.Id.name)
+            _pd_id_max = self._pd_id_max + pc.max(_ids).as_py()
+            payments = payments.set_column(
+                payments.schema.get_field_index(PayDelayColumns.Id.name), PayDelayColumns.Id.name,
+                pc.add_checked(_ids, pa.scalar(self._pd_id_max, _ids.type))
+            )
+            # the entities whose first (last) new payment is an outlier: the open story (the last new story)
+            # is ended, as the outlier leaves a gap in pd-ids which divides the stories in the batch
+            _starting_with_outlier = pa.array([], StoryStateColumns.EntityId.otype)
+            _ending_with_outlier = pa.array([], StoryStateColumns.EntityId.otype)
+            if PayDelayColumns.IsOutlier.name in payments.column_names:
+                payments = sort_if_needed(payments.select(
+                    PaymentHistoryGrouper.COLUMNS + [PayDelayColumns.IsOutlier.name]), PayDelayColumns.Id.name)
+                _entities = Segments(payments.column(PayDelayColumns.EntityId.name))
+                _outliers = payments.column(PayDelayColumns.IsOutlier.name)
+                _starting_with_outlier = _entities.keys().filter(_entities.first(_outliers))
+                _ending_with_outlier = _entities.keys().filter(_entities.last(_outliers))
+                payments = payments.filter(~pc.field(PayDelayColumns.IsOutlier.name))
+            payments = sort_if_needed(payments.select(PaymentHistoryGrouper.COLUMNS), PayDelayColumns.Id.name)
+
+            _grouper = PaymentHistoryGrouper(None, self.source_codename, content=payments)
+            _grouper.detect_dividers()
+            _grouper.calculate_story_ids()
+            _grouped = _grouper.combine()
+            _grouper = None
+            _new = self._statistics(_grouped)
+
+            # the first and the last new payment of every entity
+            _entities = Segments(payments.column(PayDelayColumns.EntityId.name))
+            if len(_entities) != len(pc.unique(_entities.keys())):
+                raise ValueError('The payments of an entity are not contiguous in pd-id order')
+            _next = {
+                StoryStateColumns.EntityId.name: _entities.keys(),
+                PayDelayColumns.DueDate.name + self.NEXT: _entities.first(
+                    payments.column(PayDelayColumns.DueDate.name)),
+                PayDelayColumns.DelayDays.name + self.NEXT: _entities.first(
+                    payments.column(PayDelayColumns.DelayDays.name)),
+                self.COL_FIRST_STORY_ID: _entities.first(_grouped.column(PaymentGroupsColumns.StoryId.name))
+            }
+            _last = {
+                StoryStateColumns.StoryId.name: _entities.last(payments.column(PayDelayColumns.Id.name)),
+                StoryStateColumns.LastDueDate.name: _entities.last(payments.column(PayDelayColumns.DueDate.name)),
+                StoryStateColumns.FollowedByOutlier.name: pc.is_in(_entities.keys(), value_set=_ending_with_outlier)
+            }
+            for _credit_status in range(1, 5):
+                _col = PayDelayColumns.LaterDebtsMinDaysToValidFrom(_credit_status).name
+                _next[_col + self.NEXT] = _entities.first(payments.column(_col))
+                _last[_col] = _entities.last(payments.column(_col))
+
+            self._state = self._state.set_column(
+                self._state.schema.get_field_index(StoryStateColumns.FollowedByOutlier.name),
+                StoryStateColumns.FollowedByOutlier.name,
+                pc.or_(self._state.column(StoryStateColumns.FollowedByOutlier.name),
+                       pc.is_in(self._state.column(StoryStateColumns.EntityId.name), value_set=_starting_with_outlier))
+            )
+            _continued = self._state.join(pa.table(_next), keys=StoryStateColumns.EntityId.name, join_type='inner')
+            if pc.any(pc.less(_continued.column(PayDelayColumns.DueDate.name + self.NEXT),
+                              _continued.column(StoryStateColumns.LastDueDate.name))).as_py():
+                raise ValueError('Some of payments are due before the last processed payment of the entity')
+
+            # the last processed payment is the divider if it is followed by a debt (or the next delay is unknown),
+            # the one followed by an outlier is the divider as if the next payment was unknown (see detect_dividers)
+            _followed_by_outlier = _continued.column(StoryStateColumns.FollowedByOutlier.name)
+            for _col in [PayDelayColumns.DelayDays.name] + [
+                    PayDelayColumns.LaterDebtsMinDaysToValidFrom(_cs).name for _cs in range(1, 5)]:
+                _continued = _continued.set_column(
+                    _continued.schema.get_field_index(_col + self.NEXT), _col + self.NEXT,
+                    pc.if_else(_followed_by_outlier, pa.scalar(None, _continued.schema.field(_col + self.NEXT).type),
+                               _continued.column(_col + self.NEXT))
+                )
+            _dividing_cs, _dividing_days = self._dividing(_continued, self.NEXT)
+            _ended = pc.or_(pc.greater(_dividing_cs, 0),
+                            pc.is_null(_continued.column(PayDelayColumns.DelayDays.name + self.NEXT)))
+            _statistics.append(_continued.append_column(
+                PaymentGroupsColumns.DividingCreditStatus.name, _dividing_cs
+            ).append_column(
+                PaymentGroupsColumns.DividingDaysToDebt.name, _dividing_days
+            ).filter(_ended))
+
+            # otherwise the open story is continued by the first new story of the entity
+            _continued = _continued.filter(pc.invert(_ended))
+            _retracted = _continued.column(StoryStateColumns.StoryId.name).combine_chunks()
+            _merged = self._merged(_continued.select(
+                [_c.name for _c in StoryStateColumns.Statistics] + [self.COL_FIRST_STORY_ID]
+            ).join(
+                _new.rename_columns([_c + self.NEXT for _c in _new.column_names]),
+                keys=self.COL_FIRST_STORY_ID,
+                right_keys=StoryStateColumns.StoryId.name + self.NEXT,
+                join_type='inner'
+            ))
+            _new = pa.concat_tables([
+                _new.filter(~pc.is_in(pc.field(StoryStateColumns.StoryId.name),
+                                      value_set=_merged.column(StoryStateColumns.StoryId.name).combine_chunks())),
+                _merged
+            ])
+            _statistics.append(_new)
+
+            # the new state: the last stories of entities with new payments, the others are kept
+            _updated_entities = _entities.keys().combine_chunks()
+            self._state = pa.concat_tables([
+                self._state.filter(~pc.is_in(pc.field(StoryStateColumns.EntityId.name),
+                                             value_set=_updated_entities)),
+                compact(_new.join(pa.table(_last), keys=StoryStateColumns.StoryId.name, join_type='inner'),
+                        storage_schema(StoryStateColumns.Stored))
+            ])
+            self._pd_id_max = _pd_id_max
+
+        # the open stories whose last payment got a later debt (and which were not affected by new payments)
+        _open = self._state.filter(
+            pc.is_in(pc.field(StoryStateColumns.EntityId.name), value_set=_changed_entities) &
+            ~pc.is_in(pc.field(StoryStateColumns.EntityId.name), value_set=_updated_entities)
+        )
+        _dividing_cs, _dividing_days = self._dividing(_open)
+        _statistics.append(_open.append_column(
+            PaymentGroupsColumns.DividingCreditStatus.name, _dividing_cs
+        ).append_column(
+            PaymentGroupsColumns.DividingDaysToDebt.name, _dividing_days
+        ))
+
+        _schema = storage_schema(StoryStateColumns.Statistics +
+                                 [PaymentGroupsColumns.DividingCreditStatus, PaymentGroupsColumns.DividingDaysToDebt])
+        return StoryUpdate(
+            self.stories(pa.concat_tables([compact(_s, _schema) for _s in _statistics])),
+            _retracted,
+            _ignored_debts
+        )
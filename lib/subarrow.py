@@ -1,88 +1,223 @@
 """
-Utility functions for pyarrow run in subprocess
+Utility functions for pyarrow aggregations that are too large to be done in place.
+ArrowAggregate runs the aggregation in subprocess: the work is done by a persistent pool of worker processes,
+the tables are exchanged as Arrow IPC files placed in shared memory (/dev/shm) if available,
+each call uses its own uniquely named files.
+SpillingAggregate partitions the records by hash of the (integer) key and spills the partitions to disk,
+so that only one partition is aggregated in memory at a time
 """
-import sys
-import subprocess
-import time
-
-import pyarrow.parquet as pq
+import atexit
+import itertools
+import multiprocessing
+import os
+import tempfile
+import uuid
+
+import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
 
-_FILE_IN = 'tmp_agg_in.parquet'
-_FILE_OUT = 'tmp_agg_out.parquet'
+_SHARED_MEMORY_DIR = Path('/dev/shm')
+_FILE_PREFIX = 'tmp_agg_'
+_EXTENSION_ARROW = '.arrow'
 
+WORKERS = 1
 
-class _ArrowAggregateArguments:
+SPILL_WHEN_LARGER_THAN_BYTES = 1 << 30
+SPILL_PARTITIONS_BITS = 4
 
-    def __init__(self, by: list[str], agg: list[tuple], tempdir: Path):
-        self.by = by
-        self.agg = agg
-        self.tempdir = Path(tempdir)
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_pid: Optional[int] = None
 
-    def to_args(self) -> list[str]:
-        return [",".join(self.by), ",".join([f"{a[0]}|{a[1]}" for a in self.agg]), str(self.tempdir.absolute())]
 
-    @staticmethod
-    def from_args(args: list[str]):
-        _by = args[0].split(',')
-        _agg_tup = args[1].split(",")
-        _agg = [tuple(_aggt.split("|")) for _aggt in _agg_tup]
-        _td = args[2]
+def _default_tempdir() -> Path:
+    return _SHARED_MEMORY_DIR if _SHARED_MEMORY_DIR.is_dir() else Path(tempfile.gettempdir())
 
-        return _ArrowAggregateArguments(_by, _agg, Path(_td))
 
+def _pool() -> ProcessPoolExecutor:
+    global _executor, _executor_pid
+    # a pool inherited by a forked process is not usable there, the process starts its own
+    if _executor is None or _executor_pid != os.getpid():
+        _executor_pid = os.getpid()
+        # spawned, not forked: forking a process that already runs pyarrow threads or other pools may deadlock
+        _executor = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
 
-class ArrowAggregate:
 
-    def __init__(self, table: pa.Table, by: list[str], agg: list[tuple], tempdir='.', venv=r"..\venv\Scripts\python.exe"):
-        self._table = table
-        self._args = _ArrowAggregateArguments(by, agg, Path(tempdir))
-        self._venv = venv
+def shutdown():
+    """
+    Stops the worker processes (they are started again with the next aggregation)
+    """
+    global _executor
+    if _executor is not None and _executor_pid == os.getpid():
+        _executor.shutdown()
+        _executor = None
 
-    def _tempfile_in(self) -> Path:
-        return self._args.tempdir / _FILE_IN
 
-    def _tempfile_out(self) -> Path:
-        return self._args.tempdir / _FILE_OUT
+atexit.register(shutdown)
 
-    def _store(self):
-        pq.write_table(self._table, self._tempfile_in())
 
-    def _restore(self) -> pa.Table:
-        _result = pq.read_table(self._tempfile_out())
-        while True:
-            try:
-                self._tempfile_out().unlink()
-                break
-            except PermissionError:
-                time.sleep(0.001)
-                continue
-        return _result
+def _write(table: pa.Table, file: Path):
+    with pa.OSFile(str(file), 'wb') as _sink:
+        with pa.ipc.new_file(_sink, table.schema) as _writer:
+            _writer.write_table(table)
 
-    def _exec(self):
-        res = subprocess.run([self._venv, __file__] + self._args.to_args())
-        if res.returncode != 0:
-            raise ValueError('The process failed')
 
-    def aggregate(self) -> pa.Table:
-        self._store()
-        self._exec()
-        self._tempfile_in().unlink()
-        return self._restore()
+def _read(file: Path) -> pa.Table:
+    with pa.OSFile(str(file), 'rb') as _source:
+        return pa.ipc.open_file(_source).read_all()
 
 
-if __name__ == '__main__':
+def _aggregate(file_in: Path, file_out: Path, by: list[str], agg: list[tuple]):
+    # executed in the worker process; the input is memory-mapped, not copied
+    with pa.memory_map(str(file_in), 'r') as _source:
+        _table = pa.ipc.open_file(_source).read_all()
+    _write(_table.group_by(by).aggregate(agg), file_out)
 
-    if len(sys.argv) < 4:
-        print('Incorrect number of parameters')
-        exit(1)
 
-    _arguments = _ArrowAggregateArguments.from_args(sys.argv[1:])
+class ArrowAggregate:
 
-    _table = pq.read_table(_arguments.tempdir / _FILE_IN)
-    _aggregated = _table.group_by(_arguments.by).aggregate(_arguments.agg)
-    pq.write_table(_aggregated, _arguments.tempdir / _FILE_OUT)
+    def __init__(self, table: pa.Table, by: list[str], agg: list[tuple], tempdir: Path = None):
+        self._table = table
+        self._by = by
+        self._agg = agg
+        self._tempdir = _default_tempdir() if tempdir is None else Path(tempdir)
+        self._name = uuid.uuid4().hex
 
-    exit(0)
+    def _tempfile_in(self) -> Path:
+        return self._tempdir / f'{_FILE_PREFIX}{self._name}_in{_EXTENSION_ARROW}'
+
+    def _tempfile_out(self) -> Path:
+        return self._tempdir / f'{_FILE_PREFIX}{self._name}_out{_EXTENSION_ARROW}'
+
+    def aggregate(self) -> pa.Table:
+        try:
+            _write(self._table, self._tempfile_in())
+            _pool().submit(_aggregate, self._tempfile_in(), self._tempfile_out(), self._by, self._agg).result()
+            return _read(self._tempfile_out())
+        except BrokenProcessPool as _e:
+            shutdown()
+            raise ValueError('The process failed') from _e
+        finally:
+            self._tempfile_in().unlink(missing_ok=True)
+            self._tempfile_out().unlink(missing_ok=True)
+
+
+class SpillingAggregate:
+    """
+    Out-of-core group-by over an integer key. The input is buffered in memory until the memory limit is exceeded,
+    then it is hash-partitioned by the key and spilled to disk, every partition is aggregated independently
+    (a partition that is still too large is partitioned again by the next bits of the key).
+    As all records of a group fall into the same partition, the result is the same as of the in-memory group-by,
+    only the order of groups differs.
+    The memory limit bounds the input only if it is a stream of record batches (e.g. read from a file); a table
+    is already in memory, then the limit bounds the group-by state, which is built for one partition at a time.
+    """
+
+    def __init__(self, source: Union[pa.Table, Iterable[pa.RecordBatch]], by: str, agg: list[tuple],
+                 memory_limit: int = SPILL_WHEN_LARGER_THAN_BYTES, tempdir: Path = None, _shift: int = 0):
+        """
+        :param source: the table or stream of record batches to be aggregated
+        :param by: the integer column to group by
+        :param agg: the aggregations, as for pa.TableGroupBy.aggregate
+        :param memory_limit: the number of bytes of input that may be aggregated in memory at once
+        :param tempdir: the directory for spilled partitions (the system temp dir if not provided)
+        """
+        self._columns = list(dict.fromkeys([by] + [_a[0] for _a in agg]))
+        if isinstance(source, pa.Table):
+            source = source.select(self._columns)
+            self._schema = source.schema
+            source = source.to_batches()
+        else:
+            self._schema = getattr(source, 'schema', None)
+        self._source = source
+        self._by = by
+        self._agg = agg
+        self._memory_limit = memory_limit
+        self._tempdir = Path(tempfile.gettempdir()) if tempdir is None else Path(tempdir)
+        self._shift = _shift
+
+    def _partition_ids(self, batch: pa.RecordBatch) -> pa.Array:
+        if not pa.types.is_integer(batch.schema.field(self._by).type):
+            raise ValueError(f'Only integer keys can be partitioned, {self._by} is {batch.schema.field(self._by).type}')
+        return pc.bit_wise_and(
+            pc.shift_right(batch.column(self._by), self._shift), (1 << SPILL_PARTITIONS_BITS) - 1
+        )
+
+    def _group_by(self, batches: list[pa.RecordBatch], schema: pa.Schema) -> pa.Table:
+        return pa.Table.from_batches(batches, schema).group_by(self._by).aggregate(self._agg)
+
+    def _spilled(self, files: list[Path], sizes: list[int]) -> Iterator[pa.Table]:
+        for _file, _size in zip(files, sizes):
+            if _size == 0:
+                continue
+            with pa.memory_map(str(_file), 'r') as _source:
+                _reader = pa.ipc.open_stream(_source)
+                if _size > self._memory_limit and self._shift + SPILL_PARTITIONS_BITS < 64:
+                    yield from SpillingAggregate(
+                        _reader, self._by, self._agg, self._memory_limit, self._tempdir,
+                        self._shift + SPILL_PARTITIONS_BITS
+                    ).partitions()
+                else:
+                    yield self._group_by(list(_reader), _reader.schema)
+            _file.unlink()
+
+    def _spill(self, batches: Iterable[pa.RecordBatch], schema: pa.Schema, files: list[Path]) -> list[int]:
+        _sizes = [0] * len(files)
+        _sinks = [pa.OSFile(str(_f), 'wb') for _f in files]
+        try:
+            _writers = [pa.ipc.new_stream(_sink, schema) for _sink in _sinks]
+            for _batch in batches:
+                # the batch is ordered by partition once, then every partition is a slice of it
+                # (the records of null key are put to the first partition, they form a group as well)
+                _partition_ids = pc.fill_null(self._partition_ids(_batch), 0)
+                _batch = _batch.take(pc.sort_indices(_partition_ids))
+                _ends = np.cumsum(np.bincount(_partition_ids.to_numpy(), minlength=len(_writers)))
+                for _p, (_writer, _begin, _end) in enumerate(zip(_writers, np.concatenate([[0], _ends[:-1]]), _ends)):
+                    if _end > _begin:
+                        _part = _batch.slice(int(_begin), int(_end - _begin))
+                        _writer.write_batch(_part)
+                        _sizes[_p] += _part.nbytes
+            for _writer in _writers:
+                _writer.close()
+        finally:
+            for _sink in _sinks:
+                _sink.close()
+        return _sizes
+
+    def partitions(self) -> Iterator[pa.Table]:
+        """
+        Streams out the result, one aggregated partition after another
+        """
+        _batches = iter(self._source)
+        _schema = self._schema
+        _buffer = []
+        _buffered = 0
+        for _batch in _batches:
+            _schema = _batch.schema
+            _buffer.append(_batch)
+            _buffered += _batch.nbytes
+            if _buffered > self._memory_limit:
+                break
+        else:
+            # everything fits in memory, nothing to be spilled
+            if _schema is not None:
+                yield self._group_by(_buffer, _schema)
+            return
+
+        with tempfile.TemporaryDirectory(prefix=_FILE_PREFIX, dir=self._tempdir) as _spill_dir:
+            _files = [Path(_spill_dir) / f'{_p}{_EXTENSION_ARROW}' for _p in range(1 << SPILL_PARTITIONS_BITS)]
+            _sizes = self._spill(itertools.chain(_buffer, _batches), _schema, _files)
+            _buffer = None
+            yield from self._spilled(_files, _sizes)
+
+    def aggregate(self) -> pa.Table:
+        _partitions = list(self.partitions())
+        if len(_partitions) == 0:
+            return pa.table({}) if self._schema is None else self._group_by([], self._schema)
+        return pa.concat_tables(_partitions)
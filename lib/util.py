@@ -1,9 +1,14 @@
 import pathlib
 import random
+from collections import OrderedDict
 from datetime import datetime
 from rich import print
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import pyarrow as pa
 
+from typing import Any, Callable, Hashable, Optional, Union
+
 
 class CodenameGen:
     STYLE_CAMEL = 'camel'
@@ -103,3 +108,235 @@ def report_processing(action: str, _started_at: datetime, pa_table: pa.Table):
           f'[green], total mem.: [red]{_format_bytes(pa.total_allocated_bytes())}')
 
 
+def sorting_columns(table: pa.Table, sort_keys: list[str]) -> list[pq.SortingColumn]:
+    """
+    Prepares the parquet sorting-columns metadata for the table, which is (ascending) sorted by provided columns
+    :param table: the table to be written
+    :param sort_keys: names of the columns the table is sorted by
+    :return: the value for sorting_columns argument of pq.write_table / pq.ParquetWriter
+    """
+    return [pq.SortingColumn(table.schema.get_field_index(_key)) for _key in sort_keys]
+
+
+def declared_sorting(file: pathlib.Path) -> list[str]:
+    """
+    Reads the sort order declared in the parquet file metadata (sorting-columns). The order is only trusted if all
+    row-groups declare the same ascending sorting and the statistics of the first sorting column of consecutive
+    row-groups do not overlap (sorting-columns alone only describe the order within the row-group)
+    :param file: the parquet file
+    :return: the names of the columns the whole file is sorted by, empty list if unknown
+    """
+    _metadata = pq.read_metadata(file)
+    if _metadata.num_row_groups == 0:
+        return []
+    _declared = _metadata.row_group(0).sorting_columns
+    if not _declared or any(_sc.descending for _sc in _declared):
+        return []
+    _previous_max = None
+    for _rg in range(_metadata.num_row_groups):
+        _row_group = _metadata.row_group(_rg)
+        if _row_group.sorting_columns != _declared:
+            return []
+        _statistics = _row_group.column(_declared[0].column_index).statistics
+        if _statistics is None or not _statistics.has_min_max:
+            return []
+        if _previous_max is not None and _statistics.min < _previous_max:
+            return []
+        _previous_max = _statistics.max
+    _names = _metadata.schema.to_arrow_schema().names
+    return [_names[_sc.column_index] for _sc in _declared]
+
+
+def is_sorted(column: pa.ChunkedArray) -> bool:
+    """
+    Cheap (linear) check if the column is (ascending) monotonic
+    :param column: the column to check
+    :return: True if the values are non-decreasing
+    """
+    if len(column) < 2:
+        return True
+    return pc.all(pc.less_equal(column.slice(0, len(column) - 1), column.slice(1))).as_py()
+
+
+def sort_if_needed(table: pa.Table, sort_key: str, declared: list[str] = None) -> pa.Table:
+    """
+    Sorts the table by provided column, unless it is already ordered. The order is either trusted
+    (if declared in the metadata of the file the table was read from) or verified by monotonicity check.
+    :param table: the table to sort
+    :param sort_key: the column the table shall be sorted by
+    :param declared: the sort order declared by the file (see declared_sorting)
+    :return: the sorted table (the same object if no sorting was needed)
+    """
+    if declared and declared[0] == sort_key:
+        return table
+    if is_sorted(table.column(sort_key)):
+        return table
+    _started_at = datetime.now()
+    table = table.sort_by(sort_key)
+    print(f'[yellow]The table was not ordered by {sort_key}, sorted in '
+          f'{(datetime.now() - _started_at).total_seconds():.1f} s, {table.num_rows} records')
+    return table
+
+
+def is_up_to_date(file: pathlib.Path, sources: list[pathlib.Path]) -> bool:
+    """
+    :param file: the file derived from the sources
+    :param sources: the files it was derived from
+    :return: True if the file exists and was not modified before any of the sources
+    """
+    return file.exists() and all(file.stat().st_mtime >= _source.stat().st_mtime for _source in sources)
+
+
+def compact(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """
+    Prepares the table to be written: only the columns of the storage schema are kept (in its order), cast to their
+    declared types. The narrowing of integers is checked, a value out of the declared range raises ArrowInvalid
+    :param table: the table to be written
+    :param schema: the storage schema (see input_const.storage_schema)
+    :return: the table with the storage schema (the metadata of the table are kept)
+    """
+    return table.select(schema.names).cast(schema.with_metadata(table.schema.metadata))
+
+
+def read_with_sidecar(file: pathlib.Path, sidecar: pathlib.Path, columns: list[str] = None) -> pa.Table:
+    """
+    Reads the table whose (derived) columns are stored in a separate, row-aligned sidecar file. The sidecar columns
+    are zipped with the base columns without copying, a sidecar column replaces the base column of the same name
+    :param file: the file with base columns
+    :param sidecar: the sidecar file, it does not have to exist
+    :param columns: the columns to read (from either file), if not provided all columns of both files
+    :return: the table
+    """
+    _base_names = pq.read_schema(file).names
+    _sidecar_names = pq.read_schema(sidecar).names if sidecar.exists() else []
+    if columns is None:
+        columns = _base_names + [_c for _c in _sidecar_names if _c not in _base_names]
+    _table = pq.read_table(file, columns=[_c for _c in columns if _c not in _sidecar_names])
+    _derived_names = [_c for _c in columns if _c in _sidecar_names]
+    if len(_derived_names) == 0:
+        return _table.select(columns)
+    _derived = pq.read_table(sidecar, columns=_derived_names)
+    if _derived.num_rows != _table.num_rows:
+        raise ValueError(f'The sidecar {sidecar} ({_derived.num_rows} records) is not aligned '
+                         f'with {file} ({_table.num_rows} records)')
+    for _c in _derived_names:
+        _table = _table.append_column(_derived.schema.field(_c), _derived.column(_c))
+    return _table.select(columns)
+
+
+class ColumnGraph:
+    """
+    Lazily derived columns of a table. Every derived column declares the columns it is computed from (base columns
+    of the table or other derived columns) and the kernel computing it. The column is computed only when requested,
+    directly or as an input of another requested column, and then cached. A kernel may return a scalar,
+    it is broadcast to the whole column only when materialized. A derived column named as a base column replaces it
+    (its kernel receives the base column)
+    """
+
+    def __init__(self, load: Callable[[], pa.Table]):
+        """
+        :param load: loads the table with base columns, invoked when the first column is needed
+        """
+        self._load = load
+        self._base: Optional[pa.Table] = None
+        self._derived: dict[str, tuple[list[str], Callable]] = {}
+        self._cache: dict[str, Union[pa.ChunkedArray, pa.Array, pa.Scalar]] = {}
+        self._computing: set[str] = set()
+
+    def base(self) -> pa.Table:
+        if self._base is None:
+            self._base = self._load()
+        return self._base
+
+    def derive(self, name: str, inputs: list[str], kernel: Callable):
+        """
+        Declares the derived column
+        :param name: the name of the column
+        :param inputs: the names of columns the kernel is invoked with
+        :param kernel: the function computing the column (array or scalar) from the inputs
+        """
+        self._derived[name] = (inputs, kernel)
+
+    def value(self, name: str) -> Union[pa.ChunkedArray, pa.Array, pa.Scalar]:
+        """
+        :return: the column, derived columns may be scalar
+        """
+        if name in self._cache:
+            return self._cache[name]
+        if name not in self._derived:
+            return self.base().column(name)
+        if name in self._computing:
+            raise ValueError(f'The column {name} depends on itself')
+        self._computing.add(name)
+        try:
+            _inputs, _kernel = self._derived[name]
+            self._cache[name] = _kernel(*[
+                self.base().column(_input) if _input == name else self.value(_input) for _input in _inputs
+            ])
+        finally:
+            self._computing.remove(name)
+        return self._cache[name]
+
+    def is_scalar(self, name: str) -> bool:
+        """
+        :return: True if the column is a scalar (the same value in every row, see value)
+        """
+        return isinstance(self.value(name), pa.Scalar)
+
+    def column(self, name: str) -> Union[pa.ChunkedArray, pa.Array]:
+        """
+        :return: the column materialized to the count of rows of the table, for consumers that require an array
+        (kernels broadcast a scalar, prefer value for their inputs)
+        """
+        _value = self.value(name)
+        return pa.repeat(_value, self.base().num_rows) if isinstance(_value, pa.Scalar) else _value
+
+    def computed(self) -> list[str]:
+        """
+        :return: the names of derived columns computed so far (in order of declaration)
+        """
+        return [_name for _name in self._derived if _name in self._cache]
+
+    def table(self, columns: list[str] = None) -> pa.Table:
+        """
+        :param columns: the names of base and derived columns, if not provided: the base columns
+        followed by all derived columns computed so far
+        :return: the table with materialized columns
+        """
+        if columns is None:
+            columns = self.base().column_names + [_c for _c in self.computed() if _c not in self.base().column_names]
+        return pa.table({_c: self.column(_c) for _c in columns})
+
+
+class LruCache:
+    """
+    Size-bounded cache of computed values, the least recently used value is evicted when the size is exceeded
+    """
+
+    def __init__(self, max_size: int):
+        """
+        :param max_size: the maximal count of cached values
+        """
+        self._max_size = max_size
+        self._values: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        :param key: the key of the value
+        :param compute: computes the value if it is not cached
+        :return: the cached or computed value
+        """
+        if key in self._values:
+            self._values.move_to_end(key)
+            return self._values[key]
+        _value = compute()
+        self._values[key] = _value
+        if len(self._values) > self._max_size:
+            self._values.popitem(last=False)
+        return _value
+
+    def __len__(self):
+        return len(self._values)
+
+    def clear(self):
+        self._values.clear()
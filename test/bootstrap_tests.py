@@ -0,0 +1,123 @@
+from unittest import main
+from unittest import TestCase
+from unittest.mock import patch
+
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lib.bootstrap import PerformanceBootstrap, WEIGHTS_MULTINOMIAL, WEIGHTS_POISSON, _resampled_counts
+from lib.input_const import *
+from lib.perfeval import PaymentStoriesPerformanceEvaluator
+
+PREDICTOR = PaymentStoriesColumns.ScaledDelayMean
+ACTUAL = PaymentStoriesColumns.DenotesAnyRisk
+
+
+def _weighted_metrics(values: np.ndarray, positives: np.ndarray, negatives: np.ndarray) -> tuple[float, float]:
+    """
+    :param values: the distinct values of the predictor
+    :param positives: the (resampled) count of positives of every value
+    :param negatives: the (resampled) count of negatives of every value
+    :return: the area under ROC curve of all (positive, negative) pairs and F1-max over all thresholds (NaN if
+    undefined)
+    """
+    _p = positives.sum()
+    _n = negatives.sum()
+    _pairs = positives[:, np.newaxis] * negatives[np.newaxis, :]
+    _auc = np.sum(_pairs * ((values[:, np.newaxis] > values[np.newaxis, :]) +
+                            (values[:, np.newaxis] == values[np.newaxis, :]) / 2)) / (_p * _n) if _p * _n > 0 \
+        else np.nan
+    _f1 = [0.0]
+    for _value in values:
+        _tp = positives[values >= _value].sum()
+        _fp = negatives[values >= _value].sum()
+        _f1.append(2 * _tp / (2 * _tp + _fp + _p - _tp) if _tp > 0 else 0.0)
+    return _auc, max(_f1) if _p > 0 else np.nan
+
+
+class PerformanceBootstrapTests(TestCase):
+
+    def setUp(self) -> None:
+        _rng = np.random.default_rng(3)
+        _count = 300
+        _values = np.round(_rng.normal(0.0, 1.0, _count), 1).astype(np.float32)
+        self._stories = pa.table({
+            PREDICTOR.name: pa.array(_values, PREDICTOR.otype),
+            PaymentStoriesColumns.PaymentsCount.name: pa.array(_rng.integers(1, 6, _count),
+                                                               PaymentStoriesColumns.PaymentsCount.otype),
+            ACTUAL.name: pa.array(_rng.random(_count) < 1 / (1 + np.exp(-2 * _values)), ACTUAL.otype,
+                                  mask=_rng.random(_count) < 0.05)
+        })
+        self._dir = tempfile.TemporaryDirectory()
+        self._file = Path(self._dir.name) / 'stories.parquet'
+        pq.write_table(self._stories, self._file)
+        self._evaluator = PaymentStoriesPerformanceEvaluator(self._file, 'test')
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def test_replicates(self):
+        _values, _positives, _negatives = self._evaluator.value_counts(PREDICTOR.name, ACTUAL.name)
+        for _weights in (WEIGHTS_POISSON, WEIGHTS_MULTINOMIAL):
+            _auc, _f1_max = PerformanceBootstrap(self._evaluator, 20, seed=5,
+                                                 weights=_weights).replicates(PREDICTOR.name, ACTUAL.name)
+            # a single block, drawn from the first seed spawned
+            _tp, _fp = _resampled_counts(np.random.default_rng(np.random.SeedSequence(5).spawn(1)[0]),
+                                         _positives, _negatives, 20, _weights)
+            for _i in range(20):
+                _expected_auc, _expected_f1_max = _weighted_metrics(_values, _tp[:, _i], _fp[:, _i])
+                self.assertAlmostEqual(_auc[_i], _expected_auc, places=12)
+                self.assertAlmostEqual(_f1_max[_i], _expected_f1_max, places=12)
+
+    def test_resampled_counts(self):
+        _positives = np.array([3, 0, 5, 1])
+        _negatives = np.array([2, 4, 0, 7])
+        _tp, _fp = _resampled_counts(np.random.default_rng(1), _positives, _negatives, 50, WEIGHTS_MULTINOMIAL)
+        self.assertEqual(_tp.shape, (4, 50))
+        # the classic bootstrap: exactly the count of stories, and no story of a value and class never observed
+        np.testing.assert_array_equal(_tp.sum(axis=0) + _fp.sum(axis=0), np.full(50, 22))
+        self.assertTrue(np.all(_tp[1] == 0) and np.all(_fp[2] == 0))
+        _tp, _fp = _resampled_counts(np.random.default_rng(1), _positives, _negatives, 50, WEIGHTS_POISSON)
+        self.assertTrue(np.all(_tp[1] == 0) and np.all(_fp[2] == 0))
+        self.assertRaises(ValueError, _resampled_counts, np.random.default_rng(1), _positives, _negatives, 50,
+                          'uniform')
+
+    def test_reproducible(self):
+        _first = PerformanceBootstrap(self._evaluator, 200, seed=9).replicates(PREDICTOR.name, ACTUAL.name)
+        # several blocks, computed in processes
+        with patch('lib.bootstrap.BLOCK_ELEMENTS', 1000):
+            _blocks = PerformanceBootstrap(self._evaluator, 200, seed=9).replicates(PREDICTOR.name, ACTUAL.name)
+            _parallel = PerformanceBootstrap(self._evaluator, 200, seed=9,
+                                             workers=2).replicates(PREDICTOR.name, ACTUAL.name)
+        self.assertEqual(len(_first[0]), 200)
+        np.testing.assert_array_equal(_blocks[0], _parallel[0])
+        np.testing.assert_array_equal(_blocks[1], _parallel[1])
+        _second = PerformanceBootstrap(self._evaluator, 200, seed=9).replicates(PREDICTOR.name, ACTUAL.name)
+        np.testing.assert_array_equal(_first[0], _second[0])
+        np.testing.assert_array_equal(_first[1], _second[1])
+
+    def test_intervals(self):
+        (_auc_low, _auc_high), (_f1_low, _f1_high) = PerformanceBootstrap(self._evaluator, 500, seed=1).intervals(
+            PREDICTOR.name, ACTUAL.name)
+        self.assertTrue(0 <= _auc_low <= _auc_high <= 1)
+        self.assertTrue(0 <= _f1_low <= _f1_high <= 1)
+        # the interval of the area covers the area of the stories (the predictor is informative)
+        _auc = self._evaluator.roc_auc(PREDICTOR.name, ACTUAL.name, exact=True)
+        self.assertTrue(0.5 < _auc_low <= _auc <= _auc_high)
+
+    def test_empty(self):
+        pq.write_table(self._stories.set_column(
+            self._stories.schema.get_field_index(ACTUAL.name), ACTUAL.name,
+            pa.nulls(self._stories.num_rows, ACTUAL.otype)), self._file)
+        _bootstrap = PerformanceBootstrap(PaymentStoriesPerformanceEvaluator(self._file, 'test'), 10, seed=1)
+        _auc, _f1_max = _bootstrap.replicates(PREDICTOR.name, ACTUAL.name)
+        self.assertTrue(np.all(np.isnan(_auc)) and np.all(np.isnan(_f1_max)))
+        self.assertEqual(_bootstrap.intervals(PREDICTOR.name, ACTUAL.name), ((None, None), (None, None)))
+        self.assertEqual(_bootstrap.report([PREDICTOR], [ACTUAL]).iloc[0].isna().sum(), 4)
+
+
+if __name__ == '__main__':
+    main()
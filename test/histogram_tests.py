@@ -0,0 +1,146 @@
+from unittest import main
+from unittest import TestCase
+
+import tempfile
+
+import numpy as np
+
+from lib.histogram import PredictorHistogram, MANTISSA_BITS, histograms_table, pooled_histograms, write_histograms
+from lib.input_const import Path
+
+
+def _pairwise_auc(values: np.ndarray, actual: np.ndarray) -> float:
+    # every (positive, negative) pair: 1 if the positive is ranked above, a half if tied
+    _positives = values[actual]
+    _negatives = values[~actual]
+    if len(_positives) * len(_negatives) == 0:
+        return 0.0
+    _above = _positives[:, np.newaxis] > _negatives[np.newaxis, :]
+    _tied = _positives[:, np.newaxis] == _negatives[np.newaxis, :]
+    return float((_above.sum() + _tied.sum() / 2) / len(_positives) / len(_negatives))
+
+
+def _f1_max(values: np.ndarray, actual: np.ndarray) -> tuple[float, float]:
+    # the stories with the predictor greater than the threshold are predicted as positive
+    _best, _best_threshold = None, -np.inf
+    for _threshold in np.concatenate([[-np.inf], np.unique(values)]):
+        _predicted = values > _threshold
+        _tp = int(np.sum(_predicted & actual))
+        if _tp == 0:
+            continue
+        _f1 = 2 * _tp / (2 * _tp + int(np.sum(_predicted & ~actual)) + int(np.sum(~_predicted & actual)))
+        if _best is None or _f1 > _best:
+            _best, _best_threshold = _f1, _threshold
+    return _best, _best_threshold
+
+
+class PredictorHistogramTests(TestCase):
+
+    def setUp(self) -> None:
+        _rng = np.random.default_rng(7)
+        # ties (rounded values), negative values and zeros of both signs
+        self._values = np.concatenate([np.round(_rng.normal(0.0, 3.0, 600), 1), [0.0, -0.0, 0.0, -0.0]])
+        self._actual = _rng.random(len(self._values)) < 1 / (1 + np.exp(-self._values))
+
+    def _assert_equal_histograms(self, first: PredictorHistogram, second: PredictorHistogram):
+        self.assertEqual(first.precision_bits, second.precision_bits)
+        np.testing.assert_array_equal(first.bins(), second.bins())
+        np.testing.assert_array_equal(first.positives(), second.positives())
+        np.testing.assert_array_equal(first.negatives(), second.negatives())
+
+    def test_exact_precision(self):
+        _histogram = PredictorHistogram.of(self._values, self._actual, MANTISSA_BITS)
+        self.assertEqual(len(_histogram), len(np.unique(self._values)))
+        self.assertEqual(_histogram.positive_count(), int(self._actual.sum()))
+        self.assertEqual(_histogram.negative_count(), int((~self._actual).sum()))
+        np.testing.assert_array_equal(_histogram.upper_edges(), np.unique(self._values))
+        self.assertAlmostEqual(_histogram.roc_auc(), _pairwise_auc(self._values, self._actual), places=12)
+        _f1, _threshold = _histogram.f1_max()
+        _expected_f1, _expected_threshold = _f1_max(self._values, self._actual)
+        self.assertAlmostEqual(_f1, _expected_f1, places=12)
+        self.assertEqual(_threshold, _expected_threshold)
+
+    def test_roc_curve(self):
+        _histogram = PredictorHistogram.of(self._values, self._actual, MANTISSA_BITS)
+        _roc = _histogram.roc_curve()
+        for _threshold, (_fpr, _tpr) in zip(_roc.index, _roc.values):
+            _predicted = self._values > _threshold
+            self.assertAlmostEqual(_tpr, np.sum(_predicted & self._actual) / self._actual.sum(), places=12)
+            self.assertAlmostEqual(_fpr, np.sum(_predicted & ~self._actual) / (~self._actual).sum(), places=12)
+
+    def test_bins(self):
+        for _precision_bits in (0, 3, 10):
+            _histogram = PredictorHistogram.of(self._values, self._actual, _precision_bits)
+            self.assertEqual(_histogram.positive_count() + _histogram.negative_count(), len(self._values))
+            # every value falls between the upper edges of the previous bin and of its own bin
+            _edges = _histogram.upper_edges()
+            self.assertTrue(np.all(np.diff(_edges) > 0))
+            _bin_of_value = np.searchsorted(_edges, self._values, side='left')
+            self.assertTrue(np.all(_bin_of_value < len(_edges)))
+            _counts = np.bincount(_bin_of_value, minlength=len(_edges))
+            np.testing.assert_array_equal(_counts, _histogram.positives() + _histogram.negatives())
+
+    def test_coarsened(self):
+        _histogram = PredictorHistogram.of(self._values, self._actual, 12)
+        self._assert_equal_histograms(_histogram.coarsened(5), PredictorHistogram.of(self._values, self._actual, 5))
+        self.assertIs(_histogram.coarsened(12), _histogram)
+        self.assertRaises(ValueError, _histogram.coarsened, 13)
+
+    def test_merged(self):
+        _parts = np.array_split(np.arange(len(self._values)), 3)
+        _histograms = [PredictorHistogram.of(self._values[_part], self._actual[_part], _precision_bits)
+                       for _part, _precision_bits in zip(_parts, (10, 8, 10))]
+        self._assert_equal_histograms(PredictorHistogram.merged(_histograms),
+                                      PredictorHistogram.of(self._values, self._actual, 8))
+        self._assert_equal_histograms(_histograms[0] + _histograms[2],
+                                      PredictorHistogram.of(self._values[np.concatenate([_parts[0], _parts[2]])],
+                                                            self._actual[np.concatenate([_parts[0], _parts[2]])],
+                                                            10))
+
+    def test_of_bins(self):
+        _histogram = PredictorHistogram.of(self._values, self._actual, 10)
+        # the bins repeated and shuffled are summed up
+        _order = np.random.default_rng(1).permutation(2 * len(_histogram))
+        self._assert_equal_histograms(
+            PredictorHistogram.of_bins(np.tile(_histogram.bins(), 2)[_order],
+                                       np.tile(_histogram.positives(), 2)[_order],
+                                       np.tile(_histogram.negatives(), 2)[_order], 10),
+            PredictorHistogram(_histogram.bins(), 2 * _histogram.positives(), 2 * _histogram.negatives(), 10))
+
+    def test_pooled(self):
+        _halves = np.array_split(np.arange(len(self._values)), 2)
+        _tables = [histograms_table(_codename, {('p', 'a'): PredictorHistogram.of(self._values[_half],
+                                                                                  self._actual[_half]),
+                                                ('p', 'b'): PredictorHistogram.of(self._values[_half],
+                                                                                  ~self._actual[_half])})
+                   for _codename, _half in zip(('first', 'second'), _halves)]
+        with tempfile.TemporaryDirectory() as _dir:
+            _file = write_histograms(_tables, Path(_dir) / 'histograms.parquet')
+            _pooled = pooled_histograms(_file)
+            self.assertEqual(set(_pooled.keys()), {('p', 'a'), ('p', 'b')})
+            self._assert_equal_histograms(_pooled[('p', 'a')], PredictorHistogram.of(self._values, self._actual))
+            self._assert_equal_histograms(_pooled[('p', 'b')], PredictorHistogram.of(self._values, ~self._actual))
+            self._assert_equal_histograms(pooled_histograms(_file, ['second'])[('p', 'a')],
+                                          PredictorHistogram.of(self._values[_halves[1]], self._actual[_halves[1]]))
+            self.assertEqual(pooled_histograms(write_histograms([], Path(_dir) / 'empty.parquet')), {})
+
+    def test_empty(self):
+        for _histogram in (PredictorHistogram.of(np.array([]), np.array([], dtype=bool)),
+                           PredictorHistogram.merged([])):
+            self.assertEqual(len(_histogram), 0)
+            self.assertEqual(_histogram.roc_auc(), 0.0)
+            self.assertEqual(_histogram.f1_max(), (None, -np.inf))
+            self.assertEqual(len(_histogram.roc_curve()), 1)
+
+    def test_single_class(self):
+        _histogram = PredictorHistogram.of(self._values, np.zeros(len(self._values), dtype=bool))
+        self.assertEqual(_histogram.roc_auc(), 0.0)
+        self.assertEqual(_histogram.f1_max()[0], None)
+
+    def test_idiot_durability(self):
+        self.assertRaises(ValueError, PredictorHistogram.of, self._values, self._actual, MANTISSA_BITS + 1)
+        self.assertRaises(ValueError, PredictorHistogram.of, self._values, self._actual, -1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+from unittest import main
+from unittest import TestCase
+from unittest.mock import patch
+
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lib.input_const import *
+from lib.paystories import PaymentHistoryGrouper, PaymentStoriesBuilder
+from shards_tests import _pay_delay_with_debts
+
+CODENAME = 'test'
+
+
+class PaymentStoriesBuilderTests(TestCase):
+
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()
+        self._processing = Path(self._dir.name)
+        self._patch = patch('lib.paystories.DIR_PROCESSING', self._processing)
+        self._patch.start()
+        _source = self._processing / 'source.parquet'
+        pq.write_table(_pay_delay_with_debts(np.random.default_rng(21), 300), _source)
+        _grouper = PaymentHistoryGrouper(_source, CODENAME)
+        _grouper.content()
+        _grouper.detect_dividers()
+        _grouper.calculate_story_ids()
+        _grouped = pq.read_table(_grouper.store(self._processing / 'grouped.parquet'))
+        # the stories are not contiguous, they are aggregated by hash group-by
+        self._file = self._processing / 'shuffled.parquet'
+        pq.write_table(_grouped.take(np.random.default_rng(1).permutation(_grouped.num_rows)), self._file)
+
+    def tearDown(self) -> None:
+        self._patch.stop()
+        self._dir.cleanup()
+
+    def test_streamed(self):
+        _builder = PaymentStoriesBuilder(self._file, CODENAME)
+        _builder.tendencies()
+        self.assertFalse(_builder.streamed())
+        _stories = _builder.stored_stories().sort_by(PaymentStoriesColumns.StoryId.name)
+        _derived = pq.read_table(_builder.write_derived_payments(self._processing / 'derived.parquet'))
+
+        # the payments with derived columns exceed the limit, each partition spilled is partitioned again
+        with patch.object(PaymentStoriesBuilder, '_SPILL_WHEN_LARGER_THAN_BYTES', 20000), \
+                patch.object(PaymentStoriesBuilder, 'STREAMING_BATCH_SIZE', 500):
+            _streamed = PaymentStoriesBuilder(self._file, CODENAME)
+            _streamed.story_timeline()
+            _streamed.severity()
+            _streamed.tendencies()
+            self.assertTrue(_streamed.streamed())
+            # no derived column is computed for all payments at once
+            self.assertEqual(_streamed.payments().column_names, PaymentStoriesBuilder.COLUMNS)
+            _streamed_derived = pq.read_table(
+                _streamed.write_derived_payments(self._processing / 'streamed_derived.parquet'))
+        _streamed_stories = _streamed.stored_stories().sort_by(PaymentStoriesColumns.StoryId.name)
+
+        self.assertEqual(_streamed_stories.schema, _stories.schema)
+        for _name in _stories.column_names:
+            _column = _streamed_stories.column(_name)
+            if pa.types.is_floating(_column.type):
+                # the variances are merged from the partial results of other batches
+                np.testing.assert_allclose(_column.to_numpy(zero_copy_only=False),
+                                           _stories.column(_name).to_numpy(zero_copy_only=False),
+                                           rtol=1e-5, atol=1e-5, equal_nan=True, err_msg=_name)
+            else:
+                self.assertEqual(_column.to_pylist(), _stories.column(_name).to_pylist(), _name)
+        self.assertTrue(_streamed_derived.equals(_derived, check_metadata=True))
+        self.assertEqual(_derived.column_names, [_c.name for _c in PaymentGroupsColumns.Derived])
+
+
+if __name__ == '__main__':
+    main()
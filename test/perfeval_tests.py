@@ -0,0 +1,202 @@
+from unittest import main
+from unittest import TestCase
+
+import math
+import tempfile
+
+from typing import Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lib.input_const import *
+from lib.perfeval import PaymentStoriesPerformanceEvaluator
+
+PREDICTOR = PaymentStoriesColumns.ScaledDelayMean
+ACTUAL = PaymentStoriesColumns.DenotesAnyRisk
+GROUP = PaymentStoriesColumns.BeginsWithCreditStatus
+
+
+def _pairwise_auc(values: np.ndarray, actual: np.ndarray) -> float:
+    # every (positive, negative) pair: 1 if the positive is ranked above, a half if tied
+    _positives = values[actual]
+    _negatives = values[~actual]
+    if len(_positives) * len(_negatives) == 0:
+        return 0.0
+    _above = _positives[:, np.newaxis] > _negatives[np.newaxis, :]
+    _tied = _positives[:, np.newaxis] == _negatives[np.newaxis, :]
+    return float((_above.sum() + _tied.sum() / 2) / len(_positives) / len(_negatives))
+
+
+def _average_precision(values: np.ndarray, actual: np.ndarray) -> Optional[float]:
+    # the precision of the stories with the predictor greater or equal to every positive (the ties together)
+    if not np.any(actual):
+        return None
+    return float(np.mean([np.sum(actual & (values >= _value)) / np.sum(values >= _value)
+                          for _value in values[actual]]))
+
+
+def _confusion_matrices(values: np.ndarray, actual: np.ndarray) -> list[tuple[float, int, int, int, int]]:
+    # the stories with the predictor greater than the threshold are predicted as positive
+    _matrices = []
+    for _threshold in np.concatenate([[-np.inf], np.unique(values)]):
+        _predicted = values > _threshold
+        _matrices.append((float(_threshold), int(np.sum(_predicted & actual)), int(np.sum(~_predicted & actual)),
+                          int(np.sum(_predicted & ~actual)), int(np.sum(~_predicted & ~actual))))
+    return _matrices
+
+
+def _first_max(scores: list[tuple[float, Optional[float]]]) -> tuple[Optional[float], Optional[float]]:
+    _best, _best_threshold = None, None
+    for _threshold, _score in scores:
+        if _score is not None and (_best is None or _score > _best):
+            _best, _best_threshold = _score, _threshold
+    return _best, _best_threshold
+
+
+def _f1_max(values: np.ndarray, actual: np.ndarray) -> tuple[Optional[float], Optional[float]]:
+    return _first_max([(_th, None if _tp == 0 else 2 * _tp / (2 * _tp + _fp + _fn))
+                       for _th, _tp, _fn, _fp, _tn in _confusion_matrices(values, actual)])
+
+
+def _kappa_max(values: np.ndarray, actual: np.ndarray, risk_rate: float) -> tuple[Optional[float], Optional[float]]:
+    return _first_max([(_th, ((_tp + _tn) / (_tp + _fn + _fp + _tn) - risk_rate) / (1 - risk_rate))
+                       for _th, _tp, _fn, _fp, _tn in _confusion_matrices(values, actual)])
+
+
+class PerformanceEvaluatorTests(TestCase):
+
+    def setUp(self) -> None:
+        _rng = np.random.default_rng(11)
+        _count = 400
+        # ties (rounded values), NaN and null predictors, unknown actual values and stories of a single payment
+        _values = np.round(_rng.normal(0.0, 1.0, _count), 1).astype(np.float32)
+        _actual = _rng.random(_count) < 1 / (1 + np.exp(-2 * _values))
+        _values[_rng.choice(_count, 10, replace=False)] = np.nan
+        self._stories = pa.table({
+            PREDICTOR.name: pa.array(_values, PREDICTOR.otype, mask=_rng.random(_count) < 0.03),
+            PaymentStoriesColumns.PaymentsCount.name: pa.array(_rng.integers(1, 6, _count),
+                                                               PaymentStoriesColumns.PaymentsCount.otype),
+            ACTUAL.name: pa.array(_actual, ACTUAL.otype, mask=_rng.random(_count) < 0.05),
+            GROUP.name: pa.array(_rng.integers(0, 4, _count), GROUP.otype, mask=_rng.random(_count) < 0.05)
+        })
+        self._dir = tempfile.TemporaryDirectory()
+        self._file = Path(self._dir.name) / 'stories.parquet'
+        pq.write_table(self._stories, self._file)
+        self._evaluator = PaymentStoriesPerformanceEvaluator(self._file, 'test')
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def _evaluated(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: the predictor, actual and group of the stories the predictor is evaluated on (see _predictor_filter)
+        """
+        _stories = self._stories.to_pandas()
+        _stories = _stories[_stories[PREDICTOR.name].notna() & (_stories[PaymentStoriesColumns.PaymentsCount.name] > 1)
+                            & _stories[ACTUAL.name].notna()]
+        return _stories[PREDICTOR.name].values.astype(np.float64), _stories[ACTUAL.name].values.astype(bool), \
+            _stories[GROUP.name].values
+
+    def test_exact_metrics(self):
+        _values, _actual, _ = self._evaluated()
+        self.assertAlmostEqual(self._evaluator.roc_auc(PREDICTOR.name, ACTUAL.name, exact=True),
+                               _pairwise_auc(_values, _actual), places=12)
+        self.assertAlmostEqual(self._evaluator.precision_recall_auc(PREDICTOR.name, ACTUAL.name),
+                               _average_precision(_values, _actual), places=12)
+        _f1, _threshold = self._evaluator.f1_max(PREDICTOR.name, ACTUAL.name, exact=True)
+        _expected_f1, _expected_threshold = _f1_max(_values, _actual)
+        self.assertAlmostEqual(_f1, _expected_f1, places=12)
+        self.assertEqual(_threshold, _expected_threshold)
+        _kappa, _threshold = self._evaluator.cohen_kappa_max(PREDICTOR.name, ACTUAL.name, exact=True)
+        _expected_kappa, _expected_threshold = _kappa_max(_values, _actual,
+                                                          self._evaluator.risk_rate(ACTUAL.name))
+        self.assertAlmostEqual(_kappa, _expected_kappa, places=12)
+        self.assertEqual(_threshold, _expected_threshold)
+
+    def test_confusion_matrices(self):
+        _values, _actual, _ = self._evaluated()
+        _expected = _confusion_matrices(_values, _actual)
+        _tp, _fn, _fp, _tn = self._evaluator.confusion_matrices(PREDICTOR.name, [_m[0] for _m in _expected],
+                                                                ACTUAL.name)
+        self.assertEqual(list(zip(_tp, _fn, _fp, _tn)), [_m[1:] for _m in _expected])
+
+    def test_value_counts(self):
+        _values, _actual, _ = self._evaluated()
+        _distinct, _positives, _negatives = self._evaluator.value_counts(PREDICTOR.name, ACTUAL.name)
+        np.testing.assert_array_equal(_distinct, np.unique(_values)[::-1])
+        np.testing.assert_array_equal(_positives, [np.sum(_actual & (_values == _v)) for _v in _distinct])
+        np.testing.assert_array_equal(_negatives, [np.sum(~_actual & (_values == _v)) for _v in _distinct])
+
+    def test_predictors_report(self):
+        _values, _actual, _ = self._evaluated()
+        _report = self._evaluator.predictors_report([PREDICTOR], [ACTUAL])
+        self.assertAlmostEqual(
+            _report.iloc[0][StoriesPerformanceReportColNames.PredictorPerformanceROCAUC(PREDICTOR, ACTUAL)],
+            _pairwise_auc(_values, _actual), places=12)
+
+    def test_grouped_metrics(self):
+        _values, _actual, _groups = self._evaluated()
+        _codes = np.where(np.isnan(_groups), 9, _groups).astype(np.int64)
+        _metrics = PaymentStoriesPerformanceEvaluator._grouped_metrics(_codes, _values, _actual)
+        np.testing.assert_array_equal(_metrics['group'], np.unique(_codes))
+        for _i, _code in enumerate(_metrics['group']):
+            _in_group = _codes == _code
+            self.assertEqual(_metrics['stories'][_i], np.sum(_in_group))
+            self.assertEqual(_metrics['positives'][_i], np.sum(_actual[_in_group]))
+            self.assertAlmostEqual(_metrics['roc_auc'][_i], _pairwise_auc(_values[_in_group], _actual[_in_group]),
+                                   places=12)
+            self.assertAlmostEqual(_metrics['pr_auc'][_i],
+                                   _average_precision(_values[_in_group], _actual[_in_group]), places=12)
+            _f1, _threshold = _f1_max(_values[_in_group], _actual[_in_group])
+            self.assertAlmostEqual(_metrics['f1_max'][_i], _f1, places=12)
+            self.assertEqual(_metrics['f1_max_threshold'][_i], _threshold)
+
+    def test_grouped_metrics_single_class(self):
+        # the group without positives, the group without negatives and the group of a single story
+        _codes = np.array([0, 0, 0, 1, 1, 2])
+        _values = np.array([0.1, 0.2, 0.2, 0.5, 0.3, 0.7])
+        _actual = np.array([False, False, False, True, True, True])
+        _metrics = PaymentStoriesPerformanceEvaluator._grouped_metrics(_codes, _values, _actual)
+        np.testing.assert_array_equal(_metrics['roc_auc'], [0.0, 0.0, 0.0])
+        self.assertTrue(math.isnan(_metrics['pr_auc'][0]))
+        self.assertTrue(math.isnan(_metrics['f1_max'][0]))
+        np.testing.assert_array_equal(_metrics['pr_auc'][1:], [1.0, 1.0])
+        np.testing.assert_array_equal(_metrics['f1_max'][1:], [1.0, 1.0])
+        np.testing.assert_array_equal(_metrics['f1_max_threshold'][1:], [-np.inf, -np.inf])
+
+    def test_grouped_report(self):
+        _values, _actual, _groups = self._evaluated()
+        _report = self._evaluator.grouped_report(GROUP.name, [PREDICTOR], [ACTUAL])
+        # the stories without credit status are the last group
+        self.assertEqual(_report[GROUP.name].tolist()[:-1], [0, 1, 2, 3])
+        self.assertTrue(math.isnan(_report[GROUP.name].iloc[-1]))
+        self.assertEqual(_report['stories'].sum(), len(_values))
+        _row = _report[_report[GROUP.name] == 2].iloc[0]
+        self.assertAlmostEqual(_row['roc_auc'], _pairwise_auc(_values[_groups == 2], _actual[_groups == 2]),
+                               places=12)
+
+        _bucketed = self._evaluator.grouped_report(GROUP.name, [PREDICTOR], [ACTUAL], bins=[1.5])
+        self.assertEqual(_bucketed[GROUP.name].tolist()[:-1], [-math.inf, 1.5])
+        self.assertTrue(math.isnan(_bucketed[GROUP.name].iloc[-1]))
+        _row = _bucketed[_bucketed[GROUP.name] == 1.5].iloc[0]
+        self.assertAlmostEqual(_row['roc_auc'], _pairwise_auc(_values[_groups >= 2], _actual[_groups >= 2]),
+                               places=12)
+
+    def test_empty(self):
+        # no story the predictor is evaluated on
+        _stories = self._stories.set_column(
+            self._stories.schema.get_field_index(ACTUAL.name), ACTUAL.name, pa.nulls(self._stories.num_rows,
+                                                                                     ACTUAL.otype))
+        pq.write_table(_stories, self._file)
+        _evaluator = PaymentStoriesPerformanceEvaluator(self._file, 'test')
+        self.assertEqual(_evaluator.roc_auc(PREDICTOR.name, ACTUAL.name, exact=True), 0.0)
+        self.assertIsNone(_evaluator.precision_recall_auc(PREDICTOR.name, ACTUAL.name))
+        self.assertEqual(_evaluator.f1_max(PREDICTOR.name, ACTUAL.name, exact=True), (None, -np.inf))
+        self.assertEqual(len(_evaluator.value_counts(PREDICTOR.name, ACTUAL.name)[0]), 0)
+        self.assertEqual(len(_evaluator.grouped_report(GROUP.name, [PREDICTOR], [ACTUAL])), 0)
+
+
+if __name__ == '__main__':
+    main()
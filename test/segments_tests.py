@@ -0,0 +1,116 @@
+from unittest import main
+from unittest import TestCase
+
+import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from lib.segments import Segments, segments_if_sorted
+
+
+class SegmentsTests(TestCase):
+
+    def setUp(self) -> None:
+        _rng = np.random.default_rng(5)
+        _count = 500
+        # groups of 1 - 9 records (the keys ascending, not consecutive) with nulls in the values
+        _keys = np.repeat(np.cumsum(_rng.integers(1, 4, 100)), _rng.integers(1, 10, 100))[:_count]
+        _count = len(_keys)
+        _nulls = _rng.random(_count) < 0.2
+        self._table = pa.table({
+            'key': pa.array(_keys, pa.int64()),
+            'float': pa.array(_rng.normal(0.0, 10.0, _count), pa.float64(), mask=_nulls),
+            'int': pa.array(_rng.integers(-1000, 1000, _count), pa.int32()),
+            'uint': pa.array(_rng.integers(0, 1000, _count), pa.uint16(), mask=_nulls),
+            'date': pa.array([datetime.date(2020, 1, 1) + datetime.timedelta(days=int(_d))
+                              for _d in _rng.integers(0, 1000, _count)], pa.date32(), mask=_nulls),
+            # the whole group is null (the first one)
+            'sparse': pa.array(np.arange(_count, dtype=np.float64), pa.float64(), mask=_keys == _keys[0])
+        })
+        self._segments = Segments(self._table.column('key'))
+
+    def _expected(self, column: str, function: str) -> list:
+        return self._table.group_by('key', use_threads=False).aggregate([(column, function)]).sort_by(
+            'key').column(f'{column}_{function}').to_pylist()
+
+    def test_segments(self):
+        _keys = np.unique(self._table.column('key').to_numpy())
+        self.assertEqual(len(self._segments), len(_keys))
+        self.assertEqual(self._segments.keys().to_pylist(), _keys.tolist())
+        np.testing.assert_array_equal(self._segments.lengths(),
+                                      [np.sum(self._table.column('key').to_numpy() == _k) for _k in _keys])
+
+    def test_reductions(self):
+        for _column in ('float', 'int', 'uint', 'sparse'):
+            for _function in ('count', 'min', 'max'):
+                self.assertEqual(getattr(self._segments, _function)(self._table.column(_column)).to_pylist(),
+                                 self._expected(_column, _function), f'{_function} of {_column}')
+            # the floating-point sums differ only in the order of summation (null for the groups of nulls)
+            for _function in ('sum', 'mean'):
+                _result = getattr(self._segments, _function)(self._table.column(_column)).to_pylist()
+                _expected = self._expected(_column, _function)
+                self.assertEqual([_v is None for _v in _result], [_v is None for _v in _expected])
+                np.testing.assert_allclose(np.array(_result, dtype=np.float64), np.array(_expected, dtype=np.float64),
+                                           rtol=1e-12, equal_nan=True, err_msg=f'{_function} of {_column}')
+        for _function in ('count', 'min', 'max'):
+            self.assertEqual(getattr(self._segments, _function)(self._table.column('date')).to_pylist(),
+                             self._expected('date', _function), f'{_function} of date')
+        self.assertEqual(self._segments.min_max(self._table.column('int')).to_pylist(),
+                         self._expected('int', 'min_max'))
+
+    def test_variance(self):
+        # the population variance of the valid values
+        _keys = self._table.column('key').to_numpy()
+        for _column in ('int', 'float'):
+            _values = self._table.column(_column).to_numpy(zero_copy_only=False).astype(np.float64)
+            _valid = ~np.isnan(_values)
+            with np.errstate(invalid='ignore'):
+                _expected = [np.var(_values[(_keys == _k) & _valid]) if np.any((_keys == _k) & _valid) else np.nan
+                             for _k in np.unique(_keys)]
+            np.testing.assert_allclose(
+                self._segments.variance(self._table.column(_column)).to_numpy(zero_copy_only=False), _expected,
+                rtol=1e-9, atol=1e-9, equal_nan=True, err_msg=f'variance of {_column}')
+
+    def test_aggregate(self):
+        _agg = [('float', 'mean'), ('int', 'sum'), ('date', 'max'), ('uint', 'count')]
+        _aggregated = self._segments.aggregate(self._table, 'key', _agg)
+        _expected = self._table.group_by('key', use_threads=False).aggregate(_agg).sort_by('key')
+        self.assertEqual(_aggregated.column_names, ['key', 'float_mean', 'int_sum', 'date_max', 'uint_count'])
+        for _name in _aggregated.column_names:
+            if _name == 'float_mean':
+                np.testing.assert_allclose(_aggregated.column(_name).to_numpy(zero_copy_only=False),
+                                           _expected.column(_name).to_numpy(zero_copy_only=False), rtol=1e-12)
+            else:
+                self.assertEqual(_aggregated.column(_name).to_pylist(), _expected.column(_name).to_pylist())
+        self.assertRaises(ValueError, self._segments.aggregate, self._table, 'key', [('int', 'median')])
+        self.assertRaises(ValueError, self._segments.aggregate, self._table.slice(1), 'key', _agg)
+
+    def test_first_last_broadcast(self):
+        _keys = self._table.column('key').to_numpy()
+        _float = self._table.column('float').to_pylist()
+        _first = [_float[np.flatnonzero(_keys == _k)[0]] for _k in np.unique(_keys)]
+        _last = [_float[np.flatnonzero(_keys == _k)[-1]] for _k in np.unique(_keys)]
+        self.assertEqual(self._segments.first(self._table.column('float')).to_pylist(), _first)
+        self.assertEqual(self._segments.last(self._table.column('float')).to_pylist(), _last)
+        self.assertEqual(self._segments.broadcast(self._segments.keys()).to_pylist(),
+                         self._table.column('key').to_pylist())
+
+    def test_if_sorted(self):
+        self.assertIsNotNone(segments_if_sorted(self._table.column('key')))
+        self.assertIsNone(segments_if_sorted(pc.negate(self._table.column('key'))))
+        self.assertIsNone(segments_if_sorted(pa.array([1, 1, None, 2], pa.int64())))
+
+    def test_empty(self):
+        _table = self._table.slice(0, 0)
+        _segments = Segments(_table.column('key'))
+        self.assertEqual(len(_segments), 0)
+        _aggregated = _segments.aggregate(_table, 'key', [('float', 'mean'), ('int', 'sum'), ('date', 'max'),
+                                                          ('uint', 'count'), ('int', 'variance')])
+        self.assertEqual(_aggregated.num_rows, 0)
+        self.assertEqual(_segments.broadcast(_segments.keys()).to_pylist(), [])
+
+
+if __name__ == '__main__':
+    main()
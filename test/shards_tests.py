@@ -0,0 +1,122 @@
+from unittest import main
+from unittest import TestCase
+from unittest.mock import patch
+
+import datetime
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lib.input_const import *
+from lib.paystories import PaymentHistoryGrouper, PaymentStoriesBuilder, build_stories_in_shards, entity_ranges, \
+    group_in_shards
+from lib.util import sorting_columns
+
+CODENAME = 'test'
+INPUT_CODE = 'T'
+
+
+def _pay_delay_with_debts(rng: np.random.Generator, entities: int) -> pa.Table:
+    """
+    :return: the payment delays with debts numbered by pd-id in order of entity and due-date
+    (as by 121_join_debts_to_pd)
+    """
+    _counts = rng.integers(1, 30, entities)
+    _entities = np.repeat(np.arange(1, entities + 1), _counts)
+    _count = len(_entities)
+    _days = np.concatenate([np.sort(rng.integers(0, 800, _c)) for _c in _counts])
+    _delays = rng.normal(5, 40, _count).astype(np.int64)
+    return pa.table({
+        PayDelayColumns.Id.name: pa.array(np.arange(1, _count + 1), PayDelayColumns.Id.otype),
+        PayDelayColumns.EntityId.name: pa.array(_entities, PayDelayColumns.EntityId.otype),
+        PayDelayColumns.DueDate.name: pa.array([datetime.date(2020, 1, 1) + datetime.timedelta(days=int(_d))
+                                                for _d in _days], PayDelayColumns.DueDate.otype),
+        PayDelayColumns.DelayDays.name: pa.array(_delays, PayDelayColumns.DelayDays.otype),
+        PayDelayColumns.InvoicedAmount.name: pa.array(rng.integers(1, 10000, _count),
+                                                      PayDelayColumns.InvoicedAmount.otype,
+                                                      mask=rng.random(_count) < 0.02),
+        PayDelayColumns.PriorDebtsMaxCreditStatus.name: pa.array(rng.integers(1, 5, _count),
+                                                                 PayDelayColumns.PriorDebtsMaxCreditStatus.otype,
+                                                                 mask=rng.random(_count) < 0.9),
+        **{PayDelayColumns.LaterDebtsMinDaysToValidFrom(_cs).name: pa.array(
+            rng.integers(1, 300, _count), PayDelayColumns.LaterDebtsMinDaysToValidFrom(_cs).otype,
+            mask=rng.random(_count) < 0.95) for _cs in range(1, 5)},
+        PayDelayColumns.IsOutlier.name: pa.array(
+            (_delays < OUTLIER__MIN_DELAY) | (_delays > OUTLIER__MAX_DELAY), PayDelayColumns.IsOutlier.otype)
+    })
+
+
+class ShardsTests(TestCase):
+
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()
+        self._processing = Path(self._dir.name)
+        # the files of the shards are written to the processing directory
+        self._patches = [patch('lib.input_const.DIR_PROCESSING', self._processing),
+                         patch('lib.paystories.DIR_PROCESSING', self._processing)]
+        for _patch in self._patches:
+            _patch.start()
+        _source = _pay_delay_with_debts(np.random.default_rng(13), 300)
+        self._sorted_file = self._processing / 'sorted.parquet'
+        pq.write_table(_source, self._sorted_file, row_group_size=500,
+                       sorting_columns=sorting_columns(_source, [PayDelayColumns.Id.name]))
+        self._unsorted_file = self._processing / 'unsorted.parquet'
+        pq.write_table(_source, self._unsorted_file, row_group_size=500)
+
+        # the single-process results
+        _grouper = PaymentHistoryGrouper(self._sorted_file, CODENAME)
+        _grouper.content()
+        _grouper.detect_dividers()
+        _grouper.calculate_story_ids()
+        self._grouped = pq.read_table(_grouper.store(self._processing / 'grouped.parquet'))
+
+    def tearDown(self) -> None:
+        for _patch in self._patches:
+            _patch.stop()
+        self._dir.cleanup()
+
+    def _assert_equal_tables(self, table: pa.Table, expected: pa.Table, message: str):
+        self.assertEqual(table.schema, expected.schema, message)
+        for _name in expected.column_names:
+            _column = table.column(_name)
+            self.assertEqual(_column.is_null().to_pylist(), expected.column(_name).is_null().to_pylist(), message)
+            # the tendencies of a single payment are NaN, equal to each other here
+            np.testing.assert_array_equal(_column.to_numpy(zero_copy_only=False),
+                                          expected.column(_name).to_numpy(zero_copy_only=False),
+                                          f'{_name} of {message}')
+
+    def test_entity_ranges(self):
+        for _file in (self._sorted_file, self._unsorted_file):
+            self.assertEqual(entity_ranges(_file, 1), [(None, None)])
+            self.assertEqual(entity_ranges(_file, 0), [(None, None)])
+            _ranges = entity_ranges(_file, 3)
+            self.assertEqual(len(_ranges), 3)
+            self.assertEqual(_ranges[0][0], None)
+            self.assertEqual(_ranges[-1][1], None)
+            self.assertEqual([_r[1] for _r in _ranges[:-1]], [_r[0] for _r in _ranges[1:]])
+
+    def test_shards(self):
+        for _file in (self._sorted_file, self._unsorted_file):
+            for _shards in (1, 2, 3):
+                _written = group_in_shards(_file, CODENAME, INPUT_CODE, _shards)
+                _grouped_file = payments_grouped_by_stories_file(INPUT_CODE, CODENAME)
+                _message = f'{_shards} shards of {_file.name}'
+                self.assertEqual(_written, self._grouped.num_rows)
+                self._assert_equal_tables(pq.read_table(_grouped_file), self._grouped, _message)
+
+                # the single-process results of the same file (the approximate median depends on its row groups)
+                _builder = PaymentStoriesBuilder(_grouped_file, CODENAME)
+                _builder.tendencies()
+                _stories = _builder.stored_stories()
+                _scaling, _count = build_stories_in_shards(_grouped_file, CODENAME, INPUT_CODE, _shards)
+                self.assertEqual(_scaling, _builder.scaling_parameters())
+                self.assertEqual(_count, _stories.num_rows)
+                self._assert_equal_tables(pq.read_table(payment_stories_file(INPUT_CODE, CODENAME)), _stories, _message)
+                self._assert_equal_tables(pq.read_table(payments_derived_file(INPUT_CODE, CODENAME)),
+                                          _builder.derived_payments(), _message)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+from unittest import main
+from unittest import TestCase
+
+import datetime
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from lib.input_const import *
+from lib.paystories import PaymentHistoryGrouper, PaymentStoriesBuilder, calculate_scaling_parameters
+from lib.storystate import IncrementalStories, updated_stories
+from lib.util import compact
+
+BEGIN = datetime.date(2020, 1, 1)
+# the first payment of the second input is due on the cut-off day (or later)
+CUTOFF = BEGIN + datetime.timedelta(days=400)
+
+
+def _day(days: int) -> datetime.date:
+    return BEGIN + datetime.timedelta(days=days)
+
+
+def _pay_delay_with_debts(payments: list[tuple], debts: list[tuple], first_input_debts: list[tuple] = None) -> pa.Table:
+    """
+    The payments of an input numbered and joined to the debts as by 111_convert_pd_to_parquet
+    and 121_join_debts_to_pd (the pd-ids from 1 in order of entity and due-date)
+    :param payments: (entity, due-date, delay, amount)
+    :param debts: (entity, credit status, valid-from, valid-to)
+    :param first_input_debts: if provided, the payments of the first input (due before the cut-off) are joined
+    to these debts only, except the last one of every entity (the later debts are applied to it incrementally)
+    """
+    _payments = sorted(payments, key=lambda _p: (_p[0], _p[1]))
+    _last_of_first_input = {}
+    for _entity, _due_date, _, _ in _payments:
+        if _due_date < CUTOFF:
+            _last_of_first_input[_entity] = _due_date
+    _columns = {PayDelayColumns.LaterDebtsMinDaysToValidFrom(_cs).name: [] for _cs in range(1, 5)}
+    _prior = []
+    for _entity, _due_date, _, _ in _payments:
+        _debts = debts if first_input_debts is None or _due_date >= _last_of_first_input.get(_entity, _due_date) \
+            else first_input_debts
+        _debts = [_d for _d in _debts if _d[0] == _entity]
+        _prior_cs = [_cs for _, _cs, _from, _to in _debts if _from < _due_date < _to]
+        _prior.append(max(_prior_cs) if _prior_cs else None)
+        for _cs in range(1, 5):
+            _later = [(_from - _due_date).days for _, _c, _from, _ in _debts if _c == _cs and _from > _due_date]
+            _columns[PayDelayColumns.LaterDebtsMinDaysToValidFrom(_cs).name].append(min(_later) if _later else None)
+    _delays = [_p[2] for _p in _payments]
+    return pa.table({
+        PayDelayColumns.Id.name: pa.array(range(1, len(_payments) + 1), PayDelayColumns.Id.otype),
+        PayDelayColumns.EntityId.name: pa.array([_p[0] for _p in _payments], PayDelayColumns.EntityId.otype),
+        PayDelayColumns.DueDate.name: pa.array([_p[1] for _p in _payments], PayDelayColumns.DueDate.otype),
+        PayDelayColumns.DelayDays.name: pa.array(_delays, PayDelayColumns.DelayDays.otype),
+        PayDelayColumns.InvoicedAmount.name: pa.array([_p[3] for _p in _payments],
+                                                      PayDelayColumns.InvoicedAmount.otype),
+        PayDelayColumns.PriorDebtsMaxCreditStatus.name: pa.array(_prior,
+                                                                 PayDelayColumns.PriorDebtsMaxCreditStatus.otype),
+        **{_name: pa.array(_values, PayDelayColumns.LaterDebtsMinDaysToValidFrom(1).otype)
+           for _name, _values in _columns.items()},
+        PayDelayColumns.IsOutlier.name: pa.array([not OUTLIER__MIN_DELAY <= _d <= OUTLIER__MAX_DELAY for _d in _delays],
+                                                 PayDelayColumns.IsOutlier.otype)
+    })
+
+
+def _debts_table(debts: list[tuple]) -> pa.Table:
+    return pa.table({
+        DebtColumns.LiabilityOwner.name: pa.array([_d[0] for _d in debts], DebtColumns.LiabilityOwner.otype),
+        DebtColumns.CreditStatus.name: pa.array([_d[1] for _d in debts], DebtColumns.CreditStatus.otype),
+        DebtColumns.ValidFrom.name: pa.array([_d[2] for _d in debts], DebtColumns.ValidFrom.otype),
+        DebtColumns.ValidTo.name: pa.array([_d[3] for _d in debts], DebtColumns.ValidTo.otype)
+    })
+
+
+class IncrementalStoriesTests(TestCase):
+
+    def setUp(self) -> None:
+        _rng = np.random.default_rng(17)
+        self._payments = []
+        self._debts = []
+        for _entity in range(1, 121):
+            for _days in np.sort(_rng.integers(0, 800, _rng.integers(1, 25))):
+                self._payments.append((_entity, _day(int(_days)), int(_rng.normal(5, 40)),
+                                       None if _rng.random() < 0.02 else int(_rng.integers(1, 10000))))
+            for _ in range(_rng.integers(0, 3)):
+                _from = int(_rng.integers(0, 850))
+                self._debts.append((_entity, int(_rng.integers(1, 5)), _day(_from), _day(_from + 300)))
+        # the boundary: the story ended by a debt registered only after the first input (valid from between
+        # the last payment of the first input and the first payment of the second one)
+        self._payments += [(1001, _day(380), 10, 100), (1001, _day(395), 12, 100), (1001, _day(405), 3, 100)]
+        self._debts.append((1001, 3, _day(398), _day(600)))
+        # the story continued over the boundary, with payments due on the cut-off day
+        self._payments += [(1002, _day(390), 10, 100), (1002, CUTOFF, 20, 100), (1002, CUTOFF, 0, 100),
+                           (1002, _day(420), 5, 100)]
+        # the outliers: the last payment of the first input, the first one of the second input
+        self._payments += [(1003, _day(370), 10, 100), (1003, _day(399), 1000, 100), (1003, _day(410), 7, 100)]
+        self._payments += [(1007, _day(380), 5, 100), (1007, _day(401), -200, 100), (1007, _day(415), 4, 100)]
+        # the entities of a single input
+        self._payments += [(1004, _day(100), 1, 100), (1005, _day(500), 2, 100)]
+        # the story ended by an outlier within the first input and a debt registered only after it
+        self._payments += [(1006, _day(100), 5, 100), (1006, _day(120), 900, 100), (1006, _day(150), 3, 100)]
+        self._debts.append((1006, 2, _day(500), _day(700)))
+
+        self._all = _pay_delay_with_debts(self._payments, self._debts)
+        self._scaling = calculate_scaling_parameters(self._all.filter(~pc.field(PayDelayColumns.IsOutlier.name)))
+
+    def _batch(self, payments: pa.Table = None) -> pa.Table:
+        _grouper = PaymentHistoryGrouper(None, 'test', content=(self._all if payments is None else payments).filter(
+            ~pc.field(PayDelayColumns.IsOutlier.name)).select(PaymentHistoryGrouper.COLUMNS))
+        _grouper.detect_dividers()
+        _grouper.calculate_story_ids()
+        return PaymentStoriesBuilder(None, 'test', scaling=self._scaling, payments=_grouper.combine()).tendencies()
+
+    def _inputs(self) -> tuple[pa.Table, pa.Table, pa.Table]:
+        """
+        :return: the payments of the first and of the second input (each joined to the debts known at its time,
+        the debts of the second input are all debts) and the debts of the second input
+        """
+        _first = [_p for _p in self._payments if _p[1] < CUTOFF]
+        _second = [_p for _p in self._payments if _p[1] >= CUTOFF]
+        return _pay_delay_with_debts(_first, self._first_input_debts()), \
+            _pay_delay_with_debts(_second, self._debts), _debts_table(self._debts)
+
+    def _first_input_debts(self) -> list[tuple]:
+        return [_d for _d in self._debts if _d[2] < CUTOFF]
+
+    def _batch_as_known(self) -> pa.Table:
+        """
+        :return: the batch of both inputs with the debts as known at the time of the first one, the stories ended
+        by an outlier within the first input are final (the batch of all debts differs only for them)
+        """
+        return self._batch(_pay_delay_with_debts(self._payments, self._debts, self._first_input_debts()))
+
+    def _assert_equal_stories(self, stories: pa.Table, expected: pa.Table):
+        # the story-ids (and pd-ids) are numbered differently, the story is identified by its entity and beginning
+        _key = [(PaymentStoriesColumns.EntityId.name, 'ascending'), (PaymentStoriesColumns.BeginsAt.name, 'ascending')]
+        _stories = stories.sort_by(_key)
+        _expected = compact(expected, storage_schema(PaymentStoriesColumns.Stored)).sort_by(_key)
+        self.assertEqual(_stories.num_rows, _expected.num_rows)
+        for _name in _expected.column_names:
+            if _name in (PaymentStoriesColumns.StoryId.name, PaymentStoriesColumns.FirstPaymentId.name):
+                continue
+            _column = _stories.column(_name)
+            if pa.types.is_floating(_column.type):
+                np.testing.assert_allclose(_column.to_numpy(zero_copy_only=False).astype(np.float64),
+                                           _expected.column(_name).to_numpy(zero_copy_only=False).astype(np.float64),
+                                           rtol=1e-4, atol=1e-4, equal_nan=True, err_msg=_name)
+            else:
+                self.assertEqual(_column.to_pylist(), _expected.column(_name).to_pylist(), _name)
+
+    def test_from_scratch(self):
+        self._assert_equal_stories(IncrementalStories('test', self._scaling).update(self._all).stories, self._batch())
+
+    def test_update(self):
+        _first, _second, _debts = self._inputs()
+        _incremental = IncrementalStories('test', self._scaling)
+        _stories = _incremental.update(_first).stories
+        self.assertEqual(_incremental.pd_id_max(), _first.num_rows)
+
+        with tempfile.TemporaryDirectory() as _dir:
+            _incremental = IncrementalStories.read(_incremental.write(Path(_dir) / 'state.parquet'), 'test')
+        self.assertEqual(_incremental.pd_id_max(), _first.num_rows)
+        self.assertEqual(_incremental.scaling_parameters(), self._scaling)
+
+        _open = set(_incremental.state().column(StoryStateColumns.StoryId.name).to_pylist())
+        _update = _incremental.update(_second, _debts)
+        # the debts valid from before the last payment of the first input were joined to it already
+        self.assertGreater(_update.ignored_debts, 0)
+        # the new stories never take the id of an earlier one, only the open stories ended keep their id
+        self.assertTrue({_id for _id in _update.stories.column(PaymentStoriesColumns.StoryId.name).to_pylist()
+                         if _id <= _first.num_rows} <= _open)
+        self.assertEqual(_incremental.pd_id_max(), _first.num_rows + _second.num_rows)
+        _stories = updated_stories(_stories, _update)
+        self.assertEqual(len(pc.unique(_stories.column(PaymentStoriesColumns.StoryId.name))), _stories.num_rows)
+        self._assert_equal_stories(_stories, self._batch_as_known())
+
+    def test_debts_only(self):
+        # the debts of the second input arrive before its payments: the stories ended by them are final already
+        _first, _second, _debts = self._inputs()
+        _incremental = IncrementalStories('test', self._scaling)
+        _stories = _incremental.update(_first).stories
+        _stories = updated_stories(_stories, _incremental.update(debts=_debts))
+        _stories = updated_stories(_stories, _incremental.update(_second))
+        self._assert_equal_stories(_stories, self._batch_as_known())
+
+    def test_ended_by_outlier(self):
+        _first, _second, _debts = self._inputs()
+        _incremental = IncrementalStories('test', self._scaling)
+        _stories = updated_stories(_incremental.update(_first).stories, _incremental.update(_second, _debts))
+        _key = (pc.field(PaymentStoriesColumns.EntityId.name) == 1006) & \
+               (pc.field(PaymentStoriesColumns.BeginsAt.name) == _day(100))
+        # the story ended by the outlier keeps the debts known in the first input, the batch takes the later one
+        self.assertEqual(_stories.filter(_key).column(PaymentStoriesColumns.EndsWithCreditStatus.name).to_pylist(),
+                         [0])
+        self.assertEqual(self._batch().filter(_key).column(PaymentStoriesColumns.EndsWithCreditStatus.name).to_pylist(),
+                         [2])
+        # the last story of the first input followed by an outlier (in either input) is ended, not continued
+        for _entity in (1003, 1007):
+            self.assertEqual(_stories.filter(pc.field(PaymentStoriesColumns.EntityId.name) == _entity).column(
+                PaymentStoriesColumns.PaymentsCount.name).to_pylist(), [1, 1])
+
+    def test_payments_out_of_order(self):
+        _first, _second, _ = self._inputs()
+        _incremental = IncrementalStories('test', self._scaling)
+        _incremental.update(_second)
+        self.assertRaises(ValueError, _incremental.update, _first)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+from unittest import main
+from unittest import TestCase
+from unittest.mock import patch
+
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+
+from lib.subarrow import SpillingAggregate
+
+AGG = [('float', 'sum'), ('float', 'variance'), ('int', 'min'), ('int', 'max'), ('int', 'count')]
+
+
+class SpillingAggregateTests(TestCase):
+
+    def setUp(self) -> None:
+        _rng = np.random.default_rng(9)
+        _count = 5000
+        # the keys differ both in the lowest bits and in the next ones (the partitions of the re-partitioning)
+        _keys = _rng.integers(0, 1 << 12, _count)
+        self._table = pa.table({
+            'key': pa.array(_keys, pa.int64(), mask=_rng.random(_count) < 0.01),
+            'float': pa.array(_rng.normal(0.0, 10.0, _count), pa.float64()),
+            'int': pa.array(_rng.integers(-1000, 1000, _count), pa.int32(), mask=_rng.random(_count) < 0.05)
+        })
+        self._dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def _assert_equal_aggregates(self, aggregated: pa.Table, expected: pa.Table):
+        _aggregated = aggregated.sort_by('key')
+        _expected = expected.sort_by('key')
+        self.assertEqual(_aggregated.column_names, _expected.column_names)
+        for _name in _expected.column_names:
+            if pa.types.is_floating(_expected.column(_name).type):
+                # the partial results are merged in other order
+                np.testing.assert_allclose(_aggregated.column(_name).to_numpy(zero_copy_only=False),
+                                           _expected.column(_name).to_numpy(zero_copy_only=False),
+                                           rtol=1e-9, atol=1e-9, err_msg=_name)
+            else:
+                self.assertEqual(_aggregated.column(_name).to_pylist(), _expected.column(_name).to_pylist(), _name)
+
+    def test_spilled(self):
+        _expected = self._table.group_by('key').aggregate(AGG)
+        for _source in (self._table, pa.RecordBatchReader.from_batches(self._table.schema,
+                                                                       self._table.to_batches(max_chunksize=300))):
+            with patch.object(SpillingAggregate, '_spill', autospec=True,
+                              side_effect=SpillingAggregate._spill) as _spill:
+                _aggregated = SpillingAggregate(_source, 'key', AGG, memory_limit=2000,
+                                                tempdir=self._dir.name).aggregate()
+            # every partition is still too large, it is partitioned again by the next bits of the key
+            self.assertTrue(any(_call.args[0]._shift > 0 for _call in _spill.call_args_list))
+            self._assert_equal_aggregates(_aggregated, _expected)
+
+    def test_in_memory(self):
+        with patch.object(SpillingAggregate, '_spill', autospec=True) as _spill:
+            _aggregated = SpillingAggregate(self._table, 'key', AGG, tempdir=self._dir.name).aggregate()
+        _spill.assert_not_called()
+        self._assert_equal_aggregates(_aggregated, self._table.group_by('key').aggregate(AGG))
+
+    def test_empty(self):
+        _aggregated = SpillingAggregate(self._table.slice(0, 0), 'key', AGG, memory_limit=0,
+                                        tempdir=self._dir.name).aggregate()
+        self.assertEqual(_aggregated.num_rows, 0)
+        self.assertEqual(_aggregated.column_names, self._table.group_by('key').aggregate(AGG).column_names)
+
+    def test_idiot_durability(self):
+        _table = self._table.set_column(0, 'key', self._table.column('key').cast(pa.float64()))
+        self.assertRaises(ValueError, SpillingAggregate(_table, 'key', AGG, memory_limit=0,
+                                                        tempdir=self._dir.name).aggregate)
+
+
+if __name__ == '__main__':
+    main()